@@ -0,0 +1,263 @@
+#!/usr/bin/env python
+# -*- coding: utf_8 -*-
+
+
+"""
+ TestKit: Implementation of Fisher ROC protocol in python
+ This is distributed under GNU LGPL license, see license.txt
+
+ Alarm log decoding and incremental alarm synchronization. AlarmSync reads
+ the alarm pointer with opcode 120 and fetches only the records written
+ since the last sync with opcode 121, as many per request as fit in a
+ frame. The last pointer read for each device is kept in a CheckpointStore
+ so a restart carries on where it stopped.
+
+ An opcode 121 response is kept as an AlarmBatch: one copy of the record
+ bytes, with Alarm records that decode their fields only when asked.
+ todict() gives the dicts opcode121 has always returned.
+"""
+
+
+import os
+import json
+import calendar
+import threading
+
+import codec
+
+
+ALARM_LENGTH = 22
+ALARM_HEADER_LENGTH = 5
+MAX_ALARMS_PER_REQUEST = (codec.MAX_DATA_LENGTH - ALARM_HEADER_LENGTH) // ALARM_LENGTH
+
+ALARM_STRUCT = codec.get_struct('<8B10sf')
+ALARM_HEADER_STRUCT = codec.get_struct('<BHH')
+
+ALARM_TYPES = ('', 'Sensor DP', 'Sensor AP', 'Sensor PT', '', 'I/O Point', 'AGA', 'User Text', 'User Value', 'MVS Sensor', 'Sensor Module', '', '', '', '', 'FST')
+ALARM_SET = ('Alarm Clear', 'Alarm Set', 'Pulse Input Alarm Clear', 'Pulse Input Alarm Set', 'SRBX Alarm Clear', 'SRBX Alarm Set', '', '', '', '', '', '', '', '', '', '')
+
+_NO_CODES = ('', '', '', '', '', '', '', '')
+_IO_CODES = ('Low Alarm', 'Lo Lo Alarm', 'High Alarm', ' Hi Hi Alarm', 'Rate Alarm', 'Status Change', 'A/D Failure', 'Manual Mode')
+
+#alarm code names by alarm type
+ALARM_CODES = (
+	_NO_CODES,
+	_IO_CODES,
+	_IO_CODES,
+	_IO_CODES,
+	_NO_CODES,
+	_IO_CODES,
+	('Low Alarm', '', 'High Alarm', '', 'Redundant Total Count Alarm', 'Redundant FLow Alarm', 'No Flow Alarm', 'Manual Mode'),
+	_NO_CODES,
+	('Logic Alarm', '', '', '', '', '', '', ''),
+	('', '', '', '', 'Input Freeze Mode', 'EIA-485 Fail Alarm', 'Sensor COmmunications Fail Alarm', 'Off Scan Mode'),
+	('Sensor Out of Order', 'Phase Discrepancy Detected Alarm', 'Inconsistent Pulse Count', 'Frequency Discrepancy Alarm', 'Channel A Failure Alarm', 'Channel B Failure Alarm', '', ''),
+	_NO_CODES,
+	_NO_CODES,
+	_NO_CODES,
+	_NO_CODES,
+	_NO_CODES,
+)
+
+
+#=============================================================================================================
+# One alarm record (the fields of ALARM_STRUCT) as a dict
+#=============================================================================================================
+def alarm_dict(alarm):
+	iAlarmType = alarm[0] >> 4
+	aCode = ALARM_CODES[iAlarmType]
+	return {
+		'type': ALARM_TYPES[iAlarmType],
+		'set': ALARM_SET[alarm[0] & 0x0F],
+		'code': aCode[alarm[1]] if alarm[1] < len(aCode) else '',
+		'date_time': "20%02d-%02d-%02d %02d:%02d:%02d"%(alarm[7],alarm[6],alarm[5],alarm[4],alarm[3],alarm[2]),
+		'tag': alarm[8],
+		'value': str(alarm[9]),
+	}
+
+
+#*************************************************************************************************************
+# One alarm record, a view on the bytes of its batch
+#*************************************************************************************************************
+class Alarm(object):
+	__slots__ = ('_raw', '_offset', '_fields')
+
+	def __init__(self, raw, offset):
+		self._raw = raw
+		self._offset = offset
+		self._fields = None
+
+	# The fields of ALARM_STRUCT, unpacked on first use
+	@property
+	def fields(self):
+		if self._fields is None:
+			self._fields = ALARM_STRUCT.unpack_from(self._raw, self._offset)
+		return self._fields
+
+	@property
+	def type(self):
+		return ALARM_TYPES[ord(self._raw[self._offset]) >> 4]
+
+	@property
+	def set(self):
+		return ALARM_SET[ord(self._raw[self._offset]) & 0x0F]
+
+	@property
+	def code(self):
+		aCode = ALARM_CODES[ord(self._raw[self._offset]) >> 4]
+		iCode = ord(self._raw[self._offset + 1])
+		return aCode[iCode] if iCode < len(aCode) else ''
+
+	# Seconds since 1970 of the device clock
+	@property
+	def time(self):
+		fields = self.fields
+		return calendar.timegm((2000 + fields[7], fields[6], fields[5], fields[4], fields[3], fields[2]))
+
+	# Without the NUL padding the dict form keeps
+	@property
+	def tag(self):
+		return self.fields[8].rstrip('\x00')
+
+	@property
+	def value(self):
+		return self.fields[9]
+
+	def todict(self):
+		return alarm_dict(self.fields)
+
+	def __repr__(self):
+		return 'Alarm(%r, %r, %r)'%(self.tag, self.set, self.value)
+
+
+#*************************************************************************************************************
+# Opcode 121 response
+#*************************************************************************************************************
+class AlarmBatch(object):
+	__slots__ = ('number', 'starting_pointer', 'current_pointer', '_raw')
+
+	def __init__(self, number, starting_pointer, current_pointer, raw):
+		self.number = number
+		self.starting_pointer = starting_pointer
+		self.current_pointer = current_pointer
+		self._raw = raw
+
+	def __len__(self):
+		return len(self._raw) // ALARM_LENGTH
+
+	def __getitem__(self, i):
+		if i < 0:
+			i += len(self)
+		if not 0 <= i < len(self):
+			raise IndexError('Alarm index out of range')
+		return Alarm(self._raw, i * ALARM_LENGTH)
+
+	def __iter__(self):
+		raw = self._raw
+		for offset in xrange(0, len(raw), ALARM_LENGTH):
+			yield Alarm(raw, offset)
+
+	#=============================================================================================================
+	# Same form as opcode121 returns
+	#=============================================================================================================
+	def todict(self):
+		unpack_from = ALARM_STRUCT.unpack_from
+		raw = self._raw
+		return {
+			'number': self.number,
+			'starting_pointer': self.starting_pointer,
+			'current_pointer': self.current_pointer,
+			'alarms': [alarm_dict(unpack_from(raw, offset)) for offset in xrange(0, len(raw), ALARM_LENGTH)],
+		}
+
+
+#=============================================================================================================
+# Opcode 121 response as an AlarmBatch, the whole records are copied out of the frame in one slice
+#=============================================================================================================
+def decode_alarms(frame, number, pointer):
+	iNumber, iStart, iCurrent = frame.unpack_from(ALARM_HEADER_STRUCT)
+	if not(iNumber == number):
+		raise RuntimeError('Incorrect Alarms in Response')
+
+	if not(iStart == pointer):
+		raise RuntimeError('Incorrect Pointer in Response')
+
+	start = codec.HEADER_LENGTH + ALARM_HEADER_LENGTH
+	end = start + (frame.length - ALARM_HEADER_LENGTH) // ALARM_LENGTH * ALARM_LENGTH
+	return AlarmBatch(iNumber, iStart, iCurrent, bytes(frame.buffer[start:end]))
+
+
+#*************************************************************************************************************
+# Last read pointer per device, kept in a small json file
+# The file is replaced atomically on every save, so a crash leaves either the old or the new checkpoints.
+#*************************************************************************************************************
+class CheckpointStore(object):
+
+	def __init__(self, path=None):
+		self.path = path
+		self._data = {}
+		self._lock = threading.Lock()
+		if path and os.path.exists(path):
+			with open(path) as f:
+				self._data = json.load(f)
+
+	def get(self, key, default=None):
+		with self._lock:
+			return self._data.get(key, default)
+
+	def set(self, key, value):
+		with self._lock:
+			self._data[key] = value
+			if self.path:
+				sTemp = self.path + '.tmp'
+				with open(sTemp, 'w') as f:
+					json.dump(self._data, f)
+				if os.name == 'nt' and os.path.exists(self.path):
+					os.remove(self.path)
+				os.rename(sTemp, self.path)
+
+
+#*************************************************************************************************************
+# Incremental alarm log reader for the devices behind one master
+# Works on the blocking TcpMaster; checkpoints are keyed by server, port, address and group.
+#*************************************************************************************************************
+class AlarmSync(object):
+
+	def __init__(self, master, store=None, batch_size=MAX_ALARMS_PER_REQUEST):
+		self.master = master
+		self.store = store or CheckpointStore()
+		self.batch_size = min(batch_size, MAX_ALARMS_PER_REQUEST)
+
+	def _key(self, address, group):
+		return '%s:%s:%d:%d'%(getattr(self.master, '_server', ''), getattr(self.master, '_port', ''), address, group)
+
+	#=============================================================================================================
+	# Read the alarms logged since the last sync, oldest first, as Alarm records (todict() for the old form)
+	# The first sync of a device only records the current pointer, unless backfill is set, then the whole
+	# ring (max_alarms records) is read.
+	#=============================================================================================================
+	def sync(self, address, group, backfill=False):
+		key = self._key(address, group)
+		pointers = self.master.opcode120(address, group)
+		current = pointers['alarm_pointer']
+		size = pointers['max_alarms'] or 1
+		last = self.store.get(key)
+		if last is None:
+			if not backfill:
+				self.store.set(key, current)
+				return []
+			last = current
+			count = size
+		else:
+			count = (current - last) % size
+
+		aAlarms = []
+		pointer = last % size
+		while count > 0:
+			#never read across the end of the ring
+			number = min(count, self.batch_size, size - pointer)
+			aAlarms.extend(self.master.read_alarms(address, group, number, pointer))
+			pointer = (pointer + number) % size
+			count -= number
+			self.store.set(key, pointer)
+		return aAlarms
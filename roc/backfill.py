@@ -0,0 +1,215 @@
+#!/usr/bin/env python
+# -*- coding: utf_8 -*-
+
+
+"""
+ TestKit: Implementation of Fisher ROC protocol in python
+ This is distributed under GNU LGPL license, see license.txt
+
+ History backfill. DailyBackfill reads opcode 128 records for a set of
+ points over a date range and streams them as they arrive, with the next
+ request already on the wire while the caller handles the current record:
+
+	backfill = DailyBackfill(master, 240, 240, [1, 2, 3], date(2026, 9, 1), date(2026, 9, 30))
+	for record in backfill:
+		store(record)
+
+ PeriodicBackfill does the same for a range of history indexes of a run of
+ points with opcode 136, as many periods per request as fit in a frame.
+ Iterating gives one history.PeriodBlock per response, periods() one
+ (timestamp, values) per period with the values of every point:
+
+	backfill = PeriodicBackfill(master, 240, 240, segment=0, first_point=0, points=24, index=0, count=840)
+	for epoch, values in backfill.periods():
+		store(epoch, values)
+
+ With an AsyncTcpMaster iterate over futures() from a coroutine instead:
+
+	for future in backfill.futures():
+		record = yield future
+
+ Completed requests are kept in done. After a link drop the same object
+ (or a new one given the saved done list) carries on with the requests
+ that are still missing. Given a store.TimeSeriesStore, DailyBackfill also
+ skips the days already stored for the device and stores what it reads.
+"""
+
+
+import calendar
+import datetime
+import threading
+import Queue
+
+import history
+import store as roc_store
+
+
+def _epoch(day):
+	return calendar.timegm(day.timetuple())
+
+
+#*************************************************************************************************************
+# Requests streamed in order with prefetch, subclasses fill _jobs and implement _request(*job)
+#*************************************************************************************************************
+class _Backfill(object):
+
+	def __init__(self, master, address, group, done=(), prefetch=1):
+		self.master = master
+		self.address = address
+		self.group = group
+		self.prefetch = max(1, prefetch)
+		self.done = set(tuple(key) for key in done)
+		self._jobs = []
+
+	def _pending(self):
+		return [job for job in self._jobs if job not in self.done]
+
+	def __len__(self):
+		return len(self._pending())
+
+	def _request(self, *job):
+		raise NotImplementedError()
+
+	#=============================================================================================================
+	# Blocking iteration, a worker thread reads up to prefetch records ahead of the caller
+	# The first error stops the worker and is raised here; records not yet yielded stay pending.
+	#=============================================================================================================
+	def __iter__(self):
+		aJobs = self._pending()
+		results = Queue.Queue(self.prefetch)
+		stop = threading.Event()
+
+		def work():
+			for job in aJobs:
+				try:
+					item = (job, self._request(*job), None)
+				except Exception as ex:
+					item = (job, None, ex)
+				while not stop.is_set():
+					try:
+						results.put(item, timeout=0.5)
+						break
+					except Queue.Full:
+						pass
+				if stop.is_set() or item[2] is not None:
+					return
+
+		worker = threading.Thread(target=work, name=self.__class__.__name__)
+		worker.daemon = True
+		worker.start()
+		try:
+			for i in range(len(aJobs)):
+				job, record, exception = results.get()
+				if exception is not None:
+					raise exception
+				self.done.add(job)
+				yield record
+		finally:
+			stop.set()
+
+	def _completed(self, job, future):
+		if future.exception() is None:
+			self.done.add(job)
+
+	#=============================================================================================================
+	# Futures of the pending records in order, for an AsyncTcpMaster
+	# Requests are queued prefetch + 1 ahead, so the link never waits for the caller.
+	#=============================================================================================================
+	def futures(self):
+		aJobs = self._pending()
+		aFutures = []
+		for i, job in enumerate(aJobs):
+			while len(aFutures) <= min(i + self.prefetch, len(aJobs) - 1):
+				queued = aJobs[len(aFutures)]
+				future = self._request(*queued)
+				future.add_done_callback(lambda f, queued=queued: self._completed(queued, f))
+				aFutures.append(future)
+			yield aFutures[i]
+			aFutures[i] = None
+
+
+#*************************************************************************************************************
+# Opcode 128 reads for points x days
+#*************************************************************************************************************
+class DailyBackfill(_Backfill):
+
+	def __init__(self, master, address, group, points, start, end, done=(), prefetch=1, store=None, device=None):
+		_Backfill.__init__(self, master, address, group, done, prefetch)
+		self.store = store
+		self.device = device or '%s:%s/%d,%d'%(getattr(master, '_server', ''), getattr(master, '_port', ''), address, group)
+		day = start
+		while day <= end:
+			for point in points:
+				self._jobs.append((point, day.toordinal()))
+				#the first hour of the day is stored for every record, the daily value only when the device has one
+				if store is not None and store.contains(self.device, roc_store.hourly_key(point), _epoch(day)):
+					self.done.add((point, day.toordinal()))
+			day += datetime.timedelta(days=1)
+
+	def pending(self):
+		return [(point, datetime.date.fromordinal(day)) for point, day in self._pending()]
+
+	def _request(self, point, day):
+		date = datetime.date.fromordinal(day)
+		record = self.master.opcode128(self.address, self.group, point, date.day, date.month, year=date.year)
+		if self.store is None:
+			return record
+		return self.master._chain(record, self._stored)
+
+	def _stored(self, record):
+		self.store.add_daily(self.device, record)
+		return record
+
+
+#*************************************************************************************************************
+# Opcode 136 reads for count periods of points first_point to first_point + points - 1
+# Points that do not fit in one response with a single period are split into groups; every group of a range
+# of indexes is read before the next range. size is the number of entries of the segment, indexes past it
+# wrap around to 0.
+#*************************************************************************************************************
+class PeriodicBackfill(_Backfill):
+
+	def __init__(self, master, address, group, segment, first_point, points, index, count, history_type=history.PERIODIC, size=None, periods=None, done=(), prefetch=1):
+		_Backfill.__init__(self, master, address, group, done, prefetch)
+		self.segment = segment
+		self.history_type = history_type
+		self.size = size
+		group_points = min(points, history.MAX_PERIOD_POINTS)
+		aGroups = [(point, min(group_points, first_point + points - point)) for point in range(first_point, first_point + points, group_points)]
+		per_request = history.max_periods(group_points)
+		if periods is not None:
+			per_request = min(per_request, periods)
+		self.groups = len(aGroups)
+		for offset in range(0, count, per_request):
+			for first, number in aGroups:
+				self._jobs.append((index + offset, first, number, min(per_request, count - offset)))
+
+	def pending(self):
+		return self._pending()
+
+	def _request(self, index, first_point, points, periods):
+		if self.size:
+			index %= self.size
+		return self.master.opcode136(self.address, self.group, self.segment, index, first_point, points, periods, self.history_type)
+
+	#=============================================================================================================
+	# (timestamp, values) per period in index order, values of all the points
+	# Only the responses of one range of indexes are held at a time. Meant for a fresh backfill, after a resume
+	# iterate the blocks instead.
+	#=============================================================================================================
+	def periods(self):
+		aBlocks = []
+		for block in self:
+			aBlocks.append(block)
+			if len(aBlocks) < self.groups:
+				continue
+			if len(aBlocks) == 1:
+				for period in block:
+					yield period
+			else:
+				for i, epoch in enumerate(aBlocks[0].times[:min(len(part) for part in aBlocks)]):
+					aValues = []
+					for part in aBlocks:
+						aValues.extend(part.row(i))
+					yield epoch, tuple(aValues)
+			aBlocks = []
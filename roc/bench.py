@@ -0,0 +1,263 @@
+#!/usr/bin/env python
+# -*- coding: utf_8 -*-
+
+
+"""
+ TestKit: Implementation of Fisher ROC protocol in python
+ This is distributed under GNU LGPL license, see license.txt
+
+ Benchmarks for TcpMaster against simulated ROC slaves. Every opcode is
+ timed on its own, then a mixed fleet workload runs several masters in
+ threads against several simulated ports. The codec paths (frame encode,
+ frame decode, crc, point set decode) are also timed without a socket.
+
+ The simulated slaves run in a child process, so the CPU time measured is
+ the master's alone. Results are transactions per second, CPU seconds and
+ wall seconds per call, the growth of GC-tracked objects per call (measured
+ with the collector off, so anything a call leaves behind shows up) and,
+ where the tracemalloc module is available, the growth of traced memory per
+ call. Use --json to keep a run for comparison with later ones:
+
+	python -m roc.bench --duration 2 --latency 0.001 --json bench.json
+"""
+
+
+import os
+import gc
+import sys
+import time
+import json
+import random
+import platform
+import threading
+import optparse
+import multiprocessing
+
+import crc
+import codec
+import points
+import roc_tcp
+import link
+import metrics
+import simulator
+
+try:
+	import tracemalloc
+except ImportError:
+	tracemalloc = None
+
+
+ADDRESS = 240
+GROUP = 240
+
+TLP_SMALL = [[1, 0, 3], [1, 0, 4], [1, 0, 5], [1, 0, 6]]
+TLP_LARGE = [[1, l, p] for l in range(3) for p in range(12)]
+
+
+#=============================================================================================================
+# CPU seconds used by the process
+#=============================================================================================================
+def _cpu():
+	return sum(os.times()[:2])
+
+
+#=============================================================================================================
+# Run fn repeatedly for duration seconds (at least min_calls times) and measure it
+#=============================================================================================================
+def measure(name, fn, duration=1.0, min_calls=10):
+	try:
+		fn()
+	except Exception:
+		pass
+	calls = 0
+	errors = 0
+	if tracemalloc is not None:
+		tracemalloc.start()
+		snapshot = tracemalloc.take_snapshot()
+	enabled = gc.isenabled()
+	gc.collect()
+	gc.disable()
+	objects = len(gc.get_objects())
+	wall = time.time()
+	cpu = _cpu()
+	deadline = wall + duration
+	while calls < min_calls or time.time() < deadline:
+		try:
+			fn()
+		except Exception:
+			errors += 1
+		calls += 1
+	cpu = _cpu() - cpu
+	wall = time.time() - wall
+	#the list returned by get_objects is not tracked itself
+	objects = (len(gc.get_objects()) - objects) / float(calls)
+	if enabled:
+		gc.enable()
+	allocated = None
+	if tracemalloc is not None:
+		allocated = sum(stat.size_diff for stat in tracemalloc.take_snapshot().compare_to(snapshot, 'filename')) / float(calls)
+		tracemalloc.stop()
+	return {'name':name, 'calls':calls, 'errors':errors, 'tps':calls / wall, 'wall_per_call':wall / calls, 'cpu_per_call':cpu / calls, 'objects_per_call':objects, 'bytes_per_call':allocated}
+
+
+#=============================================================================================================
+# Codec paths without a socket
+#=============================================================================================================
+def bench_codec(duration):
+	aResults = []
+	buf = bytearray(codec.MAX_FRAME_LENGTH)
+	body = points.compile_points(TLP_LARGE, ['f'] * len(TLP_LARGE)).request
+	aResults.append(measure('codec encode_frame_into', lambda: codec.encode_frame_into(buf, ADDRESS, GROUP, 1, 3, 180, body), duration))
+
+	device = simulator.SimulatedDevice(ADDRESS, GROUP)
+	point_set = points.compile_points(TLP_LARGE, ['f'] * len(TLP_LARGE))
+	response = codec.encode_frame(1, 3, ADDRESS, GROUP, 180, device.handle(180, bytearray(point_set.request))[1])
+	aResults.append(measure('codec decode_frame', lambda: codec.decode_frame(response), duration))
+	frame = codec.decode_frame(response)
+	aResults.append(measure('points decode 36 floats', lambda: point_set.decode(frame), duration))
+	aResults.append(measure('points compile (cached)', lambda: points.compile_points(TLP_LARGE, ['f'] * len(TLP_LARGE)), duration))
+	aResults.append(measure('crc16 263 bytes', lambda: crc.crc16(response), duration))
+	return aResults
+
+
+#=============================================================================================================
+# One master, one opcode at a time
+#=============================================================================================================
+def bench_opcodes(port, duration):
+	manager = link.LinkManager()
+	master = roc_tcp.TcpMaster('127.0.0.1', port, link_manager=manager, metrics_registry=metrics.Registry(enabled=False))
+	today = time.gmtime()
+
+	aCases = [
+		('opcode8 set clock', lambda: master.opcode8(ADDRESS, GROUP, today.tm_sec, today.tm_min, today.tm_hour, today.tm_mday, today.tm_mon, today.tm_year - 2000)),
+		('opcode17 login', lambda: master.opcode17(ADDRESS, GROUP)),
+		('opcode120 pointers', lambda: master.opcode120(ADDRESS, GROUP)),
+		('opcode121 11 alarms', lambda: master.opcode121(ADDRESS, GROUP, 11, 0)),
+		('opcode126 minute history', lambda: master.opcode126(ADDRESS, GROUP, 1)),
+		('opcode128 daily history', lambda: master.opcode128(ADDRESS, GROUP, 1, today.tm_mday, today.tm_mon)),
+		('opcode180 4 points', lambda: master.opcode180(ADDRESS, GROUP, TLP_SMALL, ['f'] * len(TLP_SMALL))),
+		('opcode180 36 points', lambda: master.opcode180(ADDRESS, GROUP, TLP_LARGE, ['f'] * len(TLP_LARGE))),
+		('opcode181 4 points', lambda: master.opcode181(ADDRESS, GROUP, TLP_SMALL, ['f'] * len(TLP_SMALL), [1.0, 2.0, 3.0, 4.0])),
+	]
+	aResults = [measure(name, fn, duration) for name, fn in aCases]
+	manager.close_all()
+	return aResults
+
+
+#=============================================================================================================
+# Several masters per port in threads, each running a random mix of reads
+#=============================================================================================================
+def bench_fleet(ports, devices, duration, seed=1):
+	manager = link.LinkManager()
+	registry = metrics.Registry(enabled=False)
+	counts = []
+	stop = threading.Event()
+
+	def work(port, address, rng, count):
+		master = roc_tcp.TcpMaster('127.0.0.1', port, link_manager=manager, metrics_registry=registry)
+		aMix = [
+			lambda: master.opcode180(address, GROUP, TLP_SMALL, ['f'] * len(TLP_SMALL)),
+			lambda: master.opcode180(address, GROUP, TLP_LARGE, ['f'] * len(TLP_LARGE)),
+			lambda: master.opcode120(address, GROUP),
+			lambda: master.opcode126(address, GROUP, 1),
+		]
+		aWeights = [0, 0, 0, 0, 0, 0, 1, 1, 2, 3]
+		while not stop.is_set():
+			try:
+				aMix[rng.choice(aWeights)]()
+				count[0] += 1
+			except Exception:
+				count[1] += 1
+
+	aThreads = []
+	rng = random.Random(seed)
+	for port in ports:
+		for i in range(devices):
+			count = [0, 0]
+			counts.append(count)
+			thread = threading.Thread(target=work, args=(port, 1 + i, random.Random(rng.random()), count))
+			thread.daemon = True
+			aThreads.append(thread)
+
+	cpu = _cpu()
+	wall = time.time()
+	for thread in aThreads:
+		thread.start()
+	time.sleep(duration)
+	stop.set()
+	for thread in aThreads:
+		thread.join()
+	wall = time.time() - wall
+	cpu = _cpu() - cpu
+	manager.close_all()
+	calls = sum(count[0] for count in counts) or 1
+	return [{'name':'fleet %d ports x %d devices'%(len(ports), devices), 'calls':calls, 'errors':sum(count[1] for count in counts), 'tps':calls / wall, 'wall_per_call':wall / calls, 'cpu_per_call':cpu / calls, 'objects_per_call':None, 'bytes_per_call':None}]
+
+
+#=============================================================================================================
+# Child process running the simulated ports, sends their port numbers and runs until told to stop
+#=============================================================================================================
+def _serve(conn, count, devices, latency, jitter, corruption, seed):
+	aServers = []
+	for i in range(count):
+		server = simulator.SimulatedRoc(latency=latency, jitter=jitter, corruption=corruption, seed=seed + i)
+		device = server.add_device(ADDRESS, GROUP)
+		for n in range(40):
+			device.add_alarm('TAG%d'%n)
+		for n in range(devices):
+			server.add_device(1 + n, GROUP)
+		aServers.append(server.start())
+	conn.send([server.port for server in aServers])
+	conn.recv()
+	for server in aServers:
+		server.stop()
+
+
+def _report(aResults, out=sys.stdout):
+	out.write('%-32s %10s %10s %12s %12s %9s %9s %7s\n'%('benchmark', 'calls', 'tps', 'wall us', 'cpu us', 'objects', 'bytes', 'errors'))
+	for r in aResults:
+		sObjects = '%.2f'%r['objects_per_call'] if r['objects_per_call'] is not None else '-'
+		sBytes = '%.0f'%r['bytes_per_call'] if r['bytes_per_call'] is not None else '-'
+		out.write('%-32s %10d %10.1f %12.1f %12.1f %9s %9s %7d\n'%(r['name'], r['calls'], r['tps'], r['wall_per_call'] * 1e6, r['cpu_per_call'] * 1e6, sObjects, sBytes, r['errors']))
+
+
+def main(argv=None):
+	parser = optparse.OptionParser(usage='%prog [options]')
+	parser.add_option('--duration', type='float', default=1.0, help='seconds per benchmark')
+	parser.add_option('--latency', type='float', default=0.0, help='simulated response latency in seconds')
+	parser.add_option('--jitter', type='float', default=0.0, help='random extra latency in seconds')
+	parser.add_option('--corruption', type='float', default=0.0, help='fraction of corrupted responses')
+	parser.add_option('--ports', type='int', default=4, help='simulated ports in the fleet workload')
+	parser.add_option('--devices', type='int', default=4, help='devices per port in the fleet workload')
+	parser.add_option('--seed', type='int', default=1)
+	parser.add_option('--skip-codec', action='store_true', default=False)
+	parser.add_option('--skip-fleet', action='store_true', default=False)
+	parser.add_option('--json', help='write the results to this file')
+	options, args = parser.parse_args(argv)
+
+	conn, child_conn = multiprocessing.Pipe()
+	child = multiprocessing.Process(target=_serve, args=(child_conn, max(1, options.ports), options.devices, options.latency, options.jitter, options.corruption, options.seed))
+	child.daemon = True
+	child.start()
+	aPorts = conn.recv()
+
+	aResults = []
+	try:
+		if not options.skip_codec:
+			aResults.extend(bench_codec(options.duration))
+		aResults.extend(bench_opcodes(aPorts[0], options.duration))
+		if not options.skip_fleet:
+			aResults.extend(bench_fleet(aPorts, options.devices, options.duration, options.seed))
+	finally:
+		conn.send('stop')
+		child.join(5)
+
+	_report(aResults)
+	if options.json:
+		with open(options.json, 'w') as f:
+			json.dump({'time':time.time(), 'python':platform.python_version(), 'options':options.__dict__, 'results':aResults}, f, indent=1)
+	return 0
+
+
+if __name__ == '__main__':
+	sys.exit(main())
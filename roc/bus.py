@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+# -*- coding: utf_8 -*-
+
+
+"""
+ TestKit: Implementation of Fisher ROC protocol in python
+ This is distributed under GNU LGPL license, see license.txt
+
+ Multi-drop bus arbitration. Several ROCs on one RS-485 line behind a
+ terminal server share a single Link and differ only by address/group. A
+ Bus queues the transactions waiting for that link per device and hands
+ the line out round robin between devices, so a unit with a long backlog or
+ slow answers takes one turn at a time and the rest of the drop keeps
+ being polled. Responses are routed by header (see Link.recv), a late
+ answer or line noise is dropped without reconnecting.
+
+	master = TcpMaster('10.0.0.5', 4000, bus=True)
+	with bus.get(link).turn(address, group):
+		...
+"""
+
+
+import weakref
+import threading
+from collections import deque, OrderedDict
+
+
+#*************************************************************************************************************
+# A transaction waiting for the line
+#*************************************************************************************************************
+class _Ticket(object):
+	__slots__ = ('granted',)
+
+	def __init__(self):
+		self.granted = False
+
+
+#*************************************************************************************************************
+# Holds the line for one device for the length of a with block
+#*************************************************************************************************************
+class _Turn(object):
+	__slots__ = ('bus', 'device')
+
+	def __init__(self, bus, device):
+		self.bus = bus
+		self.device = device
+
+	def __enter__(self):
+		self.bus.acquire(self.device)
+		return self.bus.link
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		self.bus.release()
+		return False
+
+
+#*************************************************************************************************************
+# Bus arbiter for one link
+#*************************************************************************************************************
+class Bus(object):
+
+	def __init__(self, link):
+		self.link = link
+		self.transactions = 0
+		self.waits = 0
+		self._busy = False
+		self._queues = OrderedDict()
+		self._served = {}
+		self._cond = threading.Condition(threading.Lock())
+
+	def turn(self, address, group):
+		return _Turn(self, (address, group))
+
+	#=============================================================================================================
+	# Wait for the turn of device, then hold the link
+	#=============================================================================================================
+	def acquire(self, device):
+		with self._cond:
+			if self._busy:
+				ticket = _Ticket()
+				queue = self._queues.get(device)
+				if queue is None:
+					queue = self._queues[device] = deque()
+				queue.append(ticket)
+				self.waits += 1
+				while not ticket.granted:
+					self._cond.wait()
+			self._busy = True
+			self.transactions += 1
+			self._served[device] = self._served.get(device, 0) + 1
+		self.link.__enter__()
+
+	#=============================================================================================================
+	# Release the link and give it to the next device in turn
+	# The device served longest ago goes first, a device with more waiting goes to the back of the line.
+	#=============================================================================================================
+	def release(self):
+		self.link.__exit__(None, None, None)
+		with self._cond:
+			if not self._queues:
+				self._busy = False
+				return
+			device, queue = self._queues.popitem(last=False)
+			queue.popleft().granted = True
+			if queue:
+				self._queues[device] = queue
+			self._cond.notify_all()
+
+	#=============================================================================================================
+	# Waiting transactions per device and transactions served per device
+	#=============================================================================================================
+	def pending(self):
+		with self._cond:
+			return dict((device, len(queue)) for device, queue in self._queues.items())
+
+	def served(self):
+		with self._cond:
+			return dict(self._served)
+
+
+_buses = weakref.WeakKeyDictionary()
+_lock = threading.Lock()
+
+
+#=============================================================================================================
+# The Bus of a link, every master on the same link must use the same one
+#=============================================================================================================
+def get(link):
+	with _lock:
+		bus = _buses.get(link)
+		if bus is None:
+			bus = _buses[link] = Bus(link)
+		return bus
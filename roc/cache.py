@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+# -*- coding: utf_8 -*-
+
+
+"""
+ TestKit: Implementation of Fisher ROC protocol in python
+ This is distributed under GNU LGPL license, see license.txt
+
+ Read-through cache for opcode 180. Values are kept per (device, T, L, P)
+ for a time to live chosen by point type, with LRU eviction past
+ max_entries. A read that is only partly cached fetches the missing points
+ alone. An opcode 181 write drops the points it writes.
+
+	cache = TlpCache(ttls={12: 0, 15: 3600, 1: 5}, default_ttl=10)
+	master = TcpMaster('10.0.0.5', 4000, cache=cache)
+"""
+
+
+import time
+import threading
+from itertools import chain
+from collections import OrderedDict
+
+import points
+
+
+#*************************************************************************************************************
+# TLP value cache
+# ttls maps a point type to seconds (0 is never cached), default_ttl is for the types not in ttls
+#*************************************************************************************************************
+class TlpCache(object):
+
+	def __init__(self, ttls=None, default_ttl=5.0, max_entries=10000):
+		self.ttls = dict(ttls or {})
+		self.default_ttl = default_ttl
+		self.max_entries = max_entries
+		self.hits = 0
+		self.misses = 0
+		self._entries = OrderedDict()
+		self._lock = threading.Lock()
+
+	def __len__(self):
+		return len(self._entries)
+
+	def ttl(self, t):
+		return self.ttls.get(t, self.default_ttl)
+
+	#=============================================================================================================
+	# Cached values of a PointSet, one tuple of items per point (None where missing)
+	#=============================================================================================================
+	def lookup(self, device, point_set):
+		now = time.time()
+		aValues = []
+		with self._lock:
+			entries = self._entries
+			for tlp, fmt in zip(point_set.TLP, point_set.data_format):
+				key = (device, tlp)
+				entry = entries.pop(key, None)
+				if entry is None or entry[0] <= now or entry[1] != fmt:
+					aValues.append(None)
+					self.misses += 1
+					continue
+				entries[key] = entry
+				aValues.append(entry[2])
+				self.hits += 1
+		return aValues
+
+	#=============================================================================================================
+	# Store the values decoded for a PointSet
+	#=============================================================================================================
+	def store(self, device, point_set, values):
+		now = time.time()
+		with self._lock:
+			entries = self._entries
+			for tlp, fmt, (start, end) in zip(point_set.TLP, point_set.data_format, point_set.spans):
+				ttl = self.ttl(tlp[0])
+				if ttl <= 0:
+					continue
+				key = (device, tlp)
+				entries.pop(key, None)
+				entries[key] = (now + ttl, fmt, values[start:end])
+			while len(entries) > self.max_entries:
+				entries.popitem(last=False)
+
+	def invalidate(self, device, TLP):
+		with self._lock:
+			for tlp in TLP:
+				self._entries.pop((device, tuple(tlp)), None)
+
+	def clear(self, device=None):
+		with self._lock:
+			if device is None:
+				self._entries.clear()
+			else:
+				for key in [key for key in self._entries if key[0] == device]:
+					del self._entries[key]
+
+
+#*************************************************************************************************************
+# A read that is partly cached: the points to fetch and how to put the values back together
+#*************************************************************************************************************
+class PartialRead(object):
+
+	def __init__(self, cache, device, point_set, cached):
+		self.cache = cache
+		self.device = device
+		self.cached = cached
+		aMissing = [i for i, values in enumerate(cached) if values is None]
+		self.missing = aMissing
+		self.fetch = points.compile_points([point_set.TLP[i] for i in aMissing], [point_set.data_format[i] for i in aMissing])
+
+	#=============================================================================================================
+	# Flat values of the whole read, from the cache and the values fetched for the missing points
+	#=============================================================================================================
+	def merge(self, fetched):
+		self.cache.store(self.device, self.fetch, fetched)
+		aItems = list(self.cached)
+		for i, (start, end) in zip(self.missing, self.fetch.spans):
+			aItems[i] = fetched[start:end]
+		return tuple(chain.from_iterable(aItems))
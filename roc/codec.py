@@ -0,0 +1,296 @@
+#!/usr/bin/env python
+# -*- coding: utf_8 -*-
+
+
+"""
+ TestKit: Implementation of Fisher ROC protocol in python
+ This is distributed under GNU LGPL license, see license.txt
+
+ ROC frame codec. A frame is a 6 byte header (destination address/group,
+ source address/group, opcode, data length), up to 255 data bytes and a
+ 2 byte crc. Frames are built in and parsed from bytearray buffers without
+ building strings byte by byte.
+"""
+
+
+import time
+import errno
+import socket
+import struct
+from itertools import islice
+
+import crc
+from errors import TimeoutError, OpcodeError
+
+
+HEADER_LENGTH = 6
+CRC_LENGTH = 2
+MAX_DATA_LENGTH = 255
+MAX_FRAME_LENGTH = HEADER_LENGTH + MAX_DATA_LENGTH + CRC_LENGTH
+
+ERROR_OPCODE = 255
+
+_STRUCTS = {}
+
+
+#=============================================================================================================
+# Cached struct.Struct for a format string
+#=============================================================================================================
+def get_struct(fmt):
+	oStruct = _STRUCTS.get(fmt)
+	if oStruct is None:
+		oStruct = _STRUCTS[fmt] = struct.Struct(fmt)
+	return oStruct
+
+
+#=============================================================================================================
+# Crc of the first end bytes of a bytearray, without slicing it
+#=============================================================================================================
+def _crc(buf, end):
+	table = crc.CRC16_TABLE
+	value = 0x0000
+	for c in islice(buf, 0, end):
+		value = (value >> 8) ^ table[(value ^ c) & 0xff]
+	return value
+
+
+#=============================================================================================================
+# Write a complete frame into buf and return its length
+# body may be a str, bytearray or a list of byte values
+#=============================================================================================================
+def encode_frame_into(buf, address, group, host_address, host_group, opcode, body=''):
+	length = len(body)
+	if length > MAX_DATA_LENGTH:
+		raise ValueError('Frame data too long: %d bytes'%length)
+	end = HEADER_LENGTH + length
+	buf[0] = address
+	buf[1] = group
+	buf[2] = host_address
+	buf[3] = host_group
+	buf[4] = opcode
+	buf[5] = length
+	if length:
+		buf[HEADER_LENGTH:end] = body
+	value = _crc(buf, end)
+	buf[end] = value & 0xff
+	buf[end + 1] = value >> 8
+	return end + CRC_LENGTH
+
+
+#=============================================================================================================
+# Build a frame in a new buffer of exactly the frame size
+#=============================================================================================================
+def encode_frame(address, group, host_address, host_group, opcode, body=''):
+	buf = bytearray(HEADER_LENGTH + len(body) + CRC_LENGTH)
+	encode_frame_into(buf, address, group, host_address, host_group, opcode, body)
+	return buf
+
+
+#*************************************************************************************************************
+# Parsed frame, a view on the buffer it was received in
+#*************************************************************************************************************
+class Frame(object):
+	__slots__ = ('buffer', 'host_address', 'host_group', 'address', 'group', 'opcode', 'length')
+
+	def __init__(self, buf):
+		self.buffer = buf
+		self.host_address = buf[0]
+		self.host_group = buf[1]
+		self.address = buf[2]
+		self.group = buf[3]
+		self.opcode = buf[4]
+		self.length = buf[5]
+
+	# Data byte i (0 is the first byte after the header)
+	def byte(self, i):
+		if i >= self.length:
+			raise RuntimeError('Incorrect Length in Response')
+		return self.buffer[HEADER_LENGTH + i]
+
+	# Data bytes as a memoryview, nothing is copied
+	@property
+	def data(self):
+		return memoryview(self.buffer)[HEADER_LENGTH:HEADER_LENGTH + self.length]
+
+	# Unpack typed fields at a data offset, fmt is a format string or a struct.Struct
+	# The buffer is reused between frames, so nothing past the data of this frame may be read.
+	def unpack_from(self, fmt, offset=0):
+		if not isinstance(fmt, struct.Struct):
+			fmt = get_struct(fmt)
+		if offset + fmt.size > self.length:
+			raise RuntimeError('Incorrect Length in Response')
+		return fmt.unpack_from(self.buffer, HEADER_LENGTH + offset)
+
+	# Header and data as a list of byte values (crc excluded)
+	def tolist(self):
+		return list(islice(self.buffer, 0, HEADER_LENGTH + self.length))
+
+	def is_error(self):
+		return self.opcode == ERROR_OPCODE
+
+	#=============================================================================================================
+	# Validate a response against the request it answers
+	#=============================================================================================================
+	def check(self, host_address, host_group, address, group, opcode, TLP=[]):
+		if not(self.host_address == host_address) or not(self.host_group == host_group):
+			raise RuntimeError('Incorrect Host Address in Response')
+
+		if not(self.address == address) or not(self.group == group):
+			raise RuntimeError('Incorrect Device Address in Response')
+
+		if not(self.opcode == opcode) and (self.opcode != ERROR_OPCODE):
+			raise RuntimeError('Incorrect OPCode in Response')
+
+		if (self.opcode == ERROR_OPCODE):
+			#a short error response still reports an error, missing bytes read as 0
+			aData = bytearray(self.data) + bytearray(3)
+			raise OpcodeError(aData[1], aData[2], TLP, aData[0])
+		return self
+
+
+#=============================================================================================================
+# Parse a received frame, the crc is verified over the header and data in one pass
+#=============================================================================================================
+def decode_frame(buf):
+	if not isinstance(buf, bytearray):
+		buf = bytearray(buf)
+	if len(buf) < HEADER_LENGTH + CRC_LENGTH:
+		raise RuntimeError('CRC Error')
+	end = HEADER_LENGTH + buf[5] + CRC_LENGTH
+	if len(buf) < end or _crc(buf, end) != 0:
+		raise RuntimeError('CRC Error')
+	return Frame(buf)
+
+
+#*************************************************************************************************************
+# Buffered frame reader
+# Reads the header, then exactly the rest of the frame, with recv_into on one reusable buffer. Bytes
+# received past the end of a frame are kept for the next one. The returned buffer is only valid until
+# the next call to read_frame.
+#*************************************************************************************************************
+class FrameReader(object):
+
+	def __init__(self, sock=None, size=4096):
+		self._sock = sock
+		self._buffer = bytearray(max(size, MAX_FRAME_LENGTH))
+		self._view = memoryview(self._buffer)
+		self._start = 0
+		self._end = 0
+		self.first_byte_at = None
+		self.discarded = 0
+
+	#=============================================================================================================
+	# Attach a (new) socket and drop anything left from the previous one
+	#=============================================================================================================
+	def reset(self, sock=None):
+		self._sock = sock
+		self._start = 0
+		self._end = 0
+
+	def pending(self):
+		return self._end - self._start
+
+	#=============================================================================================================
+	# Receive until at least needed bytes are buffered or the deadline passes
+	#=============================================================================================================
+	def _fill(self, needed, deadline):
+		while self._end - self._start < needed:
+			remaining = deadline - time.time()
+			if remaining <= 0:
+				raise TimeoutError('Timeout waiting for response')
+			self._sock.settimeout(remaining)
+			try:
+				count = self._sock.recv_into(self._view[self._end:])
+			except socket.timeout:
+				raise TimeoutError('Timeout waiting for response')
+			if not count:
+				raise socket.error('Connection closed by peer')
+			if self.first_byte_at is None:
+				self.first_byte_at = time.time()
+			self._end += count
+
+	#=============================================================================================================
+	# Move the start of the next frame to the front of the buffer
+	#=============================================================================================================
+	def _compact(self):
+		pending = self._end - self._start
+		if pending:
+			self._buffer[:pending] = self._view[self._start:self._end]
+		self._start = 0
+		self._end = pending
+
+	#=============================================================================================================
+	# Buffer holding a whole frame at its start, or None
+	#=============================================================================================================
+	def _take_frame(self):
+		available = self._end - self._start
+		if available < HEADER_LENGTH:
+			return None
+		length = HEADER_LENGTH + self._buffer[5] + CRC_LENGTH
+		if available < length:
+			return None
+		self._start = length
+		return self._buffer
+
+	#=============================================================================================================
+	# Read one frame, the whole frame must arrive within timeout seconds
+	# first_byte_at is when the first byte of the frame was received
+	#=============================================================================================================
+	def read_frame(self, timeout):
+		now = time.time()
+		deadline = now + timeout
+		if self._start:
+			self._compact()
+		self.first_byte_at = now if self._end else None
+		self._fill(HEADER_LENGTH, deadline)
+		self._fill(HEADER_LENGTH + self._buffer[5] + CRC_LENGTH, deadline)
+		return self._take_frame()
+
+	#=============================================================================================================
+	# Read the next frame starting with header (host address, host group, device address, device group)
+	# Bytes before it (line noise, late answers to an earlier request, frames for another device) are dropped
+	# and frames that fail the crc are searched again from their second byte, without closing the socket.
+	#=============================================================================================================
+	def read_frame_for(self, header, timeout):
+		now = time.time()
+		deadline = now + timeout
+		self.first_byte_at = now if self._end - self._start else None
+		while True:
+			if self._start:
+				self._compact()
+			self._fill(HEADER_LENGTH, deadline)
+			if self._buffer.startswith(header):
+				length = HEADER_LENGTH + self._buffer[5] + CRC_LENGTH
+				self._fill(length, deadline)
+				if _crc(self._buffer, length) == 0:
+					self._start = length
+					return self._buffer
+				skip = 1
+			else:
+				#next place the header could start, keep a partial header at the end of the buffer
+				skip = self._buffer.find(header, 1, self._end)
+				if skip < 0:
+					skip = max(1, self._end - len(header) + 1)
+			self._start = skip
+			self.discarded += skip
+			self.first_byte_at = None
+
+	#=============================================================================================================
+	# Non blocking read for sockets in non blocking mode, returns None until a whole frame is buffered
+	#=============================================================================================================
+	def poll_frame(self):
+		if self._start:
+			self._compact()
+		frame = self._take_frame()
+		if frame is not None:
+			return frame
+		try:
+			count = self._sock.recv_into(self._view[self._end:])
+		except socket.error as ex:
+			if ex.args and ex.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+				return None
+			raise
+		if not count:
+			raise socket.error('Connection closed by peer')
+		self._end += count
+		return self._take_frame()
@@ -1,17 +1,15 @@
 #!/usr/bin/env python
 # -*- coding: utf_8 -*-
 
-import string
+import binascii
 
 
 #==================================================================================================
 def toHex(data):
-	prntble = string.printable[:-5]
-	hex = ['%02X'%ord(c) for c in data]
-	asc = [c if(c in prntble) else '.' for c in data]
+	sHex = binascii.hexlify(bytes(bytearray(data))).upper()
 	ret = []
-	for idx in xrange(0, len(hex), 16):
-		ret.append("%s"%(' '.join((hex[idx : idx + 16])[:16])))
+	for idx in xrange(0, len(sHex), 32):
+		ret.append(' '.join(sHex[i : i + 2] for i in xrange(idx, min(idx + 32, len(sHex)), 2)))
 	return ''.join(ret)
 
 def intHex(i):
@@ -20,16 +18,83 @@ def intHex(i):
 		sValue = "0%s"%sValue
 	return sValue
 
+
 #==================================================================================================
-def crc16(data):
-	crc = 0x0000
-	for c in data:
-		crc ^= ord(c);
+# CRC-16 lookup table (reflected polynomial 0xA001, one entry per byte value)
+#==================================================================================================
+def _crc16_table():
+	aTable = []
+	for i in range(256):
+		crc = i
 		for x in range(8):
 			if(crc & 1):
 				crc = (crc >> 1) ^ 0xa001
 			else:
 				crc = crc >> 1
+		aTable.append(crc)
+	return tuple(aTable)
+
+CRC16_TABLE = _crc16_table()
+
+
+#==================================================================================================
+# Feed data into a running crc value and return the new value
+# data may be a str, bytearray, memoryview or a list of byte values
+#==================================================================================================
+def crc16_update(crc, data):
+	if not isinstance(data, bytearray):
+		data = bytearray(data)
+	table = CRC16_TABLE
+	for c in data:
+		crc = (crc >> 8) ^ table[(crc ^ c) & 0xff]
+	return crc
+
+
+#==================================================================================================
+def crc16(data):
+	crc = crc16_update(0x0000, data)
+	return [crc & 0xff, crc >> 8]
+
+
+#==================================================================================================
+# True when data ends with a valid crc (lo, hi) of the bytes before it
+#==================================================================================================
+def crc16_check(data):
+	return len(data) >= 2 and crc16_update(0x0000, data) == 0
+
+
+#==================================================================================================
+# Crc for many frames in one call, returns a [lo, hi] pair per frame
+#==================================================================================================
+def crc16_batch(frames):
+	table = CRC16_TABLE
+	aCrc = []
+	for data in frames:
+		if not isinstance(data, bytearray):
+			data = bytearray(data)
+		crc = 0x0000
+		for c in data:
+			crc = (crc >> 8) ^ table[(crc ^ c) & 0xff]
+		aCrc.append([crc & 0xff, crc >> 8])
+	return aCrc
+
+
+#==================================================================================================
+# Streaming crc for frames that arrive or are built in pieces
+#==================================================================================================
+class CRC16(object):
+
+	def __init__(self, data=None):
+		self.value = 0x0000
+		if data is not None:
+			self.update(data)
+
+	def update(self, data):
+		self.value = crc16_update(self.value, data)
+		return self
+
+	def reset(self):
+		self.value = 0x0000
 
-	return [crc & 0xff, crc / 256]
-	
+	def digest(self):
+		return [self.value & 0xff, self.value >> 8]
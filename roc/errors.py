@@ -0,0 +1,55 @@
+#!/usr/bin/env python
+# -*- coding: utf_8 -*-
+
+
+"""
+ TestKit: Implementation of Fisher ROC protocol in python
+ This is distributed under GNU LGPL license, see license.txt
+"""
+
+
+#*************************************************************************************************************
+#
+#*************************************************************************************************************
+class TimeoutError(Exception):
+	def __init__(self, sError):
+		self.error = sError
+	def __str__(self):
+		return repr(self.error)
+
+
+#*************************************************************************************************************
+#
+#*************************************************************************************************************
+class OpcodeError(Exception):
+	def __init__(self, iOpcode, iErrorCode, aAdd, iCode=None):
+		self.opcode = iOpcode
+		self.errorcode = iErrorCode
+		self.address = aAdd
+		self.code = iCode
+		self.data = []
+
+	def __str__(self):
+		if self.opcode == 180:
+			try:
+				for aTlp in self.address:
+					for i in aTlp:
+						self.data.append(i)
+				aTlp = []
+				for i in self.data[self.errorcode-7:self.errorcode-4]:
+					aTlp.append(str(i))
+				self.errorcode = " ".join(aTlp)
+			except Exception, ex:
+				pass
+		return "Opcode Error: Opcode:%s Device Parameter:%s"%(repr(self.opcode), repr(self.errorcode))
+
+
+#*************************************************************************************************************
+# Request refused without sending it, the circuit breaker of the device is open
+#*************************************************************************************************************
+class DeviceUnavailable(Exception):
+	def __init__(self, sDevice, fRetryIn):
+		self.device = sDevice
+		self.retry_in = fRetryIn
+	def __str__(self):
+		return "Device %s unavailable, next probe in %.1fs"%(self.device, self.retry_in)
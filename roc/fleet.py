@@ -0,0 +1,348 @@
+#!/usr/bin/env python
+# -*- coding: utf_8 -*-
+
+
+"""
+ TestKit: Implementation of Fisher ROC protocol in python
+ This is distributed under GNU LGPL license, see license.txt
+
+ Multi-process fleet poller. Devices are sharded over worker processes by
+ link (every device behind one terminal server port goes to the same
+ worker, which owns that link and its TcpMaster). The shard of a link is
+ chosen by rendezvous hashing over the worker slots, so it does not change
+ across restarts and only the links of a removed slot move when the pool
+ shrinks.
+
+ Every worker runs a Scheduler over its devices and sends the results back
+ in batches over its own pipe, with a heartbeat carrying its scan counters.
+ The parent restarts a worker that dies or stops sending heartbeats; a
+ slot that fails max_restarts times within restart_window is dropped and
+ its links are spread over the other slots.
+
+	aDevices = [FleetDevice('10.0.0.5', 4000, 240, n, TLP_POINTS, interval=10) for n in range(1, 9)]
+	fleet = Fleet(aDevices, workers=8, on_results=store)
+	fleet.run()
+"""
+
+
+import os
+import re
+import time
+import select
+import signal
+import hashlib
+import threading
+import multiprocessing
+
+import link
+import alarms
+import health
+import roc_tcp
+import scheduler
+from wire import LOGGER
+
+
+#*************************************************************************************************************
+# One device of the fleet and what to poll on it
+# points are (T, L, P, format) read every interval seconds, alarm_interval syncs the alarm log.
+# transport is 'tcp', 'udp' or 'serial' (server is the device path, port the baud rate).
+#*************************************************************************************************************
+class FleetDevice(object):
+
+	def __init__(self, server, port, address, group, points=(), interval=10.0, alarm_interval=None, name=None, transport='tcp'):
+		self.server = server
+		self.port = port
+		self.transport = transport
+		self.address = address
+		self.group = group
+		self.points = list(points)
+		self.interval = interval
+		self.alarm_interval = alarm_interval
+		self.name = name or '%s:%s/%d,%d'%(server, port, address, group)
+
+	@property
+	def link(self):
+		if self.transport == 'tcp':
+			return '%s:%s'%(self.server, self.port)
+		return '%s:%s:%s'%(self.transport, self.server, self.port)
+
+	def __repr__(self):
+		return 'FleetDevice(%r)'%self.name
+
+
+#=============================================================================================================
+# Slot of a link key among slots, by rendezvous (highest random weight) hashing
+#=============================================================================================================
+def shard(key, slots):
+	return max(slots, key=lambda slot: hashlib.md5('%s/%s'%(key, slot)).digest())
+
+
+def assign(devices, slots):
+	dShards = dict((slot, []) for slot in slots)
+	for device in devices:
+		dShards[shard(device.link, slots)].append(device)
+	return dShards
+
+
+#*************************************************************************************************************
+# Worker process side
+#*************************************************************************************************************
+class _Worker(object):
+
+	def __init__(self, slot, devices, conn, options):
+		self.slot = slot
+		self.devices = devices
+		self.conn = conn
+		self.stop = threading.Event()
+		self.options = options
+		self.batch = []
+		self.lock = threading.Lock()
+		self.results = 0
+		self.errors = 0
+
+	def _emit(self, device, kind, value, error=None):
+		with self.lock:
+			self.batch.append((device.name, kind, time.time(), value, error))
+			if error is None:
+				self.results += 1
+			else:
+				self.errors += 1
+
+	def _poll(self, device):
+		return (lambda scan, values: self._emit(device, 'points', values)), (lambda scan, ex: self._emit(device, 'points', None, str(ex)))
+
+	def _alarms(self, device):
+		return (lambda scan, records: self._emit(device, 'alarms', [record.todict() for record in records])), (lambda scan, ex: self._emit(device, 'alarms', None, str(ex)))
+
+	def _flush(self, heartbeat=False):
+		with self.lock:
+			aBatch, self.batch = self.batch, []
+			stats = {'results':self.results, 'errors':self.errors, 'devices':len(self.devices), 'pid':os.getpid()}
+		if aBatch:
+			self.conn.send(('results', self.slot, aBatch))
+		if heartbeat:
+			self.conn.send(('heartbeat', self.slot, stats))
+
+	def run(self):
+		options = self.options
+		manager = link.LinkManager()
+		device_health = health.DeviceHealth(**options.get('health', {}))
+		scans = scheduler.Scheduler()
+		dMasters = {}
+		dSyncs = {}
+		for device in self.devices:
+			master = dMasters.get(device.link)
+			if master is None:
+				master = dMasters[device.link] = roc_tcp.TcpMaster(device.server, device.port, link_manager=manager, bus=True, health=device_health, transport=device.transport, **options.get('master', {}))
+			if device.points:
+				on_result, on_error = self._poll(device)
+				scans.add_poll(master, device.address, device.group, device.points, device.interval, name='poll %s'%device.name, on_result=on_result, on_error=on_error)
+			if device.alarm_interval:
+				sync = dSyncs.get(device.link)
+				if sync is None:
+					sPath = os.path.join(options['checkpoint_dir'], 'alarms-%s.json'%re.sub(r'[^A-Za-z0-9.-]', '-', device.link)) if options.get('checkpoint_dir') else None
+					sync = dSyncs[device.link] = alarms.AlarmSync(master, alarms.CheckpointStore(sPath))
+				on_result, on_error = self._alarms(device)
+				scans.add_alarms(sync, device.address, device.group, device.alarm_interval, name='alarms %s'%device.name, on_result=on_result, on_error=on_error)
+
+		scans.start()
+		parent = os.getppid()
+		next_heartbeat = 0.0
+		try:
+			while not self.stop.is_set() and os.getppid() == parent:
+				now = time.time()
+				heartbeat = now >= next_heartbeat
+				if heartbeat:
+					next_heartbeat = now + options['heartbeat']
+				self._flush(heartbeat)
+				self.stop.wait(options['batch_interval'])
+		finally:
+			scans.stop(1.0)
+			manager.close_all()
+			try:
+				self._flush()
+			except (IOError, EOFError):
+				pass
+
+
+#=============================================================================================================
+# Worker process entry, SIGTERM from the parent stops it (nothing is shared that a killed worker could hold)
+#=============================================================================================================
+def _worker_main(slot, devices, conn, options):
+	worker = _Worker(slot, devices, conn, options)
+	#the parent stops the workers, not the terminal
+	signal.signal(signal.SIGINT, signal.SIG_IGN)
+	signal.signal(signal.SIGTERM, lambda signum, frame: worker.stop.set())
+	worker.run()
+
+
+#*************************************************************************************************************
+# Parent side of one worker slot
+#*************************************************************************************************************
+class _Slot(object):
+
+	def __init__(self, slot):
+		self.slot = slot
+		self.devices = []
+		self.process = None
+		self.conn = None
+		self.last_heartbeat = 0.0
+		self.started = 0.0
+		self.restarts = []
+		self.stats = {}
+
+
+#*************************************************************************************************************
+# Fleet
+# on_results(records) gets every batch, a record is (device name, 'points' or 'alarms', time, value, error).
+#*************************************************************************************************************
+class Fleet(object):
+
+	def __init__(self, devices, workers=None, on_results=None, batch_interval=0.5, heartbeat=2.0, heartbeat_timeout=10.0, max_restarts=3, restart_window=300.0, checkpoint_dir=None, master_options=None, health_options=None):
+		self.devices = list(devices)
+		self.on_results = on_results
+		self.heartbeat_timeout = heartbeat_timeout
+		self.max_restarts = max_restarts
+		self.restart_window = restart_window
+		self.options = {'batch_interval':batch_interval, 'heartbeat':heartbeat, 'checkpoint_dir':checkpoint_dir, 'master':master_options or {}, 'health':health_options or {}}
+		self.slots = dict((i, _Slot(i)) for i in range(workers or multiprocessing.cpu_count()))
+		self.running = False
+		self.dropped = []
+		for slot, aDevices in assign(self.devices, sorted(self.slots)).items():
+			self.slots[slot].devices = aDevices
+
+	def assignments(self):
+		return dict((slot, [device.name for device in state.devices]) for slot, state in self.slots.items())
+
+	#=============================================================================================================
+	# Start and stop worker processes
+	#=============================================================================================================
+	def _spawn(self, state):
+		conn, child_conn = multiprocessing.Pipe(duplex=False)
+		state.process = multiprocessing.Process(target=_worker_main, args=(state.slot, state.devices, child_conn, self.options), name='Fleet worker %d'%state.slot)
+		state.process.daemon = True
+		state.process.start()
+		child_conn.close()
+		state.conn = conn
+		state.started = state.last_heartbeat = time.time()
+
+	def _halt(self, state, timeout=5.0):
+		if state.process is None:
+			return
+		if state.process.is_alive():
+			state.process.terminate()
+		#keep reading so a worker flushing its last batch never blocks on a full pipe
+		end = time.time() + timeout
+		while state.process.is_alive() and time.time() < end:
+			self._drain(state)
+			state.process.join(0.05)
+		if state.process.is_alive():
+			os.kill(state.process.pid, signal.SIGKILL)
+			state.process.join(1.0)
+		self._drain(state)
+		state.conn.close()
+		state.process = None
+		state.conn = None
+
+	def start(self):
+		self.running = True
+		for state in self.slots.values():
+			if state.devices:
+				self._spawn(state)
+		return self
+
+	def stop(self, timeout=5.0):
+		self.running = False
+		for state in self.slots.values():
+			if state.process is not None and state.process.is_alive():
+				state.process.terminate()
+		for state in self.slots.values():
+			self._halt(state, timeout)
+
+	#=============================================================================================================
+	# Messages of the workers
+	#=============================================================================================================
+	def _handle(self, state, message):
+		kind, slot, body = message
+		if kind == 'results':
+			if self.on_results is not None:
+				self.on_results(body)
+		elif kind == 'heartbeat':
+			state.last_heartbeat = time.time()
+			state.stats = body
+
+	def _drain(self, state):
+		try:
+			while state.conn.poll():
+				self._handle(state, state.conn.recv())
+		except (IOError, EOFError):
+			pass
+
+	#=============================================================================================================
+	# Read the worker pipes for up to timeout seconds, then check the workers
+	#=============================================================================================================
+	def poll(self, timeout=1.0):
+		dConns = dict((state.conn.fileno(), state) for state in self.slots.values() if state.conn is not None)
+		if dConns:
+			readable = select.select(list(dConns), [], [], timeout)[0]
+			for fd in readable:
+				state = dConns[fd]
+				try:
+					self._handle(state, state.conn.recv())
+				except (IOError, EOFError):
+					#the worker is gone, check_workers restarts it
+					pass
+		else:
+			time.sleep(timeout)
+		self.check_workers()
+
+	#=============================================================================================================
+	# Restart dead or silent workers, drop a slot that keeps failing and rebalance its links
+	#=============================================================================================================
+	def check_workers(self):
+		if not self.running:
+			return
+		now = time.time()
+		for state in list(self.slots.values()):
+			if state.process is None:
+				continue
+			if state.process.is_alive() and now - state.last_heartbeat < self.heartbeat_timeout:
+				continue
+			LOGGER.warning('Fleet worker %d (%d devices) %s, restarting', state.slot, len(state.devices), 'died' if not state.process.is_alive() else 'stopped sending heartbeats')
+			self._halt(state, 0.5)
+			state.restarts = [t for t in state.restarts if now - t < self.restart_window] + [now]
+			if len(state.restarts) > self.max_restarts and len(self.slots) > 1:
+				self._drop(state)
+			else:
+				self._spawn(state)
+
+	def _drop(self, state):
+		LOGGER.error('Fleet worker %d failed %d times in %ds, moving its devices', state.slot, len(state.restarts), self.restart_window)
+		del self.slots[state.slot]
+		self.dropped.append(state.slot)
+		dShards = assign(self.devices, sorted(self.slots))
+		for slot, aDevices in dShards.items():
+			other = self.slots[slot]
+			if [device.name for device in aDevices] != [device.name for device in other.devices]:
+				self._halt(other)
+				other.devices = aDevices
+				if aDevices:
+					self._spawn(other)
+
+	#=============================================================================================================
+	# Run until stopped (KeyboardInterrupt or stop from another thread), or for duration seconds
+	#=============================================================================================================
+	def run(self, duration=None):
+		if not self.running:
+			self.start()
+		end = None if duration is None else time.time() + duration
+		try:
+			while self.running and (end is None or time.time() < end):
+				self.poll(1.0 if end is None else max(0.0, min(1.0, end - time.time())))
+		except KeyboardInterrupt:
+			pass
+		finally:
+			self.stop()
+
+	def snapshot(self):
+		return dict((slot, {'devices':len(state.devices), 'alive':state.process is not None and state.process.is_alive(), 'restarts':len(state.restarts), 'last_heartbeat':state.last_heartbeat, 'stats':state.stats}) for slot, state in self.slots.items())
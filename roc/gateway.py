@@ -0,0 +1,201 @@
+#!/usr/bin/env python
+# -*- coding: utf_8 -*-
+
+
+"""
+ TestKit: Implementation of Fisher ROC protocol in python
+ This is distributed under GNU LGPL license, see license.txt
+
+ ROC gateway. Clients connect to the gateway as if it were the terminal
+ server; their requests are queued and sent one at a time on the single
+ upstream link, and every response goes back to the client that asked.
+ Identical opcode 180 requests from several clients that are waiting at the
+ same time are sent upstream once and the response is copied to each of
+ them, with the host address of each client put back in its header.
+
+	gateway = Gateway(('0.0.0.0', 4000), '10.0.0.5', 4000)
+	gateway.serve_forever()
+"""
+
+
+import socket
+import logging
+import threading
+import SocketServer
+from collections import deque
+
+import codec
+import link
+from wire import LOGGER
+
+
+COALESCE_OPCODES = (180,)
+
+
+#*************************************************************************************************************
+# Upstream transaction and the clients waiting for its response
+#*************************************************************************************************************
+class _Request(object):
+	__slots__ = ('request', 'key', 'waiters', 'response', 'done')
+
+	def __init__(self, request, key):
+		self.request = request
+		self.key = key
+		self.waiters = []
+		self.response = None
+		self.done = threading.Event()
+
+
+#*************************************************************************************************************
+# Client connection, one request at a time like on a serial line
+#*************************************************************************************************************
+class _ClientHandler(SocketServer.BaseRequestHandler):
+
+	def handle(self):
+		gateway = self.server.gateway
+		sock = self.request
+		sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+		reader = codec.FrameReader(sock)
+		gateway.stats['clients'] += 1
+		try:
+			while gateway.running:
+				try:
+					buf = reader.read_frame(gateway.idle_timeout)
+				except codec.TimeoutError:
+					continue
+				except (socket.error, EnvironmentError):
+					return
+				length = codec.HEADER_LENGTH + buf[5] + codec.CRC_LENGTH
+				request = bytes(buf[:length])
+				try:
+					codec.decode_frame(bytearray(request))
+				except RuntimeError:
+					#a real device ignores a bad frame too
+					gateway.stats['bad_requests'] += 1
+					reader.reset(sock)
+					continue
+				response = gateway.transact(request)
+				if response is not None:
+					sock.sendall(response)
+		except socket.error:
+			pass
+		finally:
+			gateway.stats['clients'] -= 1
+
+
+class _Server(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+	daemon_threads = True
+	allow_reuse_address = True
+
+
+#*************************************************************************************************************
+# Gateway
+#*************************************************************************************************************
+class Gateway(object):
+
+	def __init__(self, listen, server, port=4000, timeout_in_sec=5.0, link_manager=None, coalesce=COALESCE_OPCODES, idle_timeout=60.0, transport='tcp'):
+		self.timeout_in_sec = timeout_in_sec
+		self.coalesce = frozenset(coalesce)
+		self.idle_timeout = idle_timeout
+		self.running = False
+		self.stats = {'clients':0, 'requests':0, 'upstream':0, 'coalesced':0, 'timeouts':0, 'errors':0, 'bad_requests':0}
+		self._link = (link_manager or link.default_manager).get(server, port, transport)
+		self._queue = deque()
+		self._pending = {}
+		self._cond = threading.Condition()
+		self._server = _Server(listen, _ClientHandler, bind_and_activate=True)
+		self._server.gateway = self
+		self.address = self._server.server_address
+		self._worker = None
+		self._thread = None
+
+	#=============================================================================================================
+	# Queue a client request and wait for its response, None when the device did not answer
+	#=============================================================================================================
+	def transact(self, request):
+		opcode = ord(request[4])
+		key = None
+		if opcode in self.coalesce:
+			#same device, opcode and data, whoever asks
+			key = request[0:2] + request[4:-codec.CRC_LENGTH]
+		with self._cond:
+			self.stats['requests'] += 1
+			pending = self._pending.get(key) if key is not None else None
+			if pending is None:
+				pending = _Request(request, key)
+				if key is not None:
+					self._pending[key] = pending
+				self._queue.append(pending)
+				self._cond.notify()
+			else:
+				self.stats['coalesced'] += 1
+			pending.waiters.append(request[2:4])
+		if not pending.done.wait(self.timeout_in_sec * (len(self._queue) + 2)):
+			return None
+		response = pending.response
+		if response is None or response[0:2] == request[2:4]:
+			return response
+		#answer for another client, give it this client's host address
+		return bytes(codec.encode_frame(ord(request[2]), ord(request[3]), ord(response[2]), ord(response[3]), ord(response[4]), response[codec.HEADER_LENGTH:-codec.CRC_LENGTH]))
+
+	#=============================================================================================================
+	# Upstream worker, sends the queued requests in order
+	#=============================================================================================================
+	def _run(self):
+		while True:
+			with self._cond:
+				while self.running and not self._queue:
+					self._cond.wait(1.0)
+				if not self.running:
+					return
+				pending = self._queue.popleft()
+			response = None
+			try:
+				with self._link:
+					self._link.send(pending.request)
+					#skip late answers and noise until the frame of the addressed device
+					buf = self._link.recv(self.timeout_in_sec, pending.request[2:4] + pending.request[0:2])
+					response = bytes(buf[:codec.HEADER_LENGTH + buf[5] + codec.CRC_LENGTH])
+				self.stats['upstream'] += 1
+			except codec.TimeoutError:
+				self.stats['timeouts'] += 1
+			except Exception as ex:
+				response = None
+				self.stats['errors'] += 1
+				if LOGGER.isEnabledFor(logging.DEBUG):
+					LOGGER.debug('Gateway upstream %s: %s', self._link.name, ex)
+			with self._cond:
+				if pending.key is not None and self._pending.get(pending.key) is pending:
+					del self._pending[pending.key]
+				pending.response = response
+			pending.done.set()
+
+	#=============================================================================================================
+	# Start and stop
+	#=============================================================================================================
+	def start(self):
+		self.running = True
+		self._worker = threading.Thread(target=self._run, name='Gateway upstream %s'%self._link.name)
+		self._worker.daemon = True
+		self._worker.start()
+		self._thread = threading.Thread(target=self._server.serve_forever, kwargs={'poll_interval':0.1}, name='Gateway %s:%s'%self.address)
+		self._thread.daemon = True
+		self._thread.start()
+		return self
+
+	def serve_forever(self):
+		self.start()
+		try:
+			while self._thread.is_alive():
+				self._thread.join(1.0)
+		finally:
+			self.stop()
+
+	def stop(self):
+		with self._cond:
+			self.running = False
+			self._cond.notify_all()
+		self._server.shutdown()
+		self._server.server_close()
+		if self._worker is not None:
+			self._worker.join(self.timeout_in_sec + 1)
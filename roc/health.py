@@ -0,0 +1,191 @@
+#!/usr/bin/env python
+# -*- coding: utf_8 -*-
+
+
+"""
+ TestKit: Implementation of Fisher ROC protocol in python
+ This is distributed under GNU LGPL license, see license.txt
+
+ Adaptive timeouts and circuit breakers. The response time of every
+ (device, opcode) is smoothed like a TCP retransmit timer: the timeout is
+ the smoothed round trip plus four times its mean deviation, kept between
+ min_timeout and the fixed timeout of the master. After `failures` timeouts
+ or link errors in a row the breaker of a device opens and requests to it
+ fail at once with DeviceUnavailable. Once every probe interval one request
+ goes through as a probe; an answer closes the breaker, another failure
+ doubles the interval up to max_probe_interval.
+
+	health = DeviceHealth(min_timeout=0.2, failures=3, probe_interval=30)
+	master = TcpMaster('10.0.0.5', 4000, health=health)
+"""
+
+
+import time
+import threading
+
+from errors import DeviceUnavailable
+
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+
+#*************************************************************************************************************
+# Smoothed round trip of one (device, opcode), RFC 6298 gains
+#*************************************************************************************************************
+class RttEstimator(object):
+	__slots__ = ('srtt', 'rttvar', 'samples')
+
+	ALPHA = 0.125
+	BETA = 0.25
+
+	def __init__(self):
+		self.srtt = None
+		self.rttvar = None
+		self.samples = 0
+
+	def observe(self, rtt):
+		if self.srtt is None:
+			self.srtt = rtt
+			self.rttvar = rtt / 2.0
+		else:
+			self.rttvar += self.BETA * (abs(self.srtt - rtt) - self.rttvar)
+			self.srtt += self.ALPHA * (rtt - self.srtt)
+		self.samples += 1
+
+	#a timeout doubles the margin until the next answer is timed
+	def backoff(self):
+		if self.rttvar is not None:
+			self.rttvar = max(self.rttvar * 2, self.srtt / 2.0)
+
+	def timeout(self, default, min_timeout, max_timeout):
+		if self.srtt is None:
+			return default
+		return min(max_timeout, max(min_timeout, self.srtt + 4 * self.rttvar))
+
+
+#*************************************************************************************************************
+# Circuit breaker of one device
+#*************************************************************************************************************
+class CircuitBreaker(object):
+	__slots__ = ('state', 'failures', 'opened', 'probe_at', 'interval', 'rejected')
+
+	def __init__(self):
+		self.state = CLOSED
+		self.failures = 0
+		self.opened = 0
+		self.probe_at = 0.0
+		self.interval = 0.0
+		self.rejected = 0
+
+
+#*************************************************************************************************************
+# Timeouts and breakers of every device, can be shared by all the masters of a fleet
+#*************************************************************************************************************
+class DeviceHealth(object):
+
+	def __init__(self, min_timeout=0.2, failures=3, probe_interval=30.0, max_probe_interval=300.0):
+		self.min_timeout = min_timeout
+		self.failures = failures
+		self.probe_interval = probe_interval
+		self.max_probe_interval = max_probe_interval
+		self._rtt = {}
+		self._breakers = {}
+		self._lock = threading.Lock()
+
+	def _breaker(self, device):
+		breaker = self._breakers.get(device)
+		if breaker is None:
+			breaker = self._breakers[device] = CircuitBreaker()
+		return breaker
+
+	#=============================================================================================================
+	# Timeout for the next request, max_timeout until the first answer was timed
+	#=============================================================================================================
+	def timeout(self, device, opcode, max_timeout):
+		estimator = self._rtt.get((device, opcode))
+		if estimator is None:
+			return max_timeout
+		return estimator.timeout(max_timeout, self.min_timeout, max_timeout)
+
+	#=============================================================================================================
+	# Raise DeviceUnavailable unless a request may be sent, the first one after the probe time is the probe
+	#=============================================================================================================
+	def allow(self, device):
+		with self._lock:
+			breaker = self._breakers.get(device)
+			if breaker is None or breaker.state == CLOSED:
+				return
+			now = time.time()
+			if now >= breaker.probe_at:
+				#a probe that ends without a success or failure (an encode error) does not hold the breaker
+				#half open, another one goes through after the probe interval
+				breaker.state = HALF_OPEN
+				breaker.probe_at = now + breaker.interval
+				return
+			breaker.rejected += 1
+			raise DeviceUnavailable(device, max(0.0, breaker.probe_at - now))
+
+	#=============================================================================================================
+	# The device answered, rtt is None when the answer is not a usable sample
+	#=============================================================================================================
+	def success(self, device, opcode, rtt=None):
+		with self._lock:
+			if rtt is not None:
+				estimator = self._rtt.get((device, opcode))
+				if estimator is None:
+					estimator = self._rtt[(device, opcode)] = RttEstimator()
+				estimator.observe(rtt)
+			breaker = self._breakers.get(device)
+			if breaker is not None:
+				breaker.state = CLOSED
+				breaker.failures = 0
+				breaker.interval = 0.0
+
+	#=============================================================================================================
+	# The device did not answer (timeout or link error)
+	#=============================================================================================================
+	def failure(self, device, opcode):
+		with self._lock:
+			estimator = self._rtt.get((device, opcode))
+			if estimator is not None:
+				estimator.backoff()
+			breaker = self._breaker(device)
+			breaker.failures += 1
+			if breaker.state == HALF_OPEN:
+				breaker.interval = min(self.max_probe_interval, breaker.interval * 2)
+			elif breaker.state == CLOSED and breaker.failures >= self.failures:
+				breaker.interval = self.probe_interval
+				breaker.opened += 1
+			else:
+				return
+			breaker.state = OPEN
+			breaker.probe_at = time.time() + breaker.interval
+
+	def state(self, device):
+		breaker = self._breakers.get(device)
+		return breaker.state if breaker is not None else CLOSED
+
+	def reset(self, device=None):
+		with self._lock:
+			if device is None:
+				self._breakers.clear()
+				self._rtt.clear()
+			else:
+				self._breakers.pop(device, None)
+				for key in [key for key in self._rtt if key[0] == device]:
+					del self._rtt[key]
+
+	#=============================================================================================================
+	# Breaker state and timeouts of every device
+	#=============================================================================================================
+	def snapshot(self):
+		with self._lock:
+			dDevices = {}
+			for device, breaker in self._breakers.items():
+				dDevices[device] = {'state':breaker.state, 'failures':breaker.failures, 'opened':breaker.opened, 'rejected':breaker.rejected, 'probe_at':breaker.probe_at, 'opcodes':{}}
+			for (device, opcode), estimator in self._rtt.items():
+				dDevice = dDevices.setdefault(device, {'state':CLOSED, 'failures':0, 'opened':0, 'rejected':0, 'probe_at':0.0, 'opcodes':{}})
+				dDevice['opcodes'][opcode] = {'srtt':estimator.srtt, 'rttvar':estimator.rttvar, 'samples':estimator.samples}
+			return dDevices
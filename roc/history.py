@@ -0,0 +1,345 @@
+#!/usr/bin/env python
+# -*- coding: utf_8 -*-
+
+
+"""
+ TestKit: Implementation of Fisher ROC protocol in python
+ This is distributed under GNU LGPL license, see license.txt
+
+ History decoding. Values and timestamps come back as columns: array('d')
+ and array('q') ('l' on Python 2), or NumPy arrays when NumPy is installed.
+ A sample costs 16 bytes instead of a dict and a date string; todicts()
+ and todict() give the old form where it is still wanted.
+ Timestamps are seconds since 1970 of the device's wall clock, no time zone
+ is applied.
+
+ Opcode 135 (PointLog) and 136 (PeriodBlock) read many periods, of one
+ point or of a run of points, from a history segment by index.
+
+ DeviceClock keeps the offset between the local clock and a device clock,
+ and how fast it drifts, so a history read does not need a clock read
+ before it every time.
+"""
+
+
+import time
+import calendar
+from array import array
+
+import codec
+import points
+
+try:
+	import numpy
+except ImportError:
+	numpy = None
+
+
+CLOCK_MAX_AGE = 3600.0
+
+#TLP 12,0,0-5: seconds, minutes, hours, day, month, year
+CLOCK_POINTS = points.compile_points([[12,0,0],[12,0,1],[12,0,2],[12,0,3],[12,0,4],[12,0,5]], ['B','B','B','B','B','B'])
+
+MINUTE_STRUCT = codec.get_struct('<60f')
+
+#opcode 128 values start at data offset 3, the daily value is the one at offset 103
+DAILY_OFFSET = 3
+DAILY_INDEX = (103 - DAILY_OFFSET) // 4
+
+#type of history of opcodes 135 and 136
+MINUTE = 0
+PERIODIC = 1
+DAILY = 2
+
+#opcode 135 header: segment, point, current index, number of values
+POINT_LOG_STRUCT = codec.get_struct('<BBHB')
+POINT_LOG_OFFSET = POINT_LOG_STRUCT.size
+MAX_POINT_LOG = (codec.MAX_DATA_LENGTH - POINT_LOG_OFFSET) // 4
+
+#opcode 136 header: segment, current index, number of data elements; then a timestamp and the values per period
+PERIODS_STRUCT = codec.get_struct('<BHB')
+PERIODS_OFFSET = PERIODS_STRUCT.size
+MAX_PERIOD_POINTS = (codec.MAX_DATA_LENGTH - PERIODS_OFFSET) // 4 - 1
+
+#array('q') needs Python 3, 'l' is 64 bits on the other platforms that matter
+try:
+	array('q')
+	TIME_TYPECODE = 'q'
+except ValueError:
+	TIME_TYPECODE = 'l'
+
+
+#=============================================================================================================
+# Device epoch of a (seconds, minutes, hours, day, month, year) clock read
+#=============================================================================================================
+def clock_epoch(clock):
+	seconds, minutes, hours, day, month, year = clock
+	return calendar.timegm((year + 2000, month, day, hours, minutes, seconds))
+
+
+#*************************************************************************************************************
+# Offset and drift of a device clock against the local clock
+#*************************************************************************************************************
+class DeviceClock(object):
+	__slots__ = ('offset', 'drift', 'synced_at', 'stale')
+
+	def __init__(self):
+		self.offset = None
+		self.drift = 0.0
+		self.synced_at = 0.0
+		self.stale = True
+
+	#=============================================================================================================
+	# Record a clock read, local_time is when the response arrived
+	#=============================================================================================================
+	def update(self, device_epoch, local_time=None):
+		if local_time is None:
+			local_time = time.time()
+		offset = device_epoch - local_time
+		if self.offset is not None and local_time - self.synced_at >= 60:
+			#the device clock only has one second resolution, smooth the drift estimate
+			drift = (offset - self.now(local_time) + local_time) / (local_time - self.synced_at)
+			self.drift += 0.5 * drift
+		self.offset = offset
+		self.synced_at = local_time
+		self.stale = False
+
+	def is_fresh(self, max_age=CLOCK_MAX_AGE):
+		return not self.stale and self.offset is not None and time.time() - self.synced_at < max_age
+
+	#=============================================================================================================
+	# Estimated device epoch at a local time (now by default)
+	#=============================================================================================================
+	def now(self, local_time=None):
+		if local_time is None:
+			local_time = time.time()
+		return local_time + self.offset + self.drift * (local_time - self.synced_at)
+
+
+#*************************************************************************************************************
+# Values of one history point with their timestamps
+#*************************************************************************************************************
+class HistorySeries(object):
+	__slots__ = ('point', 'times', 'values')
+
+	def __init__(self, point, times, values):
+		self.point = point
+		self.times = times
+		self.values = values
+
+	def __len__(self):
+		return len(self.values)
+
+	def __iter__(self):
+		return iter(zip(self.times, self.values))
+
+	#=============================================================================================================
+	# One series of the samples of several series of the same point, in the order given
+	#=============================================================================================================
+	@classmethod
+	def concat(cls, series):
+		series = list(series)
+		if not series:
+			raise ValueError('No series to concatenate')
+		if numpy is not None and isinstance(series[0].values, numpy.ndarray):
+			return cls(series[0].point, numpy.concatenate([s.times for s in series]), numpy.concatenate([s.values for s in series]))
+		times = array(TIME_TYPECODE)
+		values = array('d')
+		for s in series:
+			times.extend(s.times)
+			values.extend(s.values)
+		return cls(series[0].point, times, values)
+
+	#=============================================================================================================
+	# Same form as opcode126 returns, one {'date_time', 'value'} dict per value
+	#=============================================================================================================
+	def todicts(self):
+		gmtime = time.gmtime
+		return [{'date_time':'%04d-%02d-%02d %02d:%02d:%02d'%gmtime(epoch)[:6], 'value':float(value)} for epoch, value in zip(self.times, self.values)]
+
+
+#minute i of the log is in the current hour before the current minute, in the previous hour from it on
+_MINUTE_OFFSETS = [tuple(60 * i - (3600 if i >= iMin else 0) for i in range(60)) for iMin in range(60)]
+if numpy is not None:
+	_MINUTE_OFFSETS_ARRAY = numpy.array(_MINUTE_OFFSETS, dtype=numpy.int64)
+
+
+#=============================================================================================================
+# Start of the device hour the minute log was read in
+# The response carries the device's current minute; when the clock estimate is on the other side of an
+# hour boundary the hour is moved to match it. A disagreement of more than a minute marks the clock stale.
+#=============================================================================================================
+def _hour_start(clock, minute):
+	device_now = int(clock.now())
+	estimate = (device_now // 60) % 60
+	start = device_now - device_now % 3600
+	delta = minute - estimate
+	if delta > 30:
+		start -= 3600
+		delta -= 60
+	elif delta < -30:
+		start += 3600
+		delta += 60
+	if abs(delta) > 1:
+		clock.stale = True
+	return start
+
+
+#=============================================================================================================
+# Opcode 126 response as a HistorySeries, one bulk unpack (or frombuffer) for the 60 values
+#=============================================================================================================
+def decode_minutes(frame, point, clock):
+	if frame.length < 2 + MINUTE_STRUCT.size:
+		raise RuntimeError('Incorrect Length in Response')
+	if not(frame.byte(0) == point):
+		raise RuntimeError('Incorrect Pointer in Response')
+	iMin = frame.byte(1)
+	if iMin >= 60:
+		raise RuntimeError('Incorrect Minute in Response')
+	start = _hour_start(clock, iMin)
+	if numpy is not None:
+		values = numpy.frombuffer(frame.buffer, dtype='<f4', count=60, offset=codec.HEADER_LENGTH + 2).astype(numpy.float64)
+		times = _MINUTE_OFFSETS_ARRAY[iMin] + start
+	else:
+		values = array('d', frame.unpack_from(MINUTE_STRUCT, 2))
+		times = array(TIME_TYPECODE, [start + offset for offset in _MINUTE_OFFSETS[iMin]])
+	return HistorySeries(point, times, values)
+
+
+#*************************************************************************************************************
+# Opcode 128 daily history record
+# values holds every float of the response, hourly the first 24 of them and daily the one the original
+# decoder read.
+#*************************************************************************************************************
+class DailyRecord(object):
+	__slots__ = ('point', 'month', 'day', 'year', 'values')
+
+	def __init__(self, point, month, day, values, year=None):
+		self.point = point
+		self.month = month
+		self.day = day
+		self.year = year
+		self.values = values
+
+	@property
+	def hourly(self):
+		return self.values[:24]
+
+	@property
+	def daily(self):
+		return self.values[DAILY_INDEX] if len(self.values) > DAILY_INDEX else None
+
+	def __repr__(self):
+		return 'DailyRecord(point=%d, month=%d, day=%d, daily=%r)'%(self.point, self.month, self.day, self.daily)
+
+	def todict(self):
+		return {'point':self.point, 'year':self.year, 'month':self.month, 'day':self.day, 'hourly':list(self.hourly), 'daily':self.daily}
+
+
+#=============================================================================================================
+# Opcode 128 response as a DailyRecord, all values in one unpack
+#=============================================================================================================
+def decode_daily(frame, day, month, year=None):
+	if frame.length < DAILY_OFFSET:
+		raise RuntimeError('Incorrect Length in Response')
+	if not(frame.byte(1) == month) or not(frame.byte(2) == day):
+		raise RuntimeError('Incorrect Date in Response')
+	count = (frame.length - DAILY_OFFSET) // 4
+	values = array('d', frame.unpack_from(codec.get_struct('<%df'%count), DAILY_OFFSET))
+	return DailyRecord(frame.byte(0), month, day, values, year)
+
+
+#=============================================================================================================
+# Periods of points of an opcode 136 response that fit in a frame
+#=============================================================================================================
+def max_periods(points):
+	return (codec.MAX_DATA_LENGTH - PERIODS_OFFSET) // (4 * (points + 1))
+
+
+#*************************************************************************************************************
+# Opcode 135 response, consecutive values of one point from a history segment
+#*************************************************************************************************************
+class PointLog(object):
+	__slots__ = ('segment', 'point', 'index', 'current_index', 'values')
+
+	def __init__(self, segment, point, index, current_index, values):
+		self.segment = segment
+		self.point = point
+		self.index = index
+		self.current_index = current_index
+		self.values = values
+
+	def __len__(self):
+		return len(self.values)
+
+	def __repr__(self):
+		return 'PointLog(segment=%d, point=%d, index=%d, values=%d)'%(self.segment, self.point, self.index, len(self.values))
+
+
+def decode_point_log(frame, segment, point, index):
+	rSegment, rPoint, current, count = frame.unpack_from(POINT_LOG_STRUCT)
+	if not(rSegment == segment) or not(rPoint == point):
+		raise RuntimeError('Incorrect Pointer in Response')
+	if frame.length < POINT_LOG_OFFSET + 4 * count:
+		raise RuntimeError('Incorrect Length in Response')
+	return PointLog(segment, point, index, current, array('d', frame.unpack_from(codec.get_struct('<%df'%count), POINT_LOG_OFFSET)))
+
+
+#*************************************************************************************************************
+# Opcode 136 response, consecutive periods of consecutive points of a history segment
+# times has one timestamp per period, values the point values of every period one after the other.
+#*************************************************************************************************************
+class PeriodBlock(object):
+	__slots__ = ('segment', 'index', 'current_index', 'first_point', 'points', 'times', 'values', 'history_type')
+
+	def __init__(self, segment, index, current_index, first_point, points, times, values, history_type=PERIODIC):
+		self.segment = segment
+		self.history_type = history_type
+		self.index = index
+		self.current_index = current_index
+		self.first_point = first_point
+		self.points = points
+		self.times = times
+		self.values = values
+
+	def __len__(self):
+		return len(self.times)
+
+	# Values of period i, one per point
+	def row(self, i):
+		return tuple(self.values[i * self.points:(i + 1) * self.points])
+
+	@property
+	def rows(self):
+		return [self.row(i) for i in range(len(self.times))]
+
+	def __iter__(self):
+		return ((epoch, self.row(i)) for i, epoch in enumerate(self.times))
+
+	#=============================================================================================================
+	# History of one of the points as a HistorySeries
+	#=============================================================================================================
+	def series(self, point):
+		i = point - self.first_point
+		if not 0 <= i < self.points:
+			raise ValueError('Point %d not in block'%point)
+		return HistorySeries(point, self.times, self.values[i::self.points])
+
+	def __repr__(self):
+		return 'PeriodBlock(segment=%d, index=%d, points=%d-%d, periods=%d)'%(self.segment, self.index, self.first_point, self.first_point + self.points - 1, len(self.times))
+
+
+def decode_periods(frame, segment, index, first_point, points, history_type=PERIODIC):
+	rSegment, current, count = frame.unpack_from(PERIODS_STRUCT)
+	if not(rSegment == segment):
+		raise RuntimeError('Incorrect Pointer in Response')
+	periods = count // (points + 1)
+	if frame.length < PERIODS_OFFSET + 4 * periods * (points + 1):
+		raise RuntimeError('Incorrect Length in Response')
+	width = points + 1
+	items = frame.unpack_from(codec.get_struct('<' + ('I%df'%points) * periods), PERIODS_OFFSET)
+	times = array(TIME_TYPECODE, items[::width])
+	values = array('d')
+	for i in range(0, len(items), width):
+		values.extend(items[i + 1:i + width])
+	return PeriodBlock(segment, index, current, first_point, points, times, values, history_type)
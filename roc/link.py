@@ -0,0 +1,402 @@
+#!/usr/bin/env python
+# -*- coding: utf_8 -*-
+
+
+"""
+ TestKit: Implementation of Fisher ROC protocol in python
+ This is distributed under GNU LGPL license, see license.txt
+
+ Persistent links to terminal servers. A Link owns one socket to a
+ (server, port) and is shared by every master talking to that port; the
+ LinkManager hands out one Link per (server, port). Masters hold the link
+ (with link: ...) for a whole request/response so transactions from several
+ threads never interleave on the wire.
+
+ Link is the TCP transport. UdpLink sends every request as one datagram
+ and needs no connect, a lost datagram is only a timeout. SerialLink talks
+ to a tty (server is the device path, port the baud rate) and stretches
+ the response timeout by the time the frames take on the line. They all
+ frame responses with the same FrameReader, so routing by header and
+ resync work the same over every transport:
+
+	master = TcpMaster('/dev/ttyUSB0', 9600, transport='serial')
+"""
+
+
+import os
+import time
+import errno
+import random
+import socket
+import select
+import threading
+
+try:
+	import tty
+	import termios
+except ImportError:
+	termios = None
+
+import codec
+import wire
+from errors import TimeoutError
+
+
+#=============================================================================================================
+# True when sock has data (or an EOF) waiting, never blocks
+#=============================================================================================================
+def _readable(sock):
+	if hasattr(select, 'poll'):
+		poller = select.poll()
+		poller.register(sock.fileno(), select.POLLIN | select.POLLERR | select.POLLHUP)
+		return bool(poller.poll(0))
+	return bool(select.select([sock], [], [], 0)[0])
+
+
+#*************************************************************************************************************
+# TCP link to one terminal server port
+# A transport implements _connect, returning a socket (or anything with settimeout, recv, recv_into, sendall,
+# fileno and close); the rest of the Link works the same over it.
+#*************************************************************************************************************
+class Link(object):
+
+	def __init__(self, server="127.0.0.1", port=4000, connect_timeout=5.0, backoff_base=0.5, backoff_max=60.0, trace_frames=wire.RING_SIZE):
+		self.server = server
+		self.port = port
+		self.connect_timeout = connect_timeout
+		self.backoff_base = backoff_base
+		self.backoff_max = backoff_max
+		self.failures = 0
+		self.retry_at = 0.0
+		self.connects = 0
+		self.errors = 0
+		self.bytes_sent = 0
+		self.bytes_received = 0
+		self._sock = None
+		self._reader = codec.FrameReader()
+		self._lock = threading.RLock()
+		self.frames = wire.FrameRing(trace_frames)
+		self.name = '%s:%s'%(server, port)
+
+	def __enter__(self):
+		self._lock.acquire()
+		return self
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		self._lock.release()
+		return False
+
+	def is_open(self):
+		return self._sock is not None
+
+	#=============================================================================================================
+	# Bytes dropped while looking for the response to a request
+	#=============================================================================================================
+	@property
+	def discarded(self):
+		return self._reader.discarded
+
+	#=============================================================================================================
+	# When the first byte of the last received frame arrived
+	#=============================================================================================================
+	@property
+	def first_byte_at(self):
+		return self._reader.first_byte_at
+
+	#=============================================================================================================
+	# Connect, unless a previous failure put the link in backoff
+	#=============================================================================================================
+	def open(self):
+		with self._lock:
+			self.close()
+			now = time.time()
+			if now < self.retry_at:
+				raise socket.error(errno.ECONNREFUSED, 'Link %s down, next reconnect in %.1fs'%(self.name, self.retry_at - now))
+			try:
+				sock = self._connect()
+			except Exception:
+				self._failed()
+				raise
+			self._sock = sock
+			self._reader.reset(sock)
+			self.connects += 1
+			self.failures = 0
+			self.retry_at = 0.0
+
+	def _connect(self):
+		sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+		sock.settimeout(self.connect_timeout)
+		sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+		try:
+			sock.connect((self.server, self.port))
+		except Exception:
+			sock.close()
+			raise
+		sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+		return sock
+
+	#=============================================================================================================
+	# Close Connection
+	#=============================================================================================================
+	def close(self):
+		with self._lock:
+			if self._sock:
+				self._sock.close()
+				self._sock = None
+			self._reader.reset()
+
+	#=============================================================================================================
+	# Schedule the next reconnect with exponential backoff and full jitter
+	#=============================================================================================================
+	def _failed(self):
+		self.errors += 1
+		self.failures += 1
+		delay = min(self.backoff_max, self.backoff_base * (2 ** (self.failures - 1)))
+		self.retry_at = time.time() + random.uniform(0, delay)
+
+	#=============================================================================================================
+	# Check the idle connection without blocking, stale bytes (late responses) are dropped
+	# Returns False when the peer closed the connection.
+	#=============================================================================================================
+	def is_alive(self):
+		if self._sock is None:
+			return False
+		try:
+			while _readable(self._sock):
+				self._sock.settimeout(0)
+				if not self._sock.recv(4096):
+					return False
+		except socket.error:
+			return False
+		self._reader.reset(self._sock)
+		return True
+
+	#=============================================================================================================
+	# Send a request, (re)connecting first when needed
+	#=============================================================================================================
+	def send(self, request):
+		with self._lock:
+			if not self.is_alive():
+				self.open()
+			try:
+				self._sock.settimeout(self.connect_timeout)
+				self._sock.sendall(request)
+				self.bytes_sent += len(request)
+				self.frames.record('TX', request)
+			except socket.error:
+				self.close()
+				self._failed()
+				raise
+			self._sent(len(request))
+
+	#=============================================================================================================
+	# Transport hooks: a request of length bytes was sent, response timeout for the request timeout
+	#=============================================================================================================
+	def _sent(self, length):
+		pass
+
+	def _timeout(self, timeout):
+		return timeout
+
+	#=============================================================================================================
+	# Receive one frame, valid until the next receive on this link
+	# With a header only a frame starting with it is returned, anything before it is dropped (see discarded)
+	#=============================================================================================================
+	def recv(self, timeout, header=None):
+		with self._lock:
+			if self._sock is None:
+				raise socket.error(errno.ENOTCONN, 'Link %s is not connected'%self.name)
+			timeout = self._timeout(timeout)
+			try:
+				if header is None:
+					response = self._reader.read_frame(timeout)
+				else:
+					response = self._reader.read_frame_for(header, timeout)
+				length = codec.HEADER_LENGTH + response[5] + codec.CRC_LENGTH
+				self.bytes_received += length
+				self.frames.record('RX', response, length)
+				return response
+			except TimeoutError:
+				#keep the connection, a late answer is dropped before the next request
+				self._reader.reset(self._sock)
+				raise
+			except socket.error:
+				self.close()
+				self._failed()
+				raise
+
+
+#*************************************************************************************************************
+# UDP link, one datagram per frame
+# connect only sets the peer; an unreachable port shows up as a socket error on the next receive and puts the
+# link in backoff like a refused TCP connect.
+#*************************************************************************************************************
+class UdpLink(Link):
+
+	def __init__(self, server="127.0.0.1", port=4000, **kwargs):
+		Link.__init__(self, server, port, **kwargs)
+		self.name = 'udp:%s:%s'%(server, port)
+
+	def _connect(self):
+		sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+		try:
+			sock.connect((self.server, self.port))
+		except Exception:
+			sock.close()
+			raise
+		return sock
+
+	#=============================================================================================================
+	# Drop late datagrams, an empty one is not an EOF
+	#=============================================================================================================
+	def is_alive(self):
+		if self._sock is None:
+			return False
+		try:
+			while _readable(self._sock):
+				self._sock.settimeout(0)
+				self._sock.recv(codec.MAX_FRAME_LENGTH)
+		except socket.error:
+			return False
+		self._reader.reset(self._sock)
+		return True
+
+
+#*************************************************************************************************************
+# Socket-like end of a tty (or pty) in raw 8N1, for SerialLink and the simulator
+#*************************************************************************************************************
+class SerialPort(object):
+
+	def __init__(self, fd):
+		self._fd = fd
+		self._timeout = None
+
+	#=============================================================================================================
+	# Open and configure a serial device
+	#=============================================================================================================
+	@classmethod
+	def open(cls, path, baudrate=9600):
+		if termios is None:
+			raise socket.error(errno.EOPNOTSUPP, 'Serial links need termios')
+		speed = getattr(termios, 'B%d'%baudrate, None)
+		if speed is None:
+			raise ValueError('Unsupported baud rate %s'%baudrate)
+		try:
+			fd = os.open(path, os.O_RDWR | os.O_NOCTTY | os.O_NONBLOCK)
+		except OSError as ex:
+			raise socket.error(ex.errno, '%s: %s'%(path, ex.strerror))
+		try:
+			tty.setraw(fd)
+			attrs = termios.tcgetattr(fd)
+			attrs[2] |= termios.CLOCAL | termios.CREAD
+			attrs[2] &= ~(termios.PARENB | termios.CSTOPB)
+			attrs[4] = attrs[5] = speed
+			termios.tcsetattr(fd, termios.TCSANOW, attrs)
+			termios.tcflush(fd, termios.TCIOFLUSH)
+		except Exception:
+			os.close(fd)
+			raise
+		return cls(fd)
+
+	def fileno(self):
+		return self._fd
+
+	def settimeout(self, timeout):
+		self._timeout = timeout
+
+	def _wait(self, write=False):
+		aFds = [self._fd]
+		if write:
+			ready = select.select([], aFds, [], self._timeout)[1]
+		else:
+			ready = select.select(aFds, [], [], self._timeout)[0]
+		if not ready:
+			raise socket.timeout('timed out')
+
+	def recv(self, size):
+		self._wait()
+		try:
+			return os.read(self._fd, size)
+		except OSError as ex:
+			raise socket.error(ex.errno, ex.strerror)
+
+	def recv_into(self, view):
+		data = self.recv(len(view))
+		view[:len(data)] = data
+		return len(data)
+
+	def sendall(self, data):
+		data = bytes(bytearray(data))
+		while data:
+			self._wait(True)
+			try:
+				data = data[os.write(self._fd, data):]
+			except OSError as ex:
+				if ex.errno != errno.EAGAIN:
+					raise socket.error(ex.errno, ex.strerror)
+
+	def close(self):
+		if self._fd is not None:
+			os.close(self._fd)
+			self._fd = None
+
+
+#*************************************************************************************************************
+# Serial link to a tty, server is the device path and port the baud rate
+# Answers on a half-duplex line start after the request has left the port, so the response timeout counts
+# from then; frames from other masters, line noise and the echo of an RS-485 adapter are skipped by header.
+#*************************************************************************************************************
+class SerialLink(Link):
+
+	#start, 8 data bits and a stop bit
+	BITS_PER_BYTE = 10
+
+	def __init__(self, server="/dev/ttyS0", port=9600, **kwargs):
+		Link.__init__(self, server, port, **kwargs)
+		self.path = server
+		self.baudrate = port
+		self.name = 'serial:%s'%server
+		self._line_time = 0.0
+
+	def _connect(self):
+		return SerialPort.open(self.path, self.baudrate)
+
+	def _sent(self, length):
+		self._line_time = (length + codec.MAX_FRAME_LENGTH) * self.BITS_PER_BYTE / float(self.baudrate)
+
+	def _timeout(self, timeout):
+		return timeout + self._line_time
+
+
+TRANSPORTS = {'tcp':Link, 'udp':UdpLink, 'serial':SerialLink}
+
+
+#*************************************************************************************************************
+# Pool of links keyed by (server, port, transport)
+#*************************************************************************************************************
+class LinkManager(object):
+
+	def __init__(self, **kwargs):
+		self._options = kwargs
+		self._links = {}
+		self._lock = threading.Lock()
+
+	def get(self, server, port, transport='tcp'):
+		with self._lock:
+			link = self._links.get((server, port, transport))
+			if link is None:
+				if transport not in TRANSPORTS:
+					raise ValueError('Unknown transport %r, one of %s'%(transport, ', '.join(sorted(TRANSPORTS))))
+				link = self._links[(server, port, transport)] = TRANSPORTS[transport](server, port, **self._options)
+			return link
+
+	def links(self):
+		with self._lock:
+			return self._links.values()
+
+	def close_all(self):
+		for link in self.links():
+			link.close()
+
+
+default_manager = LinkManager()
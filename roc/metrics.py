@@ -0,0 +1,207 @@
+#!/usr/bin/env python
+# -*- coding: utf_8 -*-
+
+
+"""
+ TestKit: Implementation of Fisher ROC protocol in python
+ This is distributed under GNU LGPL license, see license.txt
+
+ Transaction metrics. A Registry keeps a latency histogram per stage
+ (encode, send, wait for the first byte, receive, decode), opcode and
+ device, counters of transactions and failures by kind, and the traffic
+ and reconnect counters of the links it was given. snapshot() returns all
+ of it as plain dicts and export() in the Prometheus text format.
+"""
+
+
+import bisect
+import socket
+import threading
+
+from errors import TimeoutError, OpcodeError
+
+
+STAGES = ('encode', 'send', 'wait', 'receive', 'decode')
+
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+ERRORS = ('timeout', 'crc', 'opcode', 'response', 'link')
+
+
+#*************************************************************************************************************
+# Cumulative histogram with fixed bucket bounds (seconds)
+#*************************************************************************************************************
+class Histogram(object):
+	__slots__ = ('bounds', 'counts', 'count', 'sum')
+
+	def __init__(self, bounds=BUCKETS):
+		self.bounds = bounds
+		self.counts = [0] * (len(bounds) + 1)
+		self.count = 0
+		self.sum = 0.0
+
+	def observe(self, value):
+		self.counts[bisect.bisect_left(self.bounds, value)] += 1
+		self.count += 1
+		self.sum += value
+
+	#=============================================================================================================
+	# Upper bound of the bucket holding quantile q (0-1), None when empty
+	#=============================================================================================================
+	def quantile(self, q):
+		if not self.count:
+			return None
+		rank = q * self.count
+		total = 0
+		for bound, count in zip(self.bounds + (float('inf'),), self.counts):
+			total += count
+			if total >= rank:
+				return bound
+		return float('inf')
+
+	def snapshot(self):
+		return {'count':self.count, 'sum':self.sum, 'buckets':list(self.counts), 'p50':self.quantile(0.5), 'p99':self.quantile(0.99)}
+
+
+#*************************************************************************************************************
+# Metrics of one (opcode, device)
+#*************************************************************************************************************
+class _Series(object):
+	__slots__ = ('stages', 'transactions', 'errors', 'bytes_sent', 'bytes_received')
+
+	def __init__(self):
+		self.stages = tuple(Histogram() for stage in STAGES)
+		self.transactions = 0
+		self.errors = dict.fromkeys(ERRORS, 0)
+		self.bytes_sent = 0
+		self.bytes_received = 0
+
+
+#*************************************************************************************************************
+# Registry
+#*************************************************************************************************************
+class Registry(object):
+
+	def __init__(self, enabled=True):
+		self.enabled = enabled
+		self._series = {}
+		self._links = []
+		self._lock = threading.Lock()
+
+	def _get(self, opcode, device):
+		series = self._series.get((opcode, device))
+		if series is None:
+			series = self._series.setdefault((opcode, device), _Series())
+		return series
+
+	def track_link(self, link):
+		with self._lock:
+			if link not in self._links:
+				self._links.append(link)
+
+	#=============================================================================================================
+	# Record a completed transaction, times are the time.time() at the end of every stage, starting with
+	# the start of the encode
+	#=============================================================================================================
+	def record(self, opcode, device, times, sent, received):
+		with self._lock:
+			series = self._get(opcode, device)
+			series.transactions += 1
+			series.bytes_sent += sent
+			series.bytes_received += received
+			for i, histogram in enumerate(series.stages):
+				histogram.observe(times[i + 1] - times[i])
+
+	#=============================================================================================================
+	# Record a failed transaction, kind is one of ERRORS
+	#=============================================================================================================
+	def record_error(self, opcode, device, kind, sent=0):
+		with self._lock:
+			series = self._get(opcode, device)
+			series.transactions += 1
+			series.bytes_sent += sent
+			series.errors[kind] += 1
+
+	def reset(self):
+		with self._lock:
+			self._series.clear()
+
+	#=============================================================================================================
+	# All metrics as dicts
+	#=============================================================================================================
+	def snapshot(self):
+		with self._lock:
+			aSeries = []
+			for (opcode, device), series in sorted(self._series.items()):
+				aSeries.append({
+					'opcode':opcode,
+					'device':device,
+					'transactions':series.transactions,
+					'errors':dict(series.errors),
+					'bytes_sent':series.bytes_sent,
+					'bytes_received':series.bytes_received,
+					'stages':dict((stage, histogram.snapshot()) for stage, histogram in zip(STAGES, series.stages)),
+				})
+			aLinks = [{'link':link.name, 'connects':link.connects, 'errors':link.errors, 'bytes_sent':link.bytes_sent, 'bytes_received':link.bytes_received, 'open':link.is_open()} for link in self._links]
+		return {'series':aSeries, 'links':aLinks}
+
+	#=============================================================================================================
+	# Prometheus text exposition format
+	#=============================================================================================================
+	def export(self, prefix='roc'):
+		aLines = []
+		dSnapshot = self.snapshot()
+
+		aLines.append('# TYPE %s_transactions_total counter'%prefix)
+		for series in dSnapshot['series']:
+			aLines.append('%s_transactions_total{%s} %d'%(prefix, _labels(series), series['transactions']))
+
+		aLines.append('# TYPE %s_errors_total counter'%prefix)
+		for series in dSnapshot['series']:
+			for kind in ERRORS:
+				aLines.append('%s_errors_total{%s,kind="%s"} %d'%(prefix, _labels(series), kind, series['errors'][kind]))
+
+		for name in ('bytes_sent', 'bytes_received'):
+			aLines.append('# TYPE %s_%s_total counter'%(prefix, name))
+			for series in dSnapshot['series']:
+				aLines.append('%s_%s_total{%s} %d'%(prefix, name, _labels(series), series[name]))
+
+		aLines.append('# TYPE %s_stage_seconds histogram'%prefix)
+		for series in dSnapshot['series']:
+			for stage in STAGES:
+				histogram = series['stages'][stage]
+				sLabels = '%s,stage="%s"'%(_labels(series), stage)
+				total = 0
+				for bound, count in zip(BUCKETS + ('+Inf',), histogram['buckets']):
+					total += count
+					aLines.append('%s_stage_seconds_bucket{%s,le="%s"} %d'%(prefix, sLabels, bound, total))
+				aLines.append('%s_stage_seconds_sum{%s} %r'%(prefix, sLabels, histogram['sum']))
+				aLines.append('%s_stage_seconds_count{%s} %d'%(prefix, sLabels, histogram['count']))
+
+		for name in ('connects', 'errors', 'bytes_sent', 'bytes_received'):
+			aLines.append('# TYPE %s_link_%s_total counter'%(prefix, name))
+			for link in dSnapshot['links']:
+				aLines.append('%s_link_%s_total{link="%s"} %d'%(prefix, name, link['link'], link[name]))
+		return '\n'.join(aLines) + '\n'
+
+
+#=============================================================================================================
+# ERRORS kind of an exception raised by a transaction
+#=============================================================================================================
+def error_kind(ex):
+	if isinstance(ex, TimeoutError):
+		return 'timeout'
+	if isinstance(ex, OpcodeError):
+		return 'opcode'
+	if isinstance(ex, (socket.error, EnvironmentError)):
+		return 'link'
+	if str(ex) == 'CRC Error':
+		return 'crc'
+	return 'response'
+
+
+def _labels(series):
+	return 'opcode="%s",device="%s"'%(series['opcode'], series['device'])
+
+
+default_registry = Registry()
@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+# -*- coding: utf_8 -*-
+
+
+"""
+ TestKit: Implementation of Fisher ROC protocol in python
+ This is distributed under GNU LGPL license, see license.txt
+
+ Opcode 180 read planner. A list of (T, L, P, format) points of any length
+ is packed into the fewest opcode 180 requests that keep both the request
+ (1 byte count + 3 bytes per TLP) and the response (1 byte count + TLP echo
+ and value per point) within the 255 data bytes of a ROC frame. Identical
+ points are read once.
+
+ With min_run, at least min_run consecutive parameters of one point type
+ and logical are read as an opcode 167 block instead, 4 header bytes for
+ the whole run rather than 3 bytes per parameter each way.
+"""
+
+
+import codec
+from points import format_size
+
+
+TLP_LENGTH = 3
+MAX_POINTS = (codec.MAX_DATA_LENGTH - 1) // TLP_LENGTH
+BLOCK_HEADER_LENGTH = 4
+
+
+#*************************************************************************************************************
+# One opcode 180 request of a plan, or an opcode 167 block when start is set
+# points are indexes into the planned list, in the order the points were given
+#*************************************************************************************************************
+class ReadBatch(object):
+	__slots__ = ('points', 'TLP', 'data_format', 'response_length', 'start')
+
+	def __init__(self, start=None):
+		self.points = []
+		self.TLP = []
+		self.data_format = []
+		self.response_length = 1
+		self.start = start
+
+	def request_length(self):
+		return 1 + TLP_LENGTH * len(self.points)
+
+
+#=============================================================================================================
+# Pack points into ReadBatch objects, first fit on decreasing response size
+# Raises ValueError for a point whose value can not fit in a response on its own.
+#=============================================================================================================
+def plan_reads(points, max_points=MAX_POINTS, max_response=codec.MAX_DATA_LENGTH, min_run=0):
+	dUnique = {}
+	aUnique = []
+	for t, l, p, fmt in points:
+		key = (t, l, p, fmt)
+		if key not in dUnique:
+			dUnique[key] = len(aUnique)
+			aUnique.append((TLP_LENGTH + format_size(fmt), key))
+
+	aBlocks = _plan_blocks(aUnique, min_run, max_response) if min_run else []
+	aInBlocks = set(i for block in aBlocks for i in block.points)
+	aOrder = sorted((i for i in range(len(aUnique)) if i not in aInBlocks), key=lambda i: -aUnique[i][0])
+	aBatches = []
+	for i in aOrder:
+		size, key = aUnique[i]
+		if 1 + size > max_response:
+			raise ValueError('TLP %d,%d,%d (%s) does not fit in a response'%key)
+		for batch in aBatches:
+			if len(batch.points) < max_points and batch.response_length + size <= max_response:
+				break
+		else:
+			batch = ReadBatch()
+			aBatches.append(batch)
+		batch.points.append(i)
+		batch.response_length += size
+
+	#keep the caller's order inside every request
+	for batch in aBatches:
+		batch.points.sort()
+		for i in batch.points:
+			t, l, p, fmt = aUnique[i][1]
+			batch.TLP.append([t, l, p])
+			batch.data_format.append(fmt)
+	return ReadPlan(points, dUnique, aBlocks + aBatches)
+
+
+#=============================================================================================================
+# Opcode 167 batches for the runs of at least min_run consecutive parameters, split where a response is full
+# A parameter asked for with two formats stays in the opcode 180 batches.
+#=============================================================================================================
+def _plan_blocks(aUnique, min_run, max_response):
+	dParameters = {}
+	aTwice = set()
+	for i, (size, (t, l, p, fmt)) in enumerate(aUnique):
+		if (t, l, p) in dParameters:
+			aTwice.add((t, l, p))
+		dParameters[(t, l, p)] = i
+	for tlp in aTwice:
+		del dParameters[tlp]
+
+	aBlocks = []
+	aRun = []
+	for tlp in sorted(dParameters) + [None]:
+		if aRun and (tlp is None or tlp[:2] != aRun[-1][:2] or tlp[2] != aRun[-1][2] + 1):
+			aBlocks.extend(_split_run(aRun, dParameters, aUnique, min_run, max_response))
+			aRun = []
+		if tlp is not None:
+			aRun.append(tlp)
+	return aBlocks
+
+
+def _split_run(aRun, dParameters, aUnique, min_run, max_response):
+	aBlocks = []
+	block = None
+	for tlp in aRun:
+		i = dParameters[tlp]
+		size = aUnique[i][0] - TLP_LENGTH
+		if block is None or block.response_length + size > max_response:
+			block = ReadBatch(tlp[2])
+			block.response_length = BLOCK_HEADER_LENGTH
+			aBlocks.append(block)
+		block.points.append(i)
+		block.TLP.append(list(tlp))
+		block.data_format.append(aUnique[i][1][3])
+		block.response_length += size
+	return [block for block in aBlocks if len(block.points) >= min_run]
+
+
+#*************************************************************************************************************
+# Batches for a list of points and the way back from batch results to the caller's order
+#*************************************************************************************************************
+class ReadPlan(object):
+
+	def __init__(self, points, unique, batches):
+		self.batches = batches
+		self._slots = [unique[tuple(point)] for point in points]
+
+	def __len__(self):
+		return len(self.batches)
+
+	#=============================================================================================================
+	# One value per planned point from the decoded results of every batch (opcode180 return values)
+	# String points come back as a tuple of characters, the same as opcode180 returns them.
+	#=============================================================================================================
+	def merge(self, results):
+		aValues = {}
+		for batch, values in zip(self.batches, results):
+			values = iter(values)
+			for i, fmt in zip(batch.points, batch.data_format):
+				if fmt.endswith('c'):
+					aValues[i] = tuple(next(values) for x in range(format_size(fmt)))
+				else:
+					aValues[i] = next(values)
+		return [aValues[i] for i in self._slots]
@@ -0,0 +1,216 @@
+#!/usr/bin/env python
+# -*- coding: utf_8 -*-
+
+
+"""
+ TestKit: Implementation of Fisher ROC protocol in python
+ This is distributed under GNU LGPL license, see license.txt
+
+ Compiled point sets for opcode 180 and 181. A PointSet holds everything
+ that only depends on the TLP list and its data_format: the request body,
+ the struct that decodes every value of a response in one unpack, the one
+ that pulls the TLP echo out of it and the one that packs a write. Point
+ sets are kept in an LRU cache keyed by (TLP, data_format), so polling the
+ same points again costs one dictionary lookup. spans gives the items of
+ each point in the decoded values (a string point has one per character).
+
+ A ParameterBlock is the same for opcode 167, a run of consecutive
+ parameters of one point type and logical read without a TLP per value.
+"""
+
+
+import threading
+from collections import OrderedDict
+
+import codec
+
+
+NUMERIC_FORMATS = ('f', 'q', 'L', 'l', 'i', 'h', 'H', 'b', 'B')
+
+CACHE_SIZE = 256
+
+#opcode 167 request and response header: point type, logical, number of parameters, first parameter
+BLOCK_HEADER = codec.get_struct('<4B')
+
+
+#=============================================================================================================
+# Size in bytes of a value of a data_format entry, 'Nc' is a string of N characters
+#=============================================================================================================
+def format_size(fmt):
+	if fmt.endswith('c'):
+		return int(fmt[:-1] or 1)
+	return codec.get_struct('<' + fmt).size
+
+
+#*************************************************************************************************************
+# Compiled TLP list and data_format
+#*************************************************************************************************************
+class PointSet(object):
+	__slots__ = ('TLP', 'data_format', 'request', 'response_length', 'values', 'echo', 'expected_echo', 'writer', 'spans', '_write_args')
+
+	def __init__(self, TLP, data_format):
+		if len(TLP) != len(data_format):
+			raise ValueError('TLP and data_format lengths differ')
+		self.TLP = tuple(tuple(tlp) for tlp in TLP)
+		self.data_format = tuple(data_format)
+
+		self.request = bytearray([len(self.TLP)])
+		sValues = '<x'
+		sEcho = '<x'
+		sWrite = '<B'
+		aEcho = []
+		self.spans = []
+		start = 0
+		for (t, l, p), fmt in zip(self.TLP, self.data_format):
+			if fmt not in NUMERIC_FORMATS and not fmt.endswith('c'):
+				raise ValueError('Unknown data format %r'%fmt)
+			size = format_size(fmt)
+			self.request.extend((t, l, p))
+			aEcho.extend((t, l, p))
+			if fmt.endswith('c'):
+				#strings decode as one character per item and are written as one string
+				sValues += '3x%dc'%size
+				sWrite += '3B%ds'%size
+				self.spans.append((start, start + size))
+				start += size
+			else:
+				sValues += '3x' + fmt
+				sWrite += '3B' + fmt
+				self.spans.append((start, start + 1))
+				start += 1
+			sEcho += '3B%dx'%size
+		self.request = bytes(self.request)
+		self.values = codec.get_struct(sValues)
+		self.echo = codec.get_struct(sEcho)
+		self.expected_echo = tuple(aEcho)
+		self.response_length = self.values.size
+		self.writer = codec.get_struct(sWrite)
+
+		#pack arguments for a write, value slots are filled in by encode_write
+		self._write_args = [len(self.TLP)]
+		for tlp in self.TLP:
+			self._write_args.extend(tlp)
+			self._write_args.append(None)
+
+	def __len__(self):
+		return len(self.TLP)
+
+	#=============================================================================================================
+	# Values of an opcode 180 response frame, after checking the TLP echo
+	#=============================================================================================================
+	def decode(self, frame):
+		if frame.length < self.response_length or frame.byte(0) != len(self.TLP):
+			raise RuntimeError('TLP Recieved is not TLP Requested')
+		if frame.unpack_from(self.echo) != self.expected_echo:
+			raise RuntimeError('TLP Recieved is not TLP Requested')
+		return frame.unpack_from(self.values)
+
+	#=============================================================================================================
+	# Opcode 181 request body for one value per point
+	#=============================================================================================================
+	def encode_write(self, values):
+		if len(values) != len(self.TLP):
+			raise ValueError('Expected %d values, got %d'%(len(self.TLP), len(values)))
+		aArgs = list(self._write_args)
+		aArgs[4::4] = values
+		return self.writer.pack(*aArgs)
+
+
+#*************************************************************************************************************
+# Compiled opcode 167 read of parameters start to start + len(data_format) - 1 of point type t, logical l
+# TLP, data_format and spans are the same as a PointSet of the same parameters has.
+#*************************************************************************************************************
+class ParameterBlock(object):
+	__slots__ = ('TLP', 'data_format', 'request', 'response_length', 'values', 'header', 'spans')
+
+	def __init__(self, t, l, start, data_format):
+		count = len(data_format)
+		if not 0 < count <= 256 - start:
+			raise ValueError('Parameters %d to %d out of range'%(start, start + count - 1))
+		self.TLP = tuple((t, l, start + i) for i in range(count))
+		self.data_format = tuple(data_format)
+		self.header = (t, l, count, start)
+		self.request = bytes(bytearray(self.header))
+		sValues = '<4x'
+		self.spans = []
+		items = 0
+		for fmt in self.data_format:
+			if fmt not in NUMERIC_FORMATS and not fmt.endswith('c'):
+				raise ValueError('Unknown data format %r'%fmt)
+			if fmt.endswith('c'):
+				size = format_size(fmt)
+				sValues += '%dc'%size
+				self.spans.append((items, items + size))
+				items += size
+			else:
+				sValues += fmt
+				self.spans.append((items, items + 1))
+				items += 1
+		self.values = codec.get_struct(sValues)
+		self.response_length = self.values.size
+		if self.response_length > codec.MAX_DATA_LENGTH:
+			raise ValueError('Parameters %d to %d do not fit in a response'%(start, start + count - 1))
+
+	def __len__(self):
+		return len(self.TLP)
+
+	#=============================================================================================================
+	# Values of an opcode 167 response frame, after checking its header
+	#=============================================================================================================
+	def decode(self, frame):
+		if frame.length < self.response_length or frame.unpack_from(BLOCK_HEADER) != self.header:
+			raise RuntimeError('TLP Recieved is not TLP Requested')
+		return frame.unpack_from(self.values)
+
+
+#=============================================================================================================
+# (t, l, first parameter) when TLP is a run of consecutive parameters of one point type and logical, or None
+#=============================================================================================================
+def run_of(TLP):
+	if not TLP:
+		return None
+	t, l, start = TLP[0]
+	for i, tlp in enumerate(TLP):
+		if tlp[0] != t or tlp[1] != l or tlp[2] != start + i:
+			return None
+	return (t, l, start)
+
+
+_cache = OrderedDict()
+_lock = threading.Lock()
+
+
+#=============================================================================================================
+# PointSet for a TLP list and data_format, from the cache when it was compiled before
+#=============================================================================================================
+def compile_points(TLP, data_format):
+	if isinstance(TLP, PointSet):
+		return TLP
+	return _compiled(PointSet, tuple(tuple(tlp) for tlp in TLP), tuple(data_format))
+
+
+#=============================================================================================================
+# ParameterBlock for a run of parameters, from the same cache
+#=============================================================================================================
+def compile_block(t, l, start, data_format):
+	return _compiled(ParameterBlock, t, l, start, tuple(data_format))
+
+
+def _compiled(cls, *args):
+	key = (cls,) + args
+	with _lock:
+		compiled = _cache.pop(key, None)
+		if compiled is not None:
+			_cache[key] = compiled
+			return compiled
+	compiled = cls(*args)
+	with _lock:
+		_cache[key] = compiled
+		while len(_cache) > CACHE_SIZE:
+			_cache.popitem(last=False)
+	return compiled
+
+
+def clear_cache():
+	with _lock:
+		_cache.clear()
@@ -0,0 +1,583 @@
+#!/usr/bin/env python
+# -*- coding: utf_8 -*-
+
+
+"""
+ TestKit: Implementation of Fisher ROC protocol in python
+ This is distributed under GNU LGPL license, see license.txt
+
+ Non blocking ROC master. One EventLoop drives the sockets of any number of
+ AsyncTcpMaster objects with select.poll (select.select where poll is not
+ available). Opcode methods return a Future instead of blocking; they can be
+ waited for from a generator coroutine run with EventLoop.spawn:
+
+	def poll(master):
+		values = yield master.opcode180(240, 240, TLP, data_format)
+		raise Return(values)
+
+	loop = EventLoop(max_per_server=4)
+	master = AsyncTcpMaster("10.0.0.5", 4000, loop=loop)
+	print loop.run_until_complete(poll(master))
+"""
+
+
+import time
+import errno
+import heapq
+import socket
+import select
+import itertools
+from collections import deque
+
+import codec
+import wire
+from errors import TimeoutError
+from roc_tcp import RocMaster
+
+
+_POLLIN = getattr(select, 'POLLIN', 1)
+_POLLOUT = getattr(select, 'POLLOUT', 4)
+_POLLERR = getattr(select, 'POLLERR', 8) | getattr(select, 'POLLHUP', 16) | getattr(select, 'POLLNVAL', 32)
+
+_CONNECT_PENDING = (errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EALREADY)
+
+
+#*************************************************************************************************************
+# Value of a generator coroutine (generators can not return a value)
+#*************************************************************************************************************
+class Return(Exception):
+	def __init__(self, value=None):
+		Exception.__init__(self, value)
+		self.value = value
+
+
+#*************************************************************************************************************
+# Result of an operation that completes later on the event loop
+#*************************************************************************************************************
+class Future(object):
+
+	def __init__(self, loop):
+		self._loop = loop
+		self._done = False
+		self._result = None
+		self._exception = None
+		self._callbacks = []
+
+	def done(self):
+		return self._done
+
+	def result(self):
+		if not self._done:
+			raise RuntimeError('Result is not ready')
+		if self._exception is not None:
+			raise self._exception
+		return self._result
+
+	def exception(self):
+		if not self._done:
+			raise RuntimeError('Result is not ready')
+		return self._exception
+
+	def add_done_callback(self, fn):
+		if self._done:
+			self._loop.call_soon(fn, self)
+		else:
+			self._callbacks.append(fn)
+
+	def set_result(self, value):
+		self._result = value
+		self._set_done()
+
+	def set_exception(self, exception):
+		self._exception = exception
+		self._set_done()
+
+	def _set_done(self):
+		if self._done:
+			raise RuntimeError('Future already done')
+		self._done = True
+		aCallbacks, self._callbacks = self._callbacks, []
+		for fn in aCallbacks:
+			self._loop.call_soon(fn, self)
+
+
+#=============================================================================================================
+# Complete future with value, or with the outcome of value when it is a future itself
+#=============================================================================================================
+def _settle(future, value):
+	if isinstance(value, Future):
+		value.add_done_callback(lambda v: future.set_exception(v._exception) if v._exception is not None else future.set_result(v._result))
+	else:
+		future.set_result(value)
+
+
+#*************************************************************************************************************
+# Generator coroutine driven by the event loop
+# The generator yields Futures (or lists of Futures) and is resumed with their results.
+#*************************************************************************************************************
+class Task(Future):
+
+	def __init__(self, loop, gen):
+		Future.__init__(self, loop)
+		self._gen = gen
+		loop.call_soon(self._step, None, None)
+
+	def _step(self, value, exception):
+		try:
+			if exception is not None:
+				yielded = self._gen.throw(exception)
+			else:
+				yielded = self._gen.send(value)
+		except StopIteration:
+			self.set_result(None)
+			return
+		except Return as ret:
+			self.set_result(ret.value)
+			return
+		except Exception as ex:
+			self.set_exception(ex)
+			return
+
+		if isinstance(yielded, (list, tuple)):
+			yielded = self._loop.gather(yielded)
+		if not isinstance(yielded, Future):
+			self._loop.call_soon(self._step, None, TypeError('Coroutine yielded %r, not a Future'%(yielded,)))
+			return
+		yielded.add_done_callback(self._wakeup)
+
+	def _wakeup(self, future):
+		if future._exception is not None:
+			self._step(None, future._exception)
+		else:
+			self._step(future._result, None)
+
+
+#*************************************************************************************************************
+# Event Loop
+#*************************************************************************************************************
+class EventLoop(object):
+
+	def __init__(self, max_per_server=0):
+		self.max_per_server = max_per_server
+		self._limits = {}
+		self._active = {}
+		self._waiting = {}
+		self._ready = deque()
+		self._timers = []
+		self._sequence = itertools.count()
+		self._handlers = {}
+		self._events = {}
+		self._pending = 0
+		if hasattr(select, 'poll'):
+			self._poller = select.poll()
+		else:
+			self._poller = None
+
+	#=============================================================================================================
+	# Callbacks and timers
+	#=============================================================================================================
+	def call_soon(self, fn, *args):
+		self._ready.append((fn, args))
+
+	def call_later(self, delay, fn, *args):
+		timer = [time.time() + delay, next(self._sequence), fn, args]
+		heapq.heappush(self._timers, timer)
+		return timer
+
+	def cancel_timer(self, timer):
+		timer[2] = None
+
+	def sleep(self, delay, value=None):
+		future = Future(self)
+		self.call_later(delay, future.set_result, value)
+		return future
+
+	def spawn(self, gen):
+		return Task(self, gen)
+
+	#=============================================================================================================
+	# Future for a list of futures, its result is the list of their results
+	#=============================================================================================================
+	def gather(self, futures):
+		future = Future(self)
+		futures = list(futures)
+		remaining = [len(futures)]
+		if not futures:
+			future.set_result([])
+			return future
+
+		def done(f):
+			if future.done():
+				return
+			if f._exception is not None:
+				future.set_exception(f._exception)
+				return
+			remaining[0] -= 1
+			if not remaining[0]:
+				future.set_result([x._result for x in futures])
+
+		for f in futures:
+			f.add_done_callback(done)
+		return future
+
+	#=============================================================================================================
+	# Limit the number of transactions in progress on one terminal server
+	#=============================================================================================================
+	def set_server_limit(self, server, limit):
+		self._limits[server] = limit
+
+	def _acquire(self, master):
+		server = master._server
+		limit = self._limits.get(server, self.max_per_server)
+		if limit and self._active.get(server, 0) >= limit:
+			self._waiting.setdefault(server, deque()).append(master)
+			return
+		self._active[server] = self._active.get(server, 0) + 1
+		self.call_soon(master._begin)
+
+	def _release(self, master):
+		server = master._server
+		waiting = self._waiting.get(server)
+		if waiting:
+			self.call_soon(waiting.popleft()._begin)
+			return
+		self._active[server] -= 1
+
+	#=============================================================================================================
+	# Socket registration
+	#=============================================================================================================
+	def _register(self, sock, handler, events):
+		fd = sock.fileno()
+		if fd in self._handlers:
+			if self._poller is not None:
+				self._poller.modify(fd, events)
+		elif self._poller is not None:
+			self._poller.register(fd, events)
+		self._handlers[fd] = handler
+		self._events[fd] = events
+
+	def _unregister(self, sock):
+		fd = sock.fileno()
+		if fd in self._handlers:
+			del self._handlers[fd]
+			del self._events[fd]
+			if self._poller is not None:
+				self._poller.unregister(fd)
+
+	def _poll(self, timeout):
+		if self._poller is not None:
+			return self._poller.poll(None if timeout is None else timeout * 1000.0)
+		if not self._events:
+			if timeout:
+				time.sleep(timeout)
+			return []
+		aRead = [fd for fd, events in self._events.iteritems() if events & _POLLIN]
+		aWrite = [fd for fd, events in self._events.iteritems() if events & _POLLOUT]
+		aRead, aWrite, aError = select.select(aRead, aWrite, aRead + aWrite, timeout)
+		dEvents = {}
+		for fd in aRead:
+			dEvents[fd] = dEvents.get(fd, 0) | _POLLIN
+		for fd in aWrite:
+			dEvents[fd] = dEvents.get(fd, 0) | _POLLOUT
+		for fd in aError:
+			dEvents[fd] = dEvents.get(fd, 0) | _POLLERR
+		return dEvents.items()
+
+	#=============================================================================================================
+	# Run one iteration: ready callbacks, expired timers, then socket events
+	#=============================================================================================================
+	def run_once(self, timeout=None):
+		while self._timers and self._timers[0][2] is None:
+			heapq.heappop(self._timers)
+		if self._ready:
+			timeout = 0
+		elif self._timers:
+			delay = max(0, self._timers[0][0] - time.time())
+			timeout = delay if timeout is None else min(timeout, delay)
+
+		for fd, events in self._poll(timeout):
+			handler = self._handlers.get(fd)
+			if handler is not None:
+				handler(events)
+
+		now = time.time()
+		while self._timers and self._timers[0][0] <= now:
+			timer = heapq.heappop(self._timers)
+			if timer[2] is not None:
+				self._ready.append((timer[2], timer[3]))
+
+		for i in range(len(self._ready)):
+			fn, args = self._ready.popleft()
+			fn(*args)
+
+	def _busy(self):
+		if self._ready or self._pending:
+			return True
+		for timer in self._timers:
+			if timer[2] is not None:
+				return True
+		return False
+
+	#=============================================================================================================
+	# Run until there is nothing left to do
+	#=============================================================================================================
+	def run(self):
+		while self._busy():
+			self.run_once()
+
+	#=============================================================================================================
+	# Run until a future (or a generator coroutine) is done and return its result
+	#=============================================================================================================
+	def run_until_complete(self, future):
+		if not isinstance(future, Future):
+			future = self.spawn(future)
+		while not future.done():
+			self.run_once()
+		return future.result()
+
+
+_default_loop = None
+
+def get_event_loop():
+	global _default_loop
+	if _default_loop is None:
+		_default_loop = EventLoop()
+	return _default_loop
+
+
+#*************************************************************************************************************
+# One request waiting for its response
+#*************************************************************************************************************
+class Transaction(Future):
+
+	def __init__(self, loop, request, address, group, opcode, TLP, decode, args):
+		Future.__init__(self, loop)
+		self.request = request
+		self.address = address
+		self.group = group
+		self.opcode = opcode
+		self.TLP = TLP
+		self.decode = decode
+		self.args = args
+
+
+#*************************************************************************************************************
+# Asynchronous TCP Master Object
+# Transactions are queued and sent one at a time on the master connection. The timeout covers connect, send
+# and receive of one transaction.
+#*************************************************************************************************************
+class AsyncTcpMaster(RocMaster):
+
+	def __init__(self, server="127.0.0.1", port=4000, host_group=3, host_address=1, timeout_in_sec=5.0, loop=None, cache=None, access=False, credentials=None):
+		RocMaster.__init__(self, host_group, host_address, cache, access, credentials)
+		self.timeout_in_sec = timeout_in_sec
+		self._server = server
+		self._port = port
+		self._loop = loop or get_event_loop()
+		self._sock = None
+		self._reader = codec.FrameReader()
+		self._queue = deque()
+		self._current = None
+		self._scheduled = False
+		self._connecting = False
+		self._timer = None
+		self._tx = None
+		self._tx_offset = 0
+		self._name = '%s:%s'%(server, port)
+		self.frames = wire.FrameRing()
+
+	#=============================================================================================================
+	# Queue a request, the returned future gets decode(frame, *args)
+	#=============================================================================================================
+	def _execute(self, address, group, opcode, body='', TLP=[], decode=None, args=()):
+		request = codec.encode_frame(address, group, self._host_address, self._host_group, opcode, body)
+		transaction = Transaction(self._loop, request, address, group, opcode, TLP, decode, args)
+		self._queue.append(transaction)
+		self._loop._pending += 1
+		if not self._scheduled:
+			self._scheduled = True
+			self._loop._acquire(self)
+		return transaction
+
+	#=============================================================================================================
+	# Future for fn(result, *args), fn may itself return a future
+	#=============================================================================================================
+	def _chain(self, result, fn, *args):
+		future = Future(self._loop)
+
+		def done(f):
+			if f._exception is not None:
+				future.set_exception(f._exception)
+				return
+			try:
+				value = fn(f._result, *args)
+			except Exception as ex:
+				future.set_exception(ex)
+				return
+			_settle(future, value)
+
+		result.add_done_callback(done)
+		return future
+
+	#=============================================================================================================
+	# Future for fn(*args), or for on_error(exception) when it fails, on_error may return a future
+	#=============================================================================================================
+	def _recover(self, on_error, fn, *args):
+		future = Future(self._loop)
+
+		def failed(exception):
+			try:
+				value = on_error(exception)
+			except Exception as ex:
+				future.set_exception(ex)
+				return
+			_settle(future, value)
+
+		def done(f):
+			if f._exception is not None:
+				failed(f._exception)
+			else:
+				future.set_result(f._result)
+
+		try:
+			result = fn(*args)
+		except Exception as ex:
+			self._loop.call_soon(failed, ex)
+			return future
+		result.add_done_callback(done)
+		return future
+
+	def _gather(self, results):
+		return self._loop.gather(results)
+
+	#=============================================================================================================
+	# Start the next queued transaction, called by the loop once a server slot is free
+	#=============================================================================================================
+	def _begin(self):
+		if not self._queue:
+			self._scheduled = False
+			self._loop._release(self)
+			return
+		self._current = self._queue.popleft()
+		self._timer = self._loop.call_later(self.timeout_in_sec, self._on_timeout, self._current)
+		self._tx = memoryview(self._current.request)
+		self._tx_offset = 0
+		if self._sock is None:
+			self._connect()
+		else:
+			self._write()
+
+	def _connect(self):
+		self._sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+		self._sock.setblocking(0)
+		self._reader.reset(self._sock)
+		err = self._sock.connect_ex((self._server, self._port))
+		if err and err not in _CONNECT_PENDING:
+			self._fail(socket.error(err, errno.errorcode.get(err, str(err))))
+			return
+		self._connecting = True
+		self._loop._register(self._sock, self._on_event, _POLLOUT)
+
+	def _write(self):
+		try:
+			self._tx_offset += self._sock.send(self._tx[self._tx_offset:])
+		except socket.error as ex:
+			if not ex.args or ex.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+				self._fail(ex)
+				return
+		if self._tx_offset < len(self._tx):
+			self._loop._register(self._sock, self._on_event, _POLLOUT)
+		else:
+			wire.trace_frame('TX', self._name, self._tx)
+			self.frames.record('TX', self._tx)
+			self._loop._register(self._sock, self._on_event, _POLLIN)
+
+	#=============================================================================================================
+	# Socket events
+	#=============================================================================================================
+	def _on_event(self, events):
+		if self._connecting:
+			err = self._sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+			if err:
+				self._fail(socket.error(err, errno.errorcode.get(err, str(err))))
+				return
+			self._connecting = False
+			self._write()
+			return
+
+		if self._current is not None and self._tx_offset < len(self._tx):
+			if events & _POLLERR and not events & _POLLIN:
+				self._fail(socket.error('Connection lost'))
+			else:
+				self._write()
+			return
+
+		try:
+			response = self._reader.poll_frame()
+		except socket.error as ex:
+			if self._current is None:
+				self._do_close()
+			else:
+				self._fail(ex)
+			return
+		if response is None:
+			return
+		length = codec.HEADER_LENGTH + response[5] + codec.CRC_LENGTH
+		if wire.LOGGER.isEnabledFor(wire.TRACE):
+			wire.trace_frame('RX', self._name, memoryview(response)[:length])
+		self.frames.record('RX', response, length)
+		if self._current is None:
+			#unsolicited or late frame, nobody is waiting for it
+			self._reader.reset(self._sock)
+			return
+		self._complete(response)
+
+	def _complete(self, response):
+		transaction = self._end_transaction()
+		try:
+			result = self._finish(response, transaction.address, transaction.group, transaction.opcode, transaction.TLP, transaction.decode, transaction.args)
+		except Exception as ex:
+			self._reader.reset(self._sock)
+			wire.dump_frames(self._name, self.frames, ex)
+			transaction.set_exception(ex)
+		else:
+			transaction.set_result(result)
+
+	def _on_timeout(self, transaction):
+		if transaction is self._current:
+			self._fail(TimeoutError('Timeout waiting for response'))
+
+	#=============================================================================================================
+	# Fail the current transaction and drop the connection
+	#=============================================================================================================
+	def _fail(self, exception):
+		transaction = self._end_transaction()
+		self._do_close()
+		wire.dump_frames(self._name, self.frames, exception)
+		transaction.set_exception(exception)
+
+	def _end_transaction(self):
+		transaction, self._current = self._current, None
+		self._loop._pending -= 1
+		if self._timer is not None:
+			self._loop.cancel_timer(self._timer)
+			self._timer = None
+		#give the slot back, queue again behind the masters already waiting for one
+		self._loop._release(self)
+		if self._queue:
+			self._loop._acquire(self)
+		else:
+			self._scheduled = False
+		return transaction
+
+	#=============================================================================================================
+	# Close Connection
+	#=============================================================================================================
+	def _do_close(self):
+		if self._sock:
+			self._loop._unregister(self._sock)
+			self._sock.close()
+			self._sock = None
+		self._connecting = False
+		self._reader.reset()
+		return True
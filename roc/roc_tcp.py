@@ -8,647 +8,514 @@
 """
 
 
-import socket
-import select
+import sys
+import time
+import logging
 import struct
-import datetime
+from itertools import chain
 
-import crc
+import codec
+import link
+import points
+import planner
+import history
+import alarms
+import wire
+import metrics
+import cache
+import bus as roc_bus
+import health as roc_health
+from wire import LOGGER
+#TimeoutError is re-exported, callers catch roc_tcp.TimeoutError
+from errors import TimeoutError, OpcodeError
 
 
 #*************************************************************************************************************
-# 
+# ROC Master Object
+# Builds the requests and decodes the responses of every opcode. How a request reaches the device is left
+# to the subclass through _execute (send a request, return decode(frame, *args)), _chain (run fn on a
+# result once it is available), _recover (run a function on the error of a result) and _gather (one result
+# for a list of results).
+# With access True every device is logged in (opcode 17) before its first request. Whatever access is, a
+# request the device refuses with one of access_errors logs in again and is sent once more.
 #*************************************************************************************************************
-class TimeoutError(Exception):
-	def __init__(self, sError):
-		self.error = sError
-	def __str__(self):
-		return repr(self.error)
+class RocMaster(object):
 
+	def __init__(self, host_group=3, host_address=1, cache=None, access=False, credentials=None):
+		self._host_group = host_group
+		self._host_address = host_address
+		self.access = access
+		self.credentials = credentials or LOGIN
+		self.access_errors = ACCESS_ERRORS
+		self.cache = cache
+		#opcode 167 for TLP lists that are a run of parameters (the device must support it)
+		self.block_reads = False
+		self._clocks = {}
+		self._sessions = {}
 
-#*************************************************************************************************************
-# 
-#*************************************************************************************************************
-class OpcodeError(Exception):
-	def __init__(self, iOpcode, iErrorCode, aAdd):
-		self.opcode = iOpcode
-		self.errorcode = iErrorCode
-		self.address = aAdd
-		self.data = []
-		
-	def __str__(self):
-		if self.opcode == 180:
-			try:
-				for aTlp in self.address:
-					for i in aTlp:
-						self.data.append(i)
-				aTlp = []
-				for i in self.data[self.errorcode-7:self.errorcode-4]:
-					aTlp.append(str(i))
-				self.errorcode = " ".join(aTlp)
-			except Exception, ex:
-				pass
-		return "Opcode Error: Opcode:%s Device Parameter:%s"%(repr(self.opcode), repr(self.errorcode))
+
+	#=============================================================================================================
+	# Send a request frame and return the decoded response
+	#=============================================================================================================
+	def _execute(self, address, group, opcode, body='', TLP=[], decode=None, args=()):
+		raise NotImplementedError()
 
 
-#*************************************************************************************************************
-# TCP Master Object
-#*************************************************************************************************************
-class TcpMaster(object):
-	
-	def __init__(self, server="127.0.0.1", port=4000, host_group=3, host_address=1, timeout_in_sec=5.0):
-		self.timeout_in_sec = timeout_in_sec
-		self._server = server
-		self._port = port
-		self._sock = None
-		self._host_group = host_group
-		self._host_address = host_address
-		self.access = False
-	
 	#=============================================================================================================
-	# Connect to slave device
+	# Call fn(result, *args) once result is available
 	#=============================================================================================================
-	def _do_open(self):
-		if self._sock:
-			self._sock.close()
-		self._sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-		self.set_timeout(self.timeout_in_sec)
-		self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-		self._sock.connect((self._server, self._port))
+	def _chain(self, result, fn, *args):
+		raise NotImplementedError()
+
 
-	
 	#=============================================================================================================
-	# Close Connection
+	# List of the values of a list of results, once all of them are available
 	#=============================================================================================================
-	def _do_close(self):
-		"""Close the connection with the Slave"""
-		if self._sock:
-			self._sock.close()
-			self._sock = None
-		return True
-	
-	
+	def _gather(self, results):
+		raise NotImplementedError()
+
+
 	#=============================================================================================================
-	# Send Request to the slave
+	# Result of fn(*args), or of on_error(exception) when it fails
 	#=============================================================================================================
-	def _send(self, request):
-		try:
-			flush_socket(self._sock, 3)
-		except Exception as msg:
-			#if we can't flush the socket successfully: a disconnection may happened
-			#try to reconnect
-			self._do_open()
-		print  "TX:"+" ".join("{:02x}".format(ord(c)) for c in request)
-		self._sock.send(request)
-	
-	
+	def _recover(self, on_error, fn, *args):
+		raise NotImplementedError()
+
+
 	#=============================================================================================================
-	# Recieve data from slave
+	# Result for a value that is already known
 	#=============================================================================================================
-	def _recv(self, expected_length=-1):
-		response = []
-		length = 255
-		while len(response) < length:
-			rcv_byte = self._sock.recv(1)
-			if rcv_byte:
-				response.append(struct.unpack('B',rcv_byte)[0])
-				#response += rcv_byte
-				if len(response) == 6:
-					to_be_recv_length = struct.unpack('B',rcv_byte)[0]
-					length = to_be_recv_length + 6 + 2
-				
-			else:
-				break
-		
-		print "RX:"+" ".join(["{:02x}".format(i) for i in response])
-		return response
-	
-	
-	
+	def _resolved(self, value):
+		return self._chain(self._gather([]), lambda results: value)
+
+
 	#=============================================================================================================
-	# Set Timeout
+	# Send a request inside the login session of the device
+	#=============================================================================================================
+	def _request(self, address, group, opcode, body='', TLP=[], decode=None, args=()):
+		if self.access and (address, group) not in self._sessions:
+			return self._chain(self.login(address, group), lambda session: self._authorized(address, group, opcode, body, TLP, decode, args))
+		return self._authorized(address, group, opcode, body, TLP, decode, args)
+
+	def _authorized(self, address, group, opcode, body, TLP, decode, args):
+		return self._recover(lambda ex: self._relogin(ex, address, group, opcode, body, TLP, decode, args), self._execute, address, group, opcode, body, TLP, decode, args)
+
+	#the session is gone (device restarted, logged out after inactivity): log in and try once more
+	def _relogin(self, ex, address, group, opcode, body, TLP, decode, args):
+		if not isinstance(ex, OpcodeError) or ex.code not in self.access_errors:
+			#keep the traceback of the request when ex is the exception being handled (always for TcpMaster)
+			exc_type, exc_value, exc_traceback = sys.exc_info()
+			if exc_value is ex:
+				raise exc_type, exc_value, exc_traceback
+			raise ex
+		self._sessions.pop((address, group), None)
+		if LOGGER.isEnabledFor(logging.DEBUG):
+			LOGGER.debug('Opcode %d %d,%d refused (error %d), logging in again', opcode, address, group, ex.code)
+		return self._chain(self.login(address, group), lambda session: self._execute(address, group, opcode, body, TLP, decode, args))
+
+
+	#=============================================================================================================
+	# Check a response buffer against its request and decode it
+	#=============================================================================================================
+	def _finish(self, response, address, group, opcode, TLP=[], decode=None, args=()):
+		frame = codec.decode_frame(response)
+		frame.check(self._host_address, self._host_group, address, group, opcode, TLP)
+		if decode is None:
+			return frame
+		return decode(frame, *args)
+
+
 	#=============================================================================================================
-	def set_timeout(self, timeout_in_sec):
-		if self._sock:
-			self._sock.setblocking(timeout_in_sec > 0)
-			if timeout_in_sec:
-				self._sock.settimeout(timeout_in_sec)
-	
-    
-    
-    #=============================================================================================================
 	# OPCODE 8 SET REAL TIME CLOCK
 	#=============================================================================================================
 	def opcode8(self, address, group, seconds, minutes, hours, day, month, year,expected_length=-1):
-		data = [address, group, self._host_address, self._host_group, 8, 6, seconds, minutes, hours, day, month, year]
-		request = ""
-		for i in data:
-			request += struct.pack('B',i)
-		for i in crc.crc16(request):
-			request += struct.pack('B',i)
-		self._send(request)
-		data = self._recv()
-		responsecrc = data[-2:]
-		data = data[:-2]
-		response = ""
-		for i in data:
-			response += struct.pack('B',i)
-		
-		if not(crc.crc16(response) == responsecrc):
-			raise RuntimeError('CRC Error')
-		
-		if not(data[0] == self._host_address) or not(data[1] == self._host_group):
-			raise RuntimeError('Incorrect Host Address in Response')
-		
-		if not(data[2] == address) or not(data[3] == group):
-			raise RuntimeError('Incorrect Device Address in Response')
-		
-		if not(data[4] == 8) and (data[4] != 255):
-			raise RuntimeError('Incorrect OPCode in Response')
-		
-		if (data[4] == 255):
-			raise OpcodeError(data[7], data[8],[])
-
-		if (data[5] == 0):
+		return self._request(address, group, 8, [seconds, minutes, hours, day, month, year], decode=self._decode8)
+
+	def _decode8(self, frame):
+		if (frame.length == 0):
 			return True
-		
+
 		else:
 			return False
 
 	#=============================================================================================================
 	# OPCODE 17 LOGIN
+	# credentials is (operator id, password), the master's credentials when None
+	#=============================================================================================================
+	def opcode17(self, address, group, expected_length=-1, credentials=None):
+		return self._execute(address, group, 17, login_body(*(credentials or self.credentials)), decode=self._decode17, args=(address, group))
+
+	def _decode17(self, frame, address, group):
+		self._sessions[(address, group)] = time.time()
+		return frame.tolist()
+
+	#=============================================================================================================
+	# Log in to a device, the result is True
+	#=============================================================================================================
+	def login(self, address, group):
+		return self._chain(self.opcode17(address, group), lambda response: True)
+
+	def logged_in(self, address, group):
+		return (address, group) in self._sessions
+
+	#=============================================================================================================
+	# Forget the session of a device (or of every device), the next request logs in again when access is set
+	#=============================================================================================================
+	def logout(self, address=None, group=None):
+		if address is None:
+			self._sessions.clear()
+		else:
+			self._sessions.pop((address, group), None)
+
 	#=============================================================================================================
-	def opcode17(self, address, group, expected_length=-1):
-		data = [address, group, self._host_address, self._host_group, 17, 5,76,79,73,03,232]
-		request = ""
-		for i in data:
-			request += struct.pack('B',i)
-		for i in crc.crc16(request):
-			request += struct.pack('B',i)
-		self._send(request)
-		data = self._recv()
-		responsecrc = data[-2:]
-		data = data[:-2]
-		response = ""
-		for i in data:
-			response += struct.pack('B',i)
-		
-		if not(crc.crc16(response) == responsecrc):
-			raise RuntimeError('CRC Error')
-		
-		if not(data[0] == self._host_address) or not(data[1] == self._host_group):
-			raise RuntimeError('Incorrect Host Address in Response')
-		
-		if not(data[2] == address) or not(data[3] == group):
-			raise RuntimeError('Incorrect Device Address in Response')
-		
-		if not(data[4] == 17) and (data[4] != 255):
-			raise RuntimeError('Incorrect OPCode in Response')
-		
-		if (data[4] == 255):
-			raise OpcodeError(data[7], data[8],[])
-
-		return data
-
-    #=============================================================================================================
 	# OPCODE 120 POINTER
 	#=============================================================================================================
 	def opcode120(self, address, group, expected_length=-1):
-		data = [address, group, self._host_address, self._host_group, 120,0]
-		request = ""
-		for i in data:
-			request += struct.pack('B',i)
-		for i in crc.crc16(request):
-			request += struct.pack('B',i)
-		self._send(request)
-		data = self._recv()
-		responsecrc = data[-2:]
-		data = data[:-2]
-		response = ""
-		for i in data:
-			response += struct.pack('B',i)
-		
-		if not(crc.crc16(response) == responsecrc):
-			raise RuntimeError('CRC Error')
-		
-		if not(data[0] == self._host_address) or not(data[1] == self._host_group):
-			raise RuntimeError('Incorrect Host Address in Response')
-		
-		if not(data[2] == address) or not(data[3] == group):
-			raise RuntimeError('Incorrect Device Address in Response')
-		
-		if not(data[4] == 120) and (data[4] != 255):
-			raise RuntimeError('Incorrect OPCode in Response')
-		if (data[4] == 255):
-			raise OpcodeError(data[7], data[8],[])
+		return self._request(address, group, 120, decode=self._decode120)
+
+	def _decode120(self, frame):
+		if frame.length < _OPCODE120_STRUCT.size:
+			raise RuntimeError('Incorrect Length in Response')
 		dData = {}
-		
-		#Alarm Pointer
-		value = ""
-		value += struct.pack('B',data[6])
-		value += struct.pack('B',data[7])
-		dData['alarm_pointer'] = struct.unpack('H',value)[0]
-		
-		#Event Pointer
-		value = ""
-		value += struct.pack('B',data[8])
-		value += struct.pack('B',data[9])
-		dData['event_pointer'] = struct.unpack('H',value)[0]
-		
-		#Hourly Index
-		value = ""
-		value += struct.pack('B',data[10])
-		value += struct.pack('B',data[11])
-		dData['hourly_index'] = struct.unpack('H',value)[0]
-		
-		#Extended Index
-		value = ""
-		value += struct.pack('B',data[12])
-		value += struct.pack('B',data[13])
-		dData['extended_index'] = struct.unpack('H',value)[0]
-		
-		#Extended Number
-		value = ""
-		value += struct.pack('B',data[14])
-		value += struct.pack('B',data[15])
-		dData['number_extended'] = struct.unpack('H',value)[0]
-		
-		#Daily Index
-		value = ""
-		value += struct.pack('B',data[18])
-		value += struct.pack('B',data[19])
-		dData['daily_index'] = struct.unpack('H',value)[0]
-		
-		#Max Number Of Alarms (Normally 240)
-		value = ""
-		value += struct.pack('B',data[22])
-		value += struct.pack('B',data[23])
-		dData['max_alarms'] = struct.unpack('H',value)[0]
-		
-		#Max Number Of Events (Normally 240)
-		value = ""
-		value += struct.pack('B',data[24])
-		value += struct.pack('B',data[25])
-		dData['max_events'] = struct.unpack('H',value)[0]
-		
-		#Number of Days of Daily History Logs
-		dData['days_daily'] = data[26]
-		
-		#Number of Days of Hourly History Logs
-		dData['days_hourly'] = data[27]
-		
-		#Number of Minutes of Minute History Logs
-		dData['minutes_minute'] = data[30]
+		(dData['alarm_pointer'],			#Alarm Pointer
+		 dData['event_pointer'],			#Event Pointer
+		 dData['hourly_index'],				#Hourly Index
+		 dData['extended_index'],			#Extended Index
+		 dData['number_extended'],			#Extended Number
+		 dData['daily_index'],				#Daily Index
+		 dData['max_alarms'],				#Max Number Of Alarms (Normally 240)
+		 dData['max_events'],				#Max Number Of Events (Normally 240)
+		 dData['days_daily'],				#Number of Days of Daily History Logs
+		 dData['days_hourly'],				#Number of Days of Hourly History Logs
+		 dData['minutes_minute']) = frame.unpack_from(_OPCODE120_STRUCT)	#Number of Minutes of Minute History Logs
 		return dData
 
 
-    #=============================================================================================================
+	#=============================================================================================================
 	# OPCODE 121 ALARM HISTORY
 	#=============================================================================================================
 	def opcode121(self, address, group, number, pointer, expected_length=-1):
-		data = [address, group, self._host_address, self._host_group, 121, 3, number,]
-		print pointer
-		
-		value = struct.pack('H',pointer)
-		for byte in value:
-			data.append(struct.unpack('B',byte)[0])
-		request = ""
-		for i in data:
-			request += struct.pack('B',i)
-		for i in crc.crc16(request):
-			request += struct.pack('B',i)
-		self._send(request)
-		data = self._recv()
-		dData = {'alarms':[]}
-		responsecrc = data[-2:]
-		data = data[:-2]
-		response = ""
-		
-		for i in data:
-			response += struct.pack('B',i)
-		
-		if not(crc.crc16(response) == responsecrc):
-			raise RuntimeError('CRC Error')
-		
-		if not(data[0] == self._host_address) or not(data[1] == self._host_group):
-			raise RuntimeError('Incorrect Host Address in Response')
-		
-		if not(data[2] == address) or not(data[3] == group):
-			raise RuntimeError('Incorrect Device Address in Response')
-		
-		if not(data[4] == 121) and (data[4] != 255):
-			raise RuntimeError('Incorrect OPCode in Response')
-		
-		dData['number'] = data[6]
-		if not(dData['number'] == number):
-			raise RuntimeError('Incorrect Alarms in Response')
-		
-		value = ""
-		value += struct.pack('B',data[7])
-		value += struct.pack('B',data[8])
-		dData['starting_pointer'] = struct.unpack('H',value)[0]
-		if not(dData['starting_pointer'] == pointer):
-			raise RuntimeError('Incorrect Pointer in Response')
-		
-		if (data[4] == 255):
-			raise OpcodeError(data[7], data[8],[])
-		
-		value = ""
-		value += struct.pack('B',data[9])
-		value += struct.pack('B',data[10])
-		dData['current_pointer'] = struct.unpack('H',value)[0]
-		
-		alarms = data[11:]
-		alarms = [alarms[i:i+22] for i  in range(0, len(alarms), 22)]
-		
-		aTH = ['', 'Sensor DP', 'Sensor AP', 'Sensor PT', '', 'I/O Point', 'AGA', 'User Text', 'User Value', 'MVS Sensor', 'Sensor Module', '', '', '', '', 'FST']
-		aTL = ['Alarm Clear', 'Alarm Set', 'Pulse Input Alarm Clear', 'Pulse Input Alarm Set', 'SRBX Alarm Clear', 'SRBX Alarm Set','','','']
-		
-		
-		for alarm in alarms:
-			dAlarm = {}
-			iAlarmType =  alarm[0] >> 4
-			iAlarmSet = alarm[0] & 0x0F
-			if iAlarmType in [1,2,3,5]:
-				aCode = ['Low Alarm', 'Lo Lo Alarm', 'High Alarm', ' Hi Hi Alarm', 'Rate Alarm', 'Status Change', 'A/D Failure', 'Manual Mode']
-			elif iAlarmType == 6:
-				aCode = ['Low Alarm', '', 'High Alarm', '', 'Redundant Total Count Alarm', 'Redundant FLow Alarm', 'No Flow Alarm', 'Manual Mode']
-			elif iAlarmType == 8:
-				aCode = ['Logic Alarm', '', '', '', '', '', '', '']
-			elif iAlarmType == 9:
-				aCode = ['', '', '', '', 'Input Freeze Mode', 'EIA-485 Fail Alarm', 'Sensor COmmunications Fail Alarm', 'Off Scan Mode']
-			elif iAlarmType == 10:
-				aCode = ['Sensor Out of Order', 'Phase Discrepancy Detected Alarm', 'Inconsistent Pulse Count', 'Frequency Discrepancy Alarm', 'Channel A Failure Alarm', 'Channel B Failure Alarm', '', '']
-			
-			dAlarm['type'] = aTH[iAlarmType]
-			dAlarm['set'] = aTL[iAlarmSet]
-			dAlarm['code'] = aCode[alarm[1]]
-			dAlarm['date_time'] = "20%02d-%02d-%02d %02d:%02d:%02d"%(alarm[7],alarm[6],alarm[5],alarm[4],alarm[3],alarm[2])
-			dAlarm['tag'] = ""
-			for x in range(10):
-				dAlarm['tag'] += struct.pack('B',alarm[8+x])
-			value = ''
-			value += struct.pack('B',alarm[18])
-			value += struct.pack('B',alarm[19])
-			value += struct.pack('B',alarm[20])
-			value += struct.pack('B',alarm[21])
-			aValue = struct.unpack('f',value)
-			dAlarm['value'] = str(aValue[0])
-			
-			dData['alarms'].append(dAlarm)
-		return dData
-    
+		return self._chain(self.read_alarms(address, group, number, pointer), alarms.AlarmBatch.todict)
 
+	#=============================================================================================================
+	# number alarms from pointer on as an alarms.AlarmBatch
+	#=============================================================================================================
+	def read_alarms(self, address, group, number, pointer):
+		return self._request(address, group, 121, [number, pointer & 0xff, pointer >> 8], decode=alarms.decode_alarms, args=(number, pointer))
 
 	#=============================================================================================================
 	# OPCODE 126 MINUTE HISTORY
 	#=============================================================================================================
 	def opcode126(self, address, group, point, expected_length=-1):
-		data = [address, group, self._host_address, self._host_group, 126, 1, point]
-		clock = self.opcode180(address=address, group=group, TLP=[[12,0,5],[12,0,4],[12,0,3],[12,0,2]], data_format=['b','b','b','b'])
-		iHour = clock[3]
-		sDate = "20%2d-%02d-%02d"%(clock[0],clock[1],clock[2])
-		request = ""
-		for i in data:
-			request += struct.pack('B',i)
-		for i in crc.crc16(request):
-			request += struct.pack('B',i)
-		self._send(request)
-		data = self._recv()
-		responsecrc = data[-2:]
-		data = data[:-2]
-		response = ""
-		for i in data:
-			response += struct.pack('B',i)
-		
-		if not(crc.crc16(response) == responsecrc):
-			raise RuntimeError('CRC Error')
-		if not(data[0] == self._host_address) or not(data[1] == self._host_group):
-			raise RuntimeError('Incorrect Host Address in Response')
-		
-		if not(data[2] == address) or not(data[3] == group):
-			raise RuntimeError('Incorrect Device Address in Response')
-		
-		if not(data[4] == 126) and (data[4] != 255):
-			raise RuntimeError('Incorrect OPCode in Response')
-		if (data[4] == 255):
-			raise OpcodeError(data[7], data[8],[])
-		
-		if not(data[6] == point):
-			raise RuntimeError('Incorrect Pointer in Response')
-		
-		iMin = data[7]
-		hist = data[8:]
-		iBit = 0
-		aHist = []
-		for i in range(60):
-		    value = ''
-		    value += struct.pack('B',hist[iBit])
-		    value += struct.pack('B',hist[iBit + 1])
-		    value += struct.pack('B',hist[iBit + 2])
-		    value += struct.pack('B',hist[iBit + 3])
-		    aValue = struct.unpack('f',value)
-		    iBit += 4
-		    date_time = datetime.datetime(clock[0]+2000,clock[1],clock[2],iHour,i, 00)
-		    if i >= iMin:
-		    	date_time = date_time - datetime.timedelta(hours=1)
-		    sTime = date_time.strftime('%Y-%m-%d %H:%M:%S')
-		    aHist.append({'date_time':sTime, 'value': aValue[0]})
-		return aHist
-
-    
+		return self._chain(self.minute_history(address, group, point), history.HistorySeries.todicts)
+
+	#=============================================================================================================
+	# Minute history of a point as a history.HistorySeries
+	# The device clock is only read when the cached offset is older than max_clock_age seconds, or the minute
+	# in the last response did not match it.
+	#=============================================================================================================
+	def minute_history(self, address, group, point, max_clock_age=history.CLOCK_MAX_AGE):
+		clock = self._clocks.get((address, group))
+		if clock is not None and clock.is_fresh(max_clock_age):
+			return self._read126(clock, address, group, point)
+		return self._chain(self.sync_clock(address, group), self._read126, address, group, point)
+
+	def _read126(self, clock, address, group, point):
+		return self._request(address, group, 126, [point], decode=history.decode_minutes, args=(point, clock))
+
+	#=============================================================================================================
+	# Read the device clock (TLP 12,0,0-5) and update its cached offset, the result is the history.DeviceClock
+	#=============================================================================================================
+	def sync_clock(self, address, group):
+		return self._request(address, group, 180, history.CLOCK_POINTS.request, history.CLOCK_POINTS.TLP, decode=self._decode_clock, args=(address, group))
+
+	def _decode_clock(self, frame, address, group):
+		clock = self._clocks.get((address, group))
+		if clock is None:
+			clock = self._clocks[(address, group)] = history.DeviceClock()
+		clock.update(history.clock_epoch(history.CLOCK_POINTS.decode(frame)))
+		return clock
+
+
 	#=============================================================================================================
 	# OPCODE 128 Read Daily History
+	# Returns the whole record as a history.DailyRecord, the value the opcode used to return is its daily
 	#=============================================================================================================
-	def opcode128(self, address, group, point, day, month, expected_length=-1):
-		data = [address, group, self._host_address, self._host_group, 128, 3, point, day, month]
-		request = ""
-		for i in data:
-			request += struct.pack('B',i)
-		for i in crc.crc16(request):
-			request += struct.pack('B',i)
-		self._send(request)
-		data = self._recv()
-		responsecrc = data[-2:]
-		data = data[:-2]
-		response = ""
-		for i in data:
-			response += struct.pack('B',i)
-		
-		if not(crc.crc16(response) == responsecrc):
-			raise RuntimeError('CRC Error')
-		if not(data[0] == self._host_address) or not(data[1] == self._host_group):
-			raise RuntimeError('Incorrect Host Address in Response')
-		
-		if not(data[2] == address) or not(data[3] == group):
-			raise RuntimeError('Incorrect Device Address in Response')
-		
-		if not(data[4] == 128) and (data[4] != 255):
-			raise RuntimeError('Incorrect OPCode in Response')
-		if (data[4] == 255):
-			raise OpcodeError(data[7], data[8],[])
-		
-		if not(data[7] == month) or not(data[8] == day):
-			raise RuntimeError('Incorrect Date in Response')
-		
-		value = ''
-		value += struct.pack('B',data[109])
-		value += struct.pack('B',data[110])
-		value += struct.pack('B',data[111])
-		value += struct.pack('B',data[112])
-		aValue = struct.unpack('f',value)
-		print "Job Done Data:%s"%(",".join(map(str, aValue)))
-		return aValue
+	def opcode128(self, address, group, point, day, month, expected_length=-1, year=None):
+		return self._request(address, group, 128, [point, day, month], decode=self._decode128, args=(day, month, year))
+
+	def _decode128(self, frame, day, month, year):
+		record = history.decode_daily(frame, day, month, year)
+		if LOGGER.isEnabledFor(logging.DEBUG):
+			LOGGER.debug('Opcode 128 %d,%d point %d daily value: %s', frame.address, frame.group, record.point, record.daily)
+		return record
+
+
+	#=============================================================================================================
+	# OPCODE 135 Single point history
+	# count values of point from history index index of a segment, as a history.PointLog
+	#=============================================================================================================
+	def opcode135(self, address, group, segment, point, index, count=history.MAX_POINT_LOG, history_type=history.PERIODIC):
+		count = min(count, history.MAX_POINT_LOG)
+		return self._request(address, group, 135, [segment, point, history_type, index & 0xff, index >> 8, count], decode=history.decode_point_log, args=(segment, point, index))
+
+
+	#=============================================================================================================
+	# OPCODE 136 Multiple point history
+	# periods periods of point_count points from first_point on, starting at history index index, as a
+	# history.PeriodBlock. Fewer periods come back when they do not fit in one frame (history.max_periods).
+	#=============================================================================================================
+	def opcode136(self, address, group, segment, index, first_point, point_count, periods, history_type=history.PERIODIC):
+		periods = min(periods, history.max_periods(point_count))
+		if periods < 1:
+			raise ValueError('%d points do not fit in an opcode 136 response'%point_count)
+		return self._request(address, group, 136, [segment, index & 0xff, index >> 8, history_type, first_point, point_count, periods], decode=history.decode_periods, args=(segment, index, first_point, point_count, history_type))
+
 
-		
 	#=============================================================================================================
 	# OPCODE 180 Read TLP
+	# TLP may also be a compiled points.PointSet, data_format is then ignored
 	#=============================================================================================================
 	def opcode180(self, address, group, TLP, data_format=[], expected_length=-1):
-		data = [address, group, self._host_address, self._host_group, 180, (len(TLP)*3)+1, len(TLP)]
 		self.data_format = data_format
-		length = 1
-		regs = 0
-		for t,l,p in TLP:
-			length += 3
-			regs += 1
-			data.append(t)
-			data.append(l)
-			data.append(p)
-			
-		request = ""
-		for i in data:
-			request += struct.pack('B',i)
-		for i in crc.crc16(request):
-			request += struct.pack('B',i)
-		
-		self._send(request)
-		
-		data = self._recv()
-		responsecrc = data[-2:]
-		data = data[:-2]
-		response = ""
-		for i in data:
-			response += struct.pack('B',i)
-		
-		if not(crc.crc16(response) == responsecrc):
-			raise RuntimeError('CRC Error')
-		if not(data[0] == self._host_address) or not(data[1] == self._host_group):
-			raise RuntimeError('Incorrect Host Address in Response')
-		
-		if not(data[2] == address) or not(data[3] == group):
-			raise RuntimeError('Incorrect Device Address in Response')
-		
-		if not(data[4] == 180) and (data[4] != 255):
-			raise RuntimeError('Incorrect OPCode in Response')
-		if (data[4] == 255):
-			raise OpcodeError(data[7], data[8],TLP)
-		
-		tlplength = data[6]
-		data = data[7:]
-		value = ''
-		for i in range(len(TLP)):
-			t,l,p = TLP[i]
-			if not(data[0] == t) or not(data[1] == l) or not(data[2] == p):
-				raise RuntimeError('TLP Recieved is not TLP Requested')
-			if data_format[i] in ['f','q','L','l','i']:
-				value += struct.pack('B',data[3])
-				value += struct.pack('B',data[4])
-				value += struct.pack('B',data[5])
-				value += struct.pack('B',data[6])
-				data = data[7:]
-			elif data_format[i] in ['h','H']:
-				value += struct.pack('B',data[3])
-				value += struct.pack('B',data[4])
-				data = data[5:]
-			elif data_format[i] in ['b','B']:
-				value += struct.pack('B',data[3])
-				data = data[4:]
+		if self.block_reads and not isinstance(TLP, points.PointSet):
+			run = points.run_of(TLP)
+			if run is not None and len(TLP) > 1:
+				return self.opcode167(address, group, run[0], run[1], run[2], data_format)
+		point_set = points.compile_points(TLP, data_format)
+		if self.cache is not None:
+			return self._cached180(address, group, point_set)
+		return self._request(address, group, 180, point_set.request, point_set.TLP, decode=self._decode180, args=(point_set,))
+
+	#=============================================================================================================
+	# Opcode 180 through the TLP cache, only the points that are not cached are read
+	#=============================================================================================================
+	def _cached180(self, address, group, point_set):
+		device = self._cache_key(address, group)
+		aCached = self.cache.lookup(device, point_set)
+		if None not in aCached:
+			return self._resolved(tuple(chain.from_iterable(aCached)))
+		partial = cache.PartialRead(self.cache, device, point_set, aCached)
+		fetch = partial.fetch
+		return self._chain(self._request(address, group, 180, fetch.request, fetch.TLP, decode=self._decode180, args=(fetch,)), partial.merge)
+
+	def _cache_key(self, address, group):
+		return (getattr(self, '_server', None), getattr(self, '_port', None), address, group)
+
+	def _decode180(self, frame, point_set):
+		aValue = point_set.decode(frame)
+		if LOGGER.isEnabledFor(logging.DEBUG):
+			LOGGER.debug('Opcode 180 %d,%d data: %s', frame.address, frame.group, aValue)
+		return aValue
+
+
+	#=============================================================================================================
+	# Read any number of (T, L, P, format) tlps with as few opcode 180 requests as the frame size allows
+	# Values come back in the order of tlps. With blocks (block_reads when None) runs of min_run parameters
+	# or more are read with opcode 167.
+	#=============================================================================================================
+	def read_points(self, address, group, tlps, blocks=None, min_run=3):
+		if blocks is None:
+			blocks = self.block_reads
+		plan = planner.plan_reads(tlps, min_run=min_run if blocks else 0)
+		aResults = []
+		for batch in plan.batches:
+			if batch.start is not None:
+				aResults.append(self.opcode167(address, group, batch.TLP[0][0], batch.TLP[0][1], batch.start, batch.data_format))
 			else:
-				#MUST BE A STRING (c)
-				stringlength = int(data_format[i].replace('c',''))
-				dataformat = ''
-				for x in range(stringlength):
-					dataformat += 'c'
-					value += struct.pack('B',data[3+x])
-				data = data[3+stringlength:]
-				data_format[i] = dataformat
-		aValue = struct.unpack('=%s'%(''.join(data_format)),value)
-		print "Job Done Data:%s"%(",".join(map(str, aValue)))
+				aResults.append(self.opcode180(address, group, batch.TLP, batch.data_format))
+		return self._chain(self._gather(aResults), plan.merge)
+
+
+	#=============================================================================================================
+	# OPCODE 167 Read parameters of a point
+	# Parameters start to start + len(data_format) - 1 of point type t, logical l; values as opcode180 returns them
+	#=============================================================================================================
+	def opcode167(self, address, group, t, l, start, data_format):
+		block = points.compile_block(t, l, start, data_format)
+		if self.cache is not None:
+			device = self._cache_key(address, group)
+			aCached = self.cache.lookup(device, block)
+			if None not in aCached:
+				return self._resolved(tuple(chain.from_iterable(aCached)))
+			return self._chain(self._request(address, group, 167, block.request, block.TLP, decode=self._decode167, args=(block,)), self._store167, device, block)
+		return self._request(address, group, 167, block.request, block.TLP, decode=self._decode167, args=(block,))
+
+	def _decode167(self, frame, block):
+		aValue = block.decode(frame)
+		if LOGGER.isEnabledFor(logging.DEBUG):
+			LOGGER.debug('Opcode 167 %d,%d data: %s', frame.address, frame.group, aValue)
 		return aValue
-	
-	
+
+	def _store167(self, values, device, block):
+		self.cache.store(device, block, values)
+		return values
+
+
 	#=============================================================================================================
 	# OPCODE 181 WRITE TLP
 	#=============================================================================================================
 	def opcode181(self, address, group, TLP, data_format, values, expected_length=-1):
-		data = [address, group, self._host_address, self._host_group, 181,0,0]
-		length = 1
-		regs = 0
-		for i in range(len(TLP)):
-			t,l,p = TLP[i]
-			length += 3
-			regs += 1
-			data.append(t)
-			data.append(l)
-			data.append(p)
-			if data_format[i] in ['f','q','L','l','i']:
-				length += 4
-				for byte in struct.pack(data_format[i], values[i]):
-					data.append(struct.unpack('B',byte)[0])
-			elif data_format[i] in ['h','H']:
-				length += 2
-				for byte in struct.pack(data_format[i], values[i]):
-					data.append(struct.unpack('B',byte)[0])
-			elif data_format[i] in ['b','B']:
-				length += 1
-				for byte in struct.pack(data_format[i], values[i]):
-					data.append(struct.unpack('B',byte)[0])
-			else:
-				#Must be a string
-				stringlength = int(data_format[i].replace('c',''))
-				data_format = ''
-				for x in range(stringlength):
-					length += 1
-					data_format += 'c'
-					data.append(struct.unpack('B',values[x])[0])
-				
-		data[5] = length
-		data[6] = regs
-		
-		request = ""
-		for i in data:
-			request += struct.pack('B',i)
-		for i in crc.crc16(request):
-			request += struct.pack('B',i)
-		
-		self._send(request)
-		data = self._recv()
-		responsecrc = data[-2:]
-		data = data[:-2]
-		
-		response = ""
-		for i in data:
-			response += struct.pack('B',i)
-			
-		if not(crc.crc16(response) == responsecrc):
-			raise RuntimeError('CRC Error')
-		
-		if not(data[0] == self._host_address) or not(data[1] == self._host_group):
-			raise RuntimeError('Incorrect Host Address in Response')
-		
-		if not(data[2] == address) or not(data[3] == group):
-			raise RuntimeError('Incorrect Device Address in Response')
-		
-		if not(data[4] == 181):
-			raise RuntimeError('Incorrect OPCode in Response')
-		
-		if (data[5] == 0):
+		point_set = points.compile_points(TLP, data_format)
+		if self.cache is not None:
+			self.cache.invalidate(self._cache_key(address, group), point_set.TLP)
+		return self._request(address, group, 181, point_set.encode_write(values), point_set.TLP, decode=self._decode181, args=(values, point_set))
+
+	def _decode181(self, frame, values, point_set):
+		if self.cache is not None:
+			#a read that was in flight during the write may have stored the old value
+			self.cache.invalidate(self._cache_key(frame.address, frame.group), point_set.TLP)
+		if (frame.length == 0):
 			#Good Response
 			return tuple(values)
-		
-	
-	
-		
 
 
+#*************************************************************************************************************
+# TCP Master Object
+# transport is one of link.TRANSPORTS: 'tcp', 'udp', or 'serial' with the device path as server and the baud
+# rate as port.
+#*************************************************************************************************************
+class TcpMaster(RocMaster):
+
+	def __init__(self, server="127.0.0.1", port=4000, host_group=3, host_address=1, timeout_in_sec=5.0, link_manager=None, metrics_registry=None, cache=None, bus=False, health=None, access=False, credentials=None, transport='tcp'):
+		RocMaster.__init__(self, host_group, host_address, cache, access, credentials)
+		self.timeout_in_sec = timeout_in_sec
+		self._server = server
+		self._port = port
+		self._link = (link_manager or link.default_manager).get(server, port, transport)
+		self._tx = bytearray(codec.MAX_FRAME_LENGTH)
+		self._metrics = metrics_registry or metrics.default_registry
+		self._metrics.track_link(self._link)
+		self._devices = {}
+		#several devices on one multi-drop line share the link through a Bus, True for the link's own
+		self._bus = roc_bus.get(self._link) if bus is True else (bus or None)
+		#adaptive timeouts (timeout_in_sec is the longest) and circuit breakers, True for a health of its own
+		self.health = roc_health.DeviceHealth() if health is True else (health or None)
+
+	#=============================================================================================================
+	# Connect to slave device
+	#=============================================================================================================
+	def _do_open(self):
+		self._link.open()
+
+
+	#=============================================================================================================
+	# Close Connection
+	#=============================================================================================================
+	def _do_close(self):
+		"""Close the connection with the Slave"""
+		self._link.close()
+		return True
+
+
+	#=============================================================================================================
+	# Send Request to the slave
+	#=============================================================================================================
+	def _send(self, request):
+		wire.trace_frame('TX', self._link.name, request)
+		self._link.send(request)
+
+
+	#=============================================================================================================
+	# Recieve data from slave
+	#=============================================================================================================
+	def _recv(self, expected_length=-1, header=None, timeout=None):
+		response = self._link.recv(timeout or self.timeout_in_sec, header)
+		if LOGGER.isEnabledFor(wire.TRACE):
+			wire.trace_frame('RX', self._link.name, memoryview(response)[:codec.HEADER_LENGTH + response[5] + codec.CRC_LENGTH])
+		return response
+
+
+
+	#=============================================================================================================
+	# Set Timeout
+	#=============================================================================================================
+	def set_timeout(self, timeout_in_sec):
+		self.timeout_in_sec = timeout_in_sec
+
+
+	#=============================================================================================================
+	# Send a request frame and return the decoded response
+	#=============================================================================================================
+	def _execute(self, address, group, opcode, body='', TLP=[], decode=None, args=()):
+		health = self.health
+		timeout = None
+		if health is not None:
+			device = self._device(address, group)
+			health.allow(device)
+			timeout = health.timeout(device, opcode, self.timeout_in_sec)
+		with (self._bus.turn(address, group) if self._bus is not None else self._link):
+			#the request buffer is shared by every thread using this master
+			started = time.time()
+			length = codec.encode_frame_into(self._tx, address, group, self._host_address, self._host_group, opcode, body)
+			encoded = time.time()
+			try:
+				self._send(memoryview(self._tx)[:length])
+				sent = time.time()
+				response = self._recv(header=self._header(address, group), timeout=timeout)
+				received = time.time()
+				if health is not None:
+					health.success(device, opcode, received - sent)
+				result = self._finish(response, address, group, opcode, TLP, decode, args)
+			except Exception as ex:
+				wire.dump_frames(self._link.name, self._link.frames, ex)
+				kind = metrics.error_kind(ex)
+				if health is not None and kind in ('timeout', 'link'):
+					health.failure(device, opcode)
+				if self._metrics.enabled:
+					self._metrics.record_error(opcode, self._device(address, group), kind, length)
+				raise
+			if self._metrics.enabled:
+				first_byte = max(sent, self._link.first_byte_at or received)
+				self._metrics.record(opcode, self._device(address, group), (started, encoded, sent, first_byte, received, time.time()), length, codec.HEADER_LENGTH + response[5] + codec.CRC_LENGTH)
+			return result
+
+
+	#=============================================================================================================
+	# Header of the responses of a device, anything else on the line is skipped while waiting for one
+	#=============================================================================================================
+	def _header(self, address, group):
+		return bytes(bytearray((self._host_address, self._host_group, address, group)))
+
+
+	#=============================================================================================================
+	# Device name in the metrics
+	#=============================================================================================================
+	def _device(self, address, group):
+		name = self._devices.get((address, group))
+		if name is None:
+			name = self._devices[(address, group)] = '%s:%s/%d,%d'%(self._server, self._port, address, group)
+		return name
+
+
+	def _chain(self, result, fn, *args):
+		return fn(result, *args)
+
+
+	def _recover(self, on_error, fn, *args):
+		try:
+			return fn(*args)
+		except Exception as ex:
+			return on_error(ex)
+
+
+	def _gather(self, results):
+		return list(results)
+
+
+_OPCODE120_STRUCT = struct.Struct('<HHHHH2xH2xHHBB2xB')
+
+#operator id and password of the login this master always sent
+LOGIN = ('LOI', 1000)
+
+#error codes (first data byte of an opcode 255 response) that mean the device wants a login
+ACCESS_ERRORS = (20, 21, 63)
+
+
+#=============================================================================================================
+# Opcode 17 data: 3 character operator id and the password, high byte first
+#=============================================================================================================
+def login_body(operator, password):
+	if len(operator) != 3:
+		raise ValueError('Operator id must be 3 characters: %r'%operator)
+	return bytearray(operator) + struct.pack('>H', password)
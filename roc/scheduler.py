@@ -0,0 +1,243 @@
+#!/usr/bin/env python
+# -*- coding: utf_8 -*-
+
+
+"""
+ TestKit: Implementation of Fisher ROC protocol in python
+ This is distributed under GNU LGPL license, see license.txt
+
+ Polling scheduler for blocking masters. A ScanClass is a function run
+ every interval seconds against a deadline (the end of its period unless
+ given). Scans are grouped by the link they use and every link has one
+ worker thread, so a link always has the next due transaction ready but
+ never more than one in progress. Among the scans that are due the worker
+ runs the highest priority (lowest number) first, then the earliest
+ deadline.
+
+	scheduler = Scheduler(on_miss=report)
+	scheduler.add_poll(master, 240, 240, TLP_POINTS, interval=10)
+	scheduler.add_alarms(alarm_sync, 240, 240, interval=60, priority=1)
+	scheduler.start()
+"""
+
+
+import time
+import random
+import threading
+
+
+#*************************************************************************************************************
+# One periodic scan
+#*************************************************************************************************************
+class ScanClass(object):
+
+	def __init__(self, name, interval, fn, args=(), link=None, priority=0, jitter=0.0, deadline=None, skip_on_overrun=True, on_result=None, on_error=None):
+		self.name = name
+		self.interval = float(interval)
+		self.fn = fn
+		self.args = args
+		self.link = link
+		self.priority = priority
+		self.jitter = jitter
+		self.deadline = self.interval if deadline is None else deadline
+		self.skip_on_overrun = skip_on_overrun
+		self.on_result = on_result
+		self.on_error = on_error
+		self.due = 0.0
+		self.period_start = 0.0
+		self.runs = 0
+		self.errors = 0
+		self.missed = 0
+		self.skipped = 0
+		self.last_start = None
+		self.last_duration = None
+		self.last_error = None
+
+	def __repr__(self):
+		return 'ScanClass(%r, interval=%s, priority=%s)'%(self.name, self.interval, self.priority)
+
+	def _schedule(self, due):
+		self.due = due + (random.uniform(0, self.jitter) if self.jitter else 0.0)
+
+	#=============================================================================================================
+	# Deadline of the current period (jitter does not move it)
+	#=============================================================================================================
+	def current_deadline(self):
+		return self.period_start + self.deadline
+
+	def snapshot(self):
+		return {'name':self.name, 'interval':self.interval, 'priority':self.priority, 'runs':self.runs, 'errors':self.errors, 'missed':self.missed, 'skipped':self.skipped, 'last_duration':self.last_duration, 'next_due':self.due}
+
+
+#*************************************************************************************************************
+# Worker for the scans sharing one link
+#*************************************************************************************************************
+class _LinkWorker(object):
+
+	def __init__(self, scheduler, key):
+		self.scheduler = scheduler
+		self.key = key
+		self.scans = []
+		self._thread = None
+
+	#=============================================================================================================
+	# Due scan to run next, or the time the next one becomes due
+	#=============================================================================================================
+	def _select(self, now):
+		best = None
+		next_due = None
+		for scan in self.scans:
+			if scan.due <= now:
+				if best is None or (scan.priority, scan.current_deadline()) < (best.priority, best.current_deadline()):
+					best = scan
+			elif next_due is None or scan.due < next_due:
+				next_due = scan.due
+		return best, next_due
+
+	def run(self):
+		scheduler = self.scheduler
+		cond = scheduler._cond
+		while True:
+			with cond:
+				while True:
+					if not scheduler._running:
+						return
+					now = time.time()
+					scan, next_due = self._select(now)
+					if scan is not None:
+						break
+					cond.wait(None if next_due is None else next_due - now)
+			scheduler._run(scan)
+
+
+#*************************************************************************************************************
+# Scheduler
+# on_miss(scan, lateness) is called whenever a scan finishes after its deadline or periods are skipped.
+#*************************************************************************************************************
+class Scheduler(object):
+
+	def __init__(self, on_miss=None):
+		self.on_miss = on_miss
+		self._workers = {}
+		self._cond = threading.Condition()
+		self._running = False
+
+	#=============================================================================================================
+	# Add a scan, link is any key naming the link it uses (scans with the same link never overlap)
+	#=============================================================================================================
+	def add(self, name, interval, fn, args=(), link=None, **kwargs):
+		scan = ScanClass(name, interval, fn, args, link, **kwargs)
+		with self._cond:
+			worker = self._workers.get(link)
+			if worker is None:
+				worker = self._workers[link] = _LinkWorker(self, link)
+			now = time.time()
+			scan.period_start = now
+			scan._schedule(now)
+			worker.scans.append(scan)
+			if self._running and worker._thread is None:
+				self._start_worker(worker)
+			self._cond.notify_all()
+		return scan
+
+	def remove(self, scan):
+		with self._cond:
+			worker = self._workers.get(scan.link)
+			if worker is not None and scan in worker.scans:
+				worker.scans.remove(scan)
+
+	#=============================================================================================================
+	# Read (T, L, P, format) points with master.read_points every interval seconds
+	#=============================================================================================================
+	def add_poll(self, master, address, group, points, interval, name=None, **kwargs):
+		name = name or 'poll %s %d,%d'%(_link_key(master), address, group)
+		return self.add(name, interval, master.read_points, (address, group, points), _link_key(master), **kwargs)
+
+	#=============================================================================================================
+	# Sync the alarm log of a device with an alarms.AlarmSync every interval seconds
+	#=============================================================================================================
+	def add_alarms(self, alarm_sync, address, group, interval, name=None, **kwargs):
+		name = name or 'alarms %s %d,%d'%(_link_key(alarm_sync.master), address, group)
+		return self.add(name, interval, alarm_sync.sync, (address, group), _link_key(alarm_sync.master), **kwargs)
+
+	def scans(self):
+		with self._cond:
+			return [scan for worker in self._workers.values() for scan in worker.scans]
+
+	def snapshot(self):
+		return [scan.snapshot() for scan in self.scans()]
+
+	#=============================================================================================================
+	# Start and stop the worker threads
+	#=============================================================================================================
+	def start(self):
+		with self._cond:
+			self._running = True
+			for worker in self._workers.values():
+				if worker._thread is None:
+					self._start_worker(worker)
+
+	def _start_worker(self, worker):
+		worker._thread = threading.Thread(target=worker.run, name='Scheduler %s'%(worker.key,))
+		worker._thread.daemon = True
+		worker._thread.start()
+
+	def stop(self, timeout=None):
+		with self._cond:
+			self._running = False
+			self._cond.notify_all()
+			aThreads = [worker._thread for worker in self._workers.values() if worker._thread is not None]
+			for worker in self._workers.values():
+				worker._thread = None
+		for thread in aThreads:
+			thread.join(timeout)
+
+	#=============================================================================================================
+	# Run one scan and schedule its next period
+	#=============================================================================================================
+	def _run(self, scan):
+		start = time.time()
+		scan.last_start = start
+		try:
+			result = scan.fn(*scan.args)
+		except Exception as ex:
+			scan.errors += 1
+			scan.last_error = ex
+			if scan.on_error is not None:
+				scan.on_error(scan, ex)
+		else:
+			scan.last_error = None
+			if scan.on_result is not None:
+				scan.on_result(scan, result)
+		end = time.time()
+		scan.runs += 1
+		scan.last_duration = end - start
+
+		lateness = end - scan.current_deadline()
+		if lateness > 0:
+			scan.missed += 1
+		with self._cond:
+			period_start = scan.period_start + scan.interval
+			if period_start + scan.interval <= end:
+				if scan.skip_on_overrun:
+					#drop the periods that are already over instead of running them back to back
+					skipped = int((end - period_start) // scan.interval)
+					scan.skipped += skipped
+					period_start += skipped * scan.interval
+				else:
+					period_start = end
+			scan.period_start = period_start
+			scan._schedule(period_start)
+			self._cond.notify_all()
+		if lateness > 0 and self.on_miss is not None:
+			self.on_miss(scan, lateness)
+
+
+#=============================================================================================================
+# Key of the link a master uses
+#=============================================================================================================
+def _link_key(master):
+	link = getattr(master, '_link', None)
+	if link is not None:
+		return (link.server, link.port)
+	return (getattr(master, '_server', None), getattr(master, '_port', None))
@@ -0,0 +1,400 @@
+#!/usr/bin/env python
+# -*- coding: utf_8 -*-
+
+
+"""
+ TestKit: Implementation of Fisher ROC protocol in python
+ This is distributed under GNU LGPL license, see license.txt
+
+ Simulated ROC slaves for benchmarks and local testing. A SimulatedRoc is a
+ TCP server standing in for a terminal server port (or a UDP one, or the
+ far end of a pseudo-terminal for serial links); every SimulatedDevice
+ behind it answers the opcodes TcpMaster implements (8, 17, 120, 121, 126,
+ 128, 135, 136, 167, 180, 181) at its (address, group) and ignores frames for other
+ devices. Responses can be delayed (latency plus random jitter) and
+ corrupted (one byte flipped, so the master sees a CRC error).
+
+	server = SimulatedRoc(latency=0.02, jitter=0.005)
+	server.add_device(240, 240)
+	server.start()
+	master = TcpMaster('127.0.0.1', server.port)
+
+ With transport='serial' host is the path of the pty the master opens and
+ port its baud rate:
+
+	server = SimulatedRoc(transport='serial').start()
+	master = TcpMaster(server.host, server.port, transport='serial')
+"""
+
+
+import os
+import pty
+import tty
+import time
+import struct
+import random
+import calendar
+import socket
+import threading
+import SocketServer
+
+import codec
+import link
+
+
+#data_format of the parameters of a point type, everything else is a float
+DEFAULT_FORMATS = {12: 'B'}
+
+#entries of a history segment and seconds per entry for each type of history (minute, periodic, daily)
+HISTORY_SIZE = 840
+HISTORY_PERIODS = (60, 3600, 86400)
+
+ERROR_OPCODE = codec.ERROR_OPCODE
+
+#error codes for a refused login and for a request before the login
+PASSWORD_ERROR = 21
+ACCESS_ERROR = 63
+
+
+#*************************************************************************************************************
+# One simulated device
+#*************************************************************************************************************
+class SimulatedDevice(object):
+
+	def __init__(self, address=240, group=240, formats=None, max_alarms=240, seed=None, login=None):
+		self.address = address
+		self.group = group
+		self.formats = dict(DEFAULT_FORMATS)
+		self.formats.update(formats or {})
+		self.values = {}
+		self.max_alarms = max_alarms
+		self.alarm_pointer = 0
+		self.alarms = [None] * max_alarms
+		#(operator, password) the device wants before any other opcode, None when it takes anything
+		self.login = login
+		self.access = False
+		self.clock_offset = 0.0
+		self._random = random.Random(seed)
+		self._lock = threading.Lock()
+
+	def format(self, t, l, p):
+		return self.formats.get((t, l, p)) or self.formats.get(t, 'f')
+
+	#=============================================================================================================
+	# Value of a parameter, made up from the TLP until it is written
+	#=============================================================================================================
+	def value(self, t, l, p):
+		if (t, l, p) in self.values:
+			return self.values[(t, l, p)]
+		if t == 12:
+			clock = time.gmtime(time.time() + self.clock_offset)
+			return (clock.tm_sec, clock.tm_min, clock.tm_hour, clock.tm_mday, clock.tm_mon, clock.tm_year - 2000, 0, 0)[p % 8]
+		fmt = self.format(t, l, p)
+		if fmt.endswith('c'):
+			return ('%d.%d.%d'%(t, l, p)).ljust(int(fmt[:-1] or 1))
+		if fmt in ('f',):
+			return t * 10000.0 + l * 100.0 + p
+		return (t + l + p) & 0x7f
+
+	def encode_value(self, t, l, p):
+		fmt = self.format(t, l, p)
+		if fmt.endswith('c'):
+			return struct.pack('<%ds'%int(fmt[:-1] or 1), self.value(t, l, p))
+		return struct.pack('<' + fmt, self.value(t, l, p))
+
+	#=============================================================================================================
+	# Log an alarm in the ring, code and value are made up when not given
+	#=============================================================================================================
+	def add_alarm(self, tag='ALARM', value=None, alarm_type=1, alarm_set=1, code=2):
+		with self._lock:
+			clock = time.gmtime(time.time() + self.clock_offset)
+			if value is None:
+				value = self._random.uniform(0, 1000)
+			self.alarms[self.alarm_pointer] = struct.pack('<8B10sf', alarm_type << 4 | alarm_set, code, clock.tm_sec, clock.tm_min, clock.tm_hour, clock.tm_mday, clock.tm_mon, clock.tm_year - 2000, tag[:10], value)
+			self.alarm_pointer = (self.alarm_pointer + 1) % self.max_alarms
+
+	#=============================================================================================================
+	# Response data for a request, or (ERROR_OPCODE, data) for an error response
+	#=============================================================================================================
+	def handle(self, opcode, data):
+		handler = getattr(self, '_opcode%d'%opcode, None)
+		if handler is None:
+			return ERROR_OPCODE, bytearray([0, opcode, 0])
+		if self.login is not None:
+			if opcode == 17 and bytes(data[:5]) != bytes(bytearray(self.login[0]) + struct.pack('>H', self.login[1])):
+				self.access = False
+				return ERROR_OPCODE, bytearray([PASSWORD_ERROR, opcode, 0])
+			if opcode != 17 and not self.access:
+				return ERROR_OPCODE, bytearray([ACCESS_ERROR, opcode, 0])
+		out = handler(data)
+		if len(out) > codec.MAX_DATA_LENGTH:
+			return ERROR_OPCODE, bytearray([0, opcode, 0])
+		return opcode, out
+
+	#session timed out on the device
+	def logout(self):
+		self.access = False
+
+	def _opcode8(self, data):
+		seconds, minutes, hours, day, month, year = data[:6]
+		self.clock_offset = calendar.timegm((year + 2000, month, day, hours, minutes, seconds)) - time.time()
+		return bytearray()
+
+	def _opcode17(self, data):
+		self.access = True
+		return bytearray()
+
+	def _opcode120(self, data):
+		return bytearray(struct.pack('<HHHHH2xH2xHHBB2xB', self.alarm_pointer, 0, 0, 0, 0, 0, self.max_alarms, 240, 35, 35, 60))
+
+	def _opcode121(self, data):
+		number, pointer = data[0], data[1] | (data[2] << 8)
+		out = bytearray(struct.pack('<BHH', number, pointer, self.alarm_pointer))
+		for i in range(number):
+			out += self.alarms[(pointer + i) % self.max_alarms] or struct.pack('<8B10sf', 0, 0, 0, 0, 0, 1, 1, 0, '', 0.0)
+		return out
+
+	def _opcode126(self, data):
+		point = data[0]
+		minute = time.gmtime(time.time() + self.clock_offset).tm_min
+		return bytearray([point, minute]) + struct.pack('<60f', *[point * 1000.0 + i for i in range(60)])
+
+	def _opcode128(self, data):
+		point, day, month = data[:3]
+		return bytearray([point, month, day]) + struct.pack('<26f', *[point * 100.0 + day + i / 100.0 for i in range(26)])
+
+	#=============================================================================================================
+	# History by index: index i of a segment holds point * 100 + i, the current index is the current period
+	#=============================================================================================================
+	def _history_index(self, history_type):
+		return int(time.time() + self.clock_offset) // HISTORY_PERIODS[history_type] % HISTORY_SIZE
+
+	def _history_time(self, history_type, current, index):
+		period = HISTORY_PERIODS[history_type]
+		now = int(time.time() + self.clock_offset)
+		return now - now % period - (current - index) % HISTORY_SIZE * period
+
+	def _opcode135(self, data):
+		segment, point, history_type, index, count = data[0], data[1], data[2], data[3] | (data[4] << 8), data[5]
+		current = self._history_index(history_type)
+		return bytearray(struct.pack('<BBHB', segment, point, current, count)) + struct.pack('<%df'%count, *[point * 100.0 + (index + i) % HISTORY_SIZE for i in range(count)])
+
+	def _opcode136(self, data):
+		segment, index, history_type, first_point, points, periods = data[0], data[1] | (data[2] << 8), data[3], data[4], data[5], data[6]
+		current = self._history_index(history_type)
+		out = bytearray(struct.pack('<BHB', segment, current, periods * (points + 1)))
+		for i in range(periods):
+			entry = (index + i) % HISTORY_SIZE
+			out += struct.pack('<I%df'%points, self._history_time(history_type, current, entry), *[point * 100.0 + entry for point in range(first_point, first_point + points)])
+		return out
+
+	def _opcode167(self, data):
+		t, l, count, start = data[:4]
+		out = bytearray(data[:4])
+		for p in range(start, start + count):
+			out.extend(self.encode_value(t, l, p))
+		return out
+
+	def _opcode180(self, data):
+		out = bytearray(data[:1])
+		for i in range(data[0]):
+			t, l, p = data[1 + 3 * i:4 + 3 * i]
+			out.extend((t, l, p))
+			out.extend(self.encode_value(t, l, p))
+		return out
+
+	def _opcode181(self, data):
+		offset = 1
+		for i in range(data[0]):
+			t, l, p = data[offset:offset + 3]
+			fmt = self.format(t, l, p)
+			if fmt.endswith('c'):
+				fmt = '%ds'%int(fmt[:-1] or 1)
+			size = struct.calcsize('<' + fmt)
+			self.values[(t, l, p)] = struct.unpack_from('<' + fmt, bytes(data[offset + 3:offset + 3 + size]))[0]
+			offset += 3 + size
+		return bytearray()
+
+
+#*************************************************************************************************************
+# Connection handler, one request/response at a time like a serial line behind a terminal server
+#*************************************************************************************************************
+class _Handler(SocketServer.BaseRequestHandler):
+
+	def handle(self):
+		server = self.server.roc
+		reader = codec.FrameReader(self.request)
+		self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+		while server.running:
+			try:
+				buf = reader.read_frame(1.0)
+			except codec.TimeoutError:
+				continue
+			except (socket.error, EnvironmentError):
+				return
+			try:
+				request = codec.decode_frame(buf)
+			except RuntimeError:
+				server.stats['crc_errors'] += 1
+				continue
+			response = server.respond(request)
+			if response is not None:
+				try:
+					self.request.sendall(response)
+				except socket.error:
+					return
+
+
+class _Server(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+	daemon_threads = True
+	allow_reuse_address = True
+
+
+#*************************************************************************************************************
+# Datagram handler, every datagram is one request frame
+#*************************************************************************************************************
+class _UdpHandler(SocketServer.BaseRequestHandler):
+
+	def handle(self):
+		server = self.server.roc
+		data, sock = self.request
+		try:
+			request = codec.decode_frame(data)
+		except RuntimeError:
+			server.stats['crc_errors'] += 1
+			return
+		response = server.respond(request)
+		if response is not None:
+			sock.sendto(response, self.client_address)
+
+
+class _UdpServer(SocketServer.ThreadingMixIn, SocketServer.UDPServer):
+	daemon_threads = True
+	allow_reuse_address = True
+
+
+#*************************************************************************************************************
+# Far end of a pseudo-terminal, answers what the master writes to the other end
+#*************************************************************************************************************
+class _PtyServer(object):
+
+	def __init__(self, roc):
+		self.roc = roc
+		self._fd, self._slave = pty.openpty()
+		#held open so the master end never reads EIO between connections of the link
+		tty.setraw(self._slave)
+		self.path = os.ttyname(self._slave)
+		self._port = link.SerialPort(self._fd)
+		self._running = False
+		self._stopped = threading.Event()
+
+	def serve_forever(self, poll_interval=0.1):
+		server = self.roc
+		reader = codec.FrameReader(self._port)
+		self._running = True
+		try:
+			self._serve(server, reader, poll_interval)
+		finally:
+			self._stopped.set()
+
+	def _serve(self, server, reader, poll_interval):
+		while self._running:
+			try:
+				buf = reader.read_frame(poll_interval)
+			except codec.TimeoutError:
+				continue
+			except (socket.error, EnvironmentError):
+				return
+			try:
+				request = codec.decode_frame(buf)
+			except RuntimeError:
+				server.stats['crc_errors'] += 1
+				reader.reset(self._port)
+				continue
+			response = server.respond(request)
+			if response is not None:
+				try:
+					self._port.sendall(response)
+				except socket.error:
+					return
+
+	#like SocketServer, returns once serve_forever is done
+	def shutdown(self):
+		self._running = False
+		self._stopped.wait()
+
+	def server_close(self):
+		self._port.close()
+		os.close(self._slave)
+
+
+#*************************************************************************************************************
+# Simulated terminal server port
+# transport is 'tcp', 'udp' or 'serial', for a serial port host is the pty to open and port the baud rate.
+#*************************************************************************************************************
+class SimulatedRoc(object):
+
+	def __init__(self, host='127.0.0.1', port=0, latency=0.0, jitter=0.0, corruption=0.0, seed=None, transport='tcp'):
+		self.latency = latency
+		self.jitter = jitter
+		self.corruption = corruption
+		self.devices = {}
+		self.running = False
+		self.stats = {'requests':0, 'responses':0, 'corrupted':0, 'crc_errors':0}
+		self._random = random.Random(seed)
+		self.transport = transport
+		if transport == 'serial':
+			self._server = _PtyServer(self)
+			self.host, self.port = self._server.path, port or 9600
+		else:
+			if transport == 'udp':
+				self._server = _UdpServer((host, port), _UdpHandler, bind_and_activate=True)
+			else:
+				self._server = _Server((host, port), _Handler, bind_and_activate=True)
+			self._server.roc = self
+			self.host, self.port = self._server.server_address
+		self._thread = None
+
+	def add_device(self, address=240, group=240, **kwargs):
+		device = self.devices[(address, group)] = SimulatedDevice(address, group, **kwargs)
+		return device
+
+	#=============================================================================================================
+	# Response frame for a request frame, None when no device has its address
+	#=============================================================================================================
+	def respond(self, request):
+		device = self.devices.get((request.host_address, request.host_group))
+		if device is None:
+			return None
+		self.stats['requests'] += 1
+		data = bytearray(request.data)
+		with device._lock:
+			opcode, out = device.handle(request.opcode, data)
+		delay = self.latency + (self._random.uniform(0, self.jitter) if self.jitter else 0.0)
+		if delay > 0:
+			time.sleep(delay)
+		response = codec.encode_frame(request.address, request.group, request.host_address, request.host_group, opcode, out)
+		if self.corruption and self._random.random() < self.corruption:
+			response[self._random.randrange(codec.HEADER_LENGTH, len(response))] ^= 0xff
+			self.stats['corrupted'] += 1
+		self.stats['responses'] += 1
+		return response
+
+	def start(self):
+		self.running = True
+		self._thread = threading.Thread(target=self._server.serve_forever, kwargs={'poll_interval':0.1}, name='SimulatedRoc %s:%s'%(self.host, self.port))
+		self._thread.daemon = True
+		self._thread.start()
+		return self
+
+	def stop(self):
+		self.running = False
+		self._server.shutdown()
+		self._server.server_close()
+
+	def __enter__(self):
+		return self.start()
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		self.stop()
+		return False
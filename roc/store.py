@@ -0,0 +1,324 @@
+#!/usr/bin/env python
+# -*- coding: utf_8 -*-
+
+
+"""
+ TestKit: Implementation of Fisher ROC protocol in python
+ This is distributed under GNU LGPL license, see license.txt
+
+ Local time-series store. Every (device, key) is one memory-mapped file of
+ fixed 16 byte records (int64 seconds since 1970, float64 value) kept in
+ time order behind a 16 byte header holding the record count. Records are
+ appended; a sample older than the last one is merged in only when its
+ timestamp is not stored yet, so overlapping history pulls are deduped on
+ insert. The timestamps themselves are the index: a lookup is a binary
+ search over the mapped file.
+
+	store = TimeSeriesStore('/var/lib/roc')
+	store.add_series(device, master.minute_history(240, 240, 3))
+	resume = store.last(device, minute_key(3))
+
+ Keys name what a series holds: minute_key for opcode 126 history,
+ hourly_key and daily_key for opcode 128 records, period_key for opcode
+ 136 blocks (one series per segment, point and history type), tlp_key for
+ polled parameters. One process writes a
+ store; the count is written after the records, so a crash during an
+ append loses that append only (a merge rewrites the records after the
+ oldest sample it inserts).
+"""
+
+
+import os
+import re
+import time
+import mmap
+import struct
+import bisect
+import calendar
+import threading
+from array import array
+
+import history
+
+try:
+	import numpy
+except ImportError:
+	numpy = None
+
+
+MAGIC = 'ROCTS\x00\x01\x00'
+HEADER = struct.Struct('<8sQ')
+RECORD = struct.Struct('<qd')
+GROW_RECORDS = 4096
+
+
+def minute_key(point):
+	return 'minute-%d'%point
+
+def hourly_key(point):
+	return 'hourly-%d'%point
+
+def daily_key(point):
+	return 'daily-%d'%point
+
+def period_key(segment, point, history_type=history.PERIODIC):
+	return 'period-%d-%d-%d'%(segment, point, history_type)
+
+def tlp_key(t, l, p):
+	return 'tlp-%d-%d-%d'%(t, l, p)
+
+
+#*************************************************************************************************************
+# Timestamps of a SeriesFile as a sequence, for bisect
+#*************************************************************************************************************
+class _Times(object):
+	__slots__ = ('series',)
+
+	def __init__(self, series):
+		self.series = series
+
+	def __len__(self):
+		return self.series.count
+
+	def __getitem__(self, i):
+		return self.series._time(i)
+
+
+#*************************************************************************************************************
+# One memory-mapped series file
+#*************************************************************************************************************
+class SeriesFile(object):
+
+	def __init__(self, path):
+		self.path = path
+		self._lock = threading.Lock()
+		if not os.path.exists(path):
+			with open(path, 'wb') as f:
+				f.write(HEADER.pack(MAGIC, 0))
+				f.truncate(HEADER.size + GROW_RECORDS * RECORD.size)
+		self._file = open(path, 'r+b')
+		self._map = mmap.mmap(self._file.fileno(), 0)
+		magic, self.count = HEADER.unpack_from(self._map, 0)
+		if magic != MAGIC:
+			self.close()
+			raise ValueError('%s is not a series file'%path)
+		self.capacity = (len(self._map) - HEADER.size) // RECORD.size
+		self._times = _Times(self)
+
+	def close(self):
+		with self._lock:
+			if self._map is not None:
+				self._map.close()
+				self._map = None
+			self._file.close()
+
+	def __len__(self):
+		return self.count
+
+	#=============================================================================================================
+	# Readers hold the lock, an insert from another thread may remap the file
+	#=============================================================================================================
+	def time(self, i):
+		with self._lock:
+			return self._time(i)
+
+	def last(self):
+		with self._lock:
+			return self._last()
+
+	def first(self):
+		with self._lock:
+			return self._time(0) if self.count else None
+
+	def __contains__(self, t):
+		with self._lock:
+			return self._contains(t)
+
+	def _time(self, i):
+		return struct.unpack_from('<q', self._map, HEADER.size + i * RECORD.size)[0]
+
+	def _last(self):
+		return self._time(self.count - 1) if self.count else None
+
+	def _contains(self, t):
+		i = bisect.bisect_left(self._times, t)
+		return i < self.count and self._time(i) == t
+
+	def _grow(self, records):
+		if records <= self.capacity:
+			return
+		capacity = max(records, self.capacity + GROW_RECORDS, self.capacity * 2)
+		self._map.flush()
+		self._map.close()
+		self._file.truncate(HEADER.size + capacity * RECORD.size)
+		self._map = mmap.mmap(self._file.fileno(), 0)
+		self.capacity = capacity
+
+	def _set_count(self, count):
+		self.count = count
+		HEADER.pack_into(self._map, 0, MAGIC, count)
+
+	#=============================================================================================================
+	# Store samples (times and values of the same length, any order), returns how many were new
+	#=============================================================================================================
+	def insert(self, times, values):
+		aSamples = sorted(set(zip((int(t) for t in times), (float(v) for v in values))), key=lambda sample: sample[0])
+		with self._lock:
+			last = self._last()
+			aNew = []
+			aOld = []
+			previous = None
+			for t, v in aSamples:
+				if t == previous:
+					continue
+				previous = t
+				if last is None or t > last:
+					aNew.append((t, v))
+				elif not self._contains(t):
+					aOld.append((t, v))
+			if aOld:
+				self._merge(aOld)
+			if aNew:
+				self._grow(self.count + len(aNew))
+				offset = HEADER.size + self.count * RECORD.size
+				self._map[offset:offset + len(aNew) * RECORD.size] = struct.pack('<' + 'qd' * len(aNew), *[x for sample in aNew for x in sample])
+				self._set_count(self.count + len(aNew))
+			return len(aNew) + len(aOld)
+
+	#older samples go in place, the records after the first of them are rewritten once
+	def _merge(self, aOld):
+		start = bisect.bisect_left(self._times, aOld[0][0])
+		aTail = self._read(start, self.count)
+		aMerged = sorted(aTail + aOld, key=lambda sample: sample[0])
+		self._grow(start + len(aMerged))
+		offset = HEADER.size + start * RECORD.size
+		self._map[offset:offset + len(aMerged) * RECORD.size] = struct.pack('<' + 'qd' * len(aMerged), *[x for sample in aMerged for x in sample])
+		self._set_count(start + len(aMerged))
+
+	def _read(self, start, end):
+		items = struct.unpack_from('<' + 'qd' * (end - start), self._map, HEADER.size + start * RECORD.size)
+		return zip(items[::2], items[1::2])
+
+	#=============================================================================================================
+	# Samples with start <= time < end (either may be None) as times and values columns
+	#=============================================================================================================
+	def range(self, start=None, end=None):
+		with self._lock:
+			i = 0 if start is None else bisect.bisect_left(self._times, start)
+			j = self.count if end is None else bisect.bisect_left(self._times, end)
+			j = max(i, j)
+			if numpy is not None:
+				records = numpy.frombuffer(self._map[HEADER.size + i * RECORD.size:HEADER.size + j * RECORD.size], dtype=[('t', '<i8'), ('v', '<f8')])
+				return records['t'].copy(), records['v'].copy()
+			items = struct.unpack_from('<' + 'qd' * (j - i), self._map, HEADER.size + i * RECORD.size)
+			return array(history.TIME_TYPECODE, items[::2]), array('d', items[1::2])
+
+	def flush(self):
+		with self._lock:
+			self._map.flush()
+
+
+#*************************************************************************************************************
+# Directory of series files, one sub directory per device
+#*************************************************************************************************************
+class TimeSeriesStore(object):
+
+	def __init__(self, root):
+		self.root = root
+		self._files = {}
+		self._lock = threading.Lock()
+		if not os.path.isdir(root):
+			os.makedirs(root)
+
+	def _path(self, device, key):
+		return os.path.join(self.root, re.sub(r'[^A-Za-z0-9.-]', '_', device), re.sub(r'[^A-Za-z0-9.-]', '_', key) + '.ts')
+
+	#=============================================================================================================
+	# Series file of a device and key, opened (and created when create is set) on first use
+	#=============================================================================================================
+	def series(self, device, key, create=True):
+		with self._lock:
+			series = self._files.get((device, key))
+			if series is None:
+				sPath = self._path(device, key)
+				if not os.path.exists(sPath):
+					if not create:
+						return None
+					if not os.path.isdir(os.path.dirname(sPath)):
+						os.makedirs(os.path.dirname(sPath))
+				series = self._files[(device, key)] = SeriesFile(sPath)
+			return series
+
+	def append(self, device, key, times, values):
+		return self.series(device, key).insert(times, values)
+
+	#=============================================================================================================
+	# Latest stored timestamp, where a poll or backfill of the series can resume; None when nothing is stored
+	#=============================================================================================================
+	def last(self, device, key):
+		series = self.series(device, key, create=False)
+		return series.last() if series is not None else None
+
+	def contains(self, device, key, t):
+		series = self.series(device, key, create=False)
+		return series is not None and t in series
+
+	#=============================================================================================================
+	# Samples of a series with start <= time < end as a history.HistorySeries, point is the key
+	#=============================================================================================================
+	def range(self, device, key, start=None, end=None):
+		series = self.series(device, key, create=False)
+		if series is None:
+			return history.HistorySeries(key, array(history.TIME_TYPECODE), array('d'))
+		times, values = series.range(start, end)
+		return history.HistorySeries(key, times, values)
+
+	#=============================================================================================================
+	# Store what the master returns
+	#=============================================================================================================
+	def add_series(self, device, series, key=None):
+		return self.append(device, key or minute_key(series.point), series.times, series.values)
+
+	def add_daily(self, device, record):
+		year = record.year or _year_of(record.month, record.day)
+		day = calendar.timegm((year, record.month, record.day, 0, 0, 0))
+		hourly = record.hourly
+		count = self.append(device, hourly_key(record.point), [day + 3600 * hour for hour in range(len(hourly))], hourly)
+		if record.daily is not None:
+			count += self.append(device, daily_key(record.point), [day], [record.daily])
+		return count
+
+	def add_periods(self, device, block):
+		count = 0
+		for point in range(block.first_point, block.first_point + block.points):
+			count += self.add_series(device, block.series(point), period_key(block.segment, point, block.history_type))
+		return count
+
+	def add_values(self, device, TLP, values, t):
+		count = 0
+		for tlp, value in zip(TLP, values):
+			if isinstance(value, (int, long, float)):
+				count += self.append(device, tlp_key(*tlp), [t], [value])
+		return count
+
+	def flush(self):
+		with self._lock:
+			aFiles = list(self._files.values())
+		for series in aFiles:
+			series.flush()
+
+	def close(self):
+		with self._lock:
+			aFiles, self._files = list(self._files.values()), {}
+		for series in aFiles:
+			series.close()
+
+
+#=============================================================================================================
+# Year of a month/day without one, this year unless that date is still ahead
+#=============================================================================================================
+def _year_of(month, day):
+	today = time.gmtime()
+	if (month, day) > (today.tm_mon, today.tm_mday):
+		return today.tm_year - 1
+	return today.tm_year
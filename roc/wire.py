@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+# -*- coding: utf_8 -*-
+
+
+"""
+ TestKit: Implementation of Fisher ROC protocol in python
+ This is distributed under GNU LGPL license, see license.txt
+
+ Wire tracing through the package logger ("modbus_tk", roc.LOGGER). Raw
+ frames are logged at the TRACE level (below DEBUG), decoded values at
+ DEBUG. Callers check LOGGER.isEnabledFor before logging, and the hex dump
+ is only built when a handler formats the record, so tracing costs one
+ level check per frame while it is off.
+
+ Every link also keeps the last frames it sent and received in a FrameRing,
+ which is logged at DEBUG when a transaction fails.
+"""
+
+
+import time
+import logging
+import binascii
+from collections import deque
+
+
+TRACE = 5
+logging.addLevelName(TRACE, 'TRACE')
+
+LOGGER = logging.getLogger("modbus_tk")
+
+RING_SIZE = 16
+
+
+#*************************************************************************************************************
+# Hex dump of a frame, formatted when it is converted to a string
+#*************************************************************************************************************
+class HexDump(object):
+	__slots__ = ('data',)
+
+	def __init__(self, data):
+		self.data = data
+
+	def __str__(self):
+		sHex = binascii.hexlify(bytes(bytearray(self.data)))
+		return ' '.join(sHex[i:i + 2] for i in xrange(0, len(sHex), 2))
+
+
+#=============================================================================================================
+# Log a frame at TRACE level, direction is 'TX' or 'RX' and name the link it went through
+#=============================================================================================================
+def trace_frame(direction, name, data):
+	if LOGGER.isEnabledFor(TRACE):
+		LOGGER.log(TRACE, '%s %s %s', direction, name, HexDump(bytearray(data)))
+
+
+#*************************************************************************************************************
+# The last frames of a link, oldest first
+#*************************************************************************************************************
+class FrameRing(object):
+
+	def __init__(self, size=RING_SIZE):
+		self._frames = deque(maxlen=size) if size else None
+
+	def __len__(self):
+		return len(self._frames) if self._frames is not None else 0
+
+	#=============================================================================================================
+	# Keep a copy of a frame, data may be a reused receive buffer with bytes past the frame
+	# One copy through a memoryview (bytes() of a memoryview is its repr on python 2).
+	#=============================================================================================================
+	def record(self, direction, data, length=None):
+		if self._frames is not None:
+			self._frames.append((time.time(), direction, memoryview(data)[:length].tobytes()))
+
+	def frames(self):
+		return list(self._frames or ())
+
+	def clear(self):
+		if self._frames is not None:
+			self._frames.clear()
+
+	def __str__(self):
+		aLines = []
+		for when, direction, data in self.frames():
+			aLines.append('%s.%03d %s %s'%(time.strftime('%H:%M:%S', time.localtime(when)), int(when * 1000) % 1000, direction, HexDump(data)))
+		return '\n'.join(aLines)
+
+
+#=============================================================================================================
+# Log the frames of a ring at DEBUG level after a failed transaction
+#=============================================================================================================
+def dump_frames(name, ring, exception):
+	if len(ring) and LOGGER.isEnabledFor(logging.DEBUG):
+		LOGGER.debug('%s failed on %s, last frames:\n%s', exception.__class__.__name__, name, ring)
@@ -0,0 +1,12 @@
+#!/usr/bin/env python
+# -*- coding: utf_8 -*-
+
+
+"""
+ TestKit: Implementation of Fisher ROC protocol in python
+ This is distributed under GNU LGPL license, see license.txt
+
+ Tests, run from the top of the tree with the standard library runner:
+
+	python -m unittest discover -s tests -t .
+"""
@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+# -*- coding: utf_8 -*-
+
+
+"""
+ TestKit: Implementation of Fisher ROC protocol in python
+ This is distributed under GNU LGPL license, see license.txt
+
+ Incremental alarm sync against a simulated device with a small alarm
+ ring, across the end of the ring and across restarts.
+"""
+
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from roc import link
+from roc import alarms
+from roc import roc_tcp
+from roc import simulator
+
+
+class TestAlarmSync(unittest.TestCase):
+
+	def setUp(self):
+		self.root = tempfile.mkdtemp()
+		self.server = simulator.SimulatedRoc().start()
+		self.device = self.server.add_device(240, 240, max_alarms=10)
+		self.manager = link.LinkManager()
+		self.master = roc_tcp.TcpMaster(self.server.host, self.server.port, timeout_in_sec=1.0, link_manager=self.manager)
+		self.count = 0
+
+	def tearDown(self):
+		self.manager.close_all()
+		self.server.stop()
+		shutil.rmtree(self.root)
+
+	def _log(self, number):
+		aTags = []
+		for i in range(number):
+			aTags.append('A%d'%self.count)
+			self.device.add_alarm(aTags[-1], float(self.count))
+			self.count += 1
+		return aTags
+
+	def _sync(self, sync, **kwargs):
+		return [record.tag for record in sync.sync(240, 240, **kwargs)]
+
+	def test_first_sync_records_pointer(self):
+		self._log(4)
+		sync = alarms.AlarmSync(self.master)
+		self.assertEqual(self._sync(sync), [])
+		self.assertEqual(self._sync(sync), [])
+		aTags = self._log(2)
+		self.assertEqual(self._sync(sync), aTags)
+
+	def test_wraparound(self):
+		self._log(6)
+		sync = alarms.AlarmSync(self.master, batch_size=3)
+		self._sync(sync)
+		#pointer 6 to 3 across the end of the 10 record ring
+		aTags = self._log(7)
+		self.assertEqual(self.device.alarm_pointer, 3)
+		self.assertEqual(self._sync(sync), aTags)
+		aTags = self._log(9)
+		self.assertEqual(self._sync(sync), aTags)
+
+	def test_backfill_reads_ring(self):
+		aTags = self._log(13)
+		sync = alarms.AlarmSync(self.master)
+		self.assertEqual(self._sync(sync, backfill=True), aTags[-10:])
+
+	def test_checkpoint_survives_restart(self):
+		sPath = os.path.join(self.root, 'alarms.json')
+		self._log(2)
+		self._sync(alarms.AlarmSync(self.master, alarms.CheckpointStore(sPath)))
+		aTags = self._log(9)
+		self.assertEqual(self._sync(alarms.AlarmSync(self.master, alarms.CheckpointStore(sPath))), aTags)
+		self.assertEqual(self._sync(alarms.AlarmSync(self.master, alarms.CheckpointStore(sPath))), [])
+
+	def test_records(self):
+		self.device.add_alarm('TAG', 12.5, alarm_type=1, alarm_set=1, code=2)
+		batch = self.master.read_alarms(240, 240, 1, 0)
+		self.assertEqual(len(batch), 1)
+		record = batch[0]
+		self.assertEqual((record.tag, record.value, record.type, record.set, record.code), ('TAG', 12.5, 'Sensor DP', 'Alarm Set', 'High Alarm'))
+		self.assertEqual(self.master.opcode121(240, 240, 1, 0)['alarms'][0]['value'], '12.5')
+
+
+if __name__ == '__main__':
+	unittest.main()
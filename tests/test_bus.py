@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+# -*- coding: utf_8 -*-
+
+
+"""
+ TestKit: Implementation of Fisher ROC protocol in python
+ This is distributed under GNU LGPL license, see license.txt
+
+ Bus arbitration between devices on one link, and responses routed by
+ header past a late answer of another device.
+"""
+
+
+import time
+import socket
+import threading
+import unittest
+
+from roc import bus
+from roc import codec
+from roc import link
+from roc import roc_tcp
+from roc import simulator
+from roc.errors import TimeoutError
+
+
+#*************************************************************************************************************
+# Stands in for a Link, counts how often it is held
+#*************************************************************************************************************
+class _Link(object):
+
+	def __init__(self):
+		self.held = 0
+
+	def __enter__(self):
+		self.held += 1
+		return self
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		self.held -= 1
+		return False
+
+
+def _wait(condition, timeout=2.0):
+	end = time.time() + timeout
+	while not condition():
+		if time.time() > end:
+			raise AssertionError('timed out waiting')
+		time.sleep(0.005)
+
+
+class TestBus(unittest.TestCase):
+
+	def test_round_robin_between_devices(self):
+		line = bus.Bus(_Link())
+		aOrder = []
+
+		def transact(device):
+			with line.turn(*device):
+				aOrder.append(device)
+
+		line.acquire((1, 1))
+		aThreads = []
+		for device, waiting in (((1, 1), 1), ((1, 1), 2), ((1, 1), 3), ((2, 1), 1), ((3, 1), 1)):
+			thread = threading.Thread(target=transact, args=(device,))
+			thread.start()
+			aThreads.append(thread)
+			#queue in a known order
+			_wait(lambda: line.pending().get(device) == waiting)
+		line.release()
+		for thread in aThreads:
+			thread.join(2.0)
+		#a device with a backlog takes one turn, then goes to the back of the line
+		self.assertEqual(aOrder, [(1, 1), (2, 1), (3, 1), (1, 1), (1, 1)])
+		self.assertEqual(line.served(), {(1, 1): 4, (2, 1): 1, (3, 1): 1})
+		self.assertEqual(line.link.held, 0)
+		self.assertEqual(line.pending(), {})
+
+	def test_one_bus_per_link(self):
+		first = _Link()
+		self.assertTrue(bus.get(first) is bus.get(first))
+		self.assertFalse(bus.get(first) is bus.get(_Link()))
+
+	def test_masters_share_the_line(self):
+		server = simulator.SimulatedRoc().start()
+		for address in (240, 241, 242):
+			server.add_device(address, 240)
+		manager = link.LinkManager()
+		master = roc_tcp.TcpMaster(server.host, server.port, timeout_in_sec=1.0, link_manager=manager, bus=True)
+		aErrors = []
+
+		def poll(address):
+			for i in range(30):
+				try:
+					if master.opcode180(address, 240, [(1, 0, address)], ['f']) != (10000.0 + address,):
+						aErrors.append(address)
+				except Exception as ex:
+					aErrors.append(ex)
+
+		aThreads = [threading.Thread(target=poll, args=(address,)) for address in (240, 241, 242)]
+		try:
+			for thread in aThreads:
+				thread.start()
+			for thread in aThreads:
+				thread.join(10.0)
+		finally:
+			manager.close_all()
+			server.stop()
+		self.assertEqual(aErrors, [])
+		self.assertEqual(sorted(master._bus.served().values()), [30, 30, 30])
+
+
+#*************************************************************************************************************
+# A late answer of one device arrives just before the answer of the next
+#*************************************************************************************************************
+class TestHeaderRouting(unittest.TestCase):
+
+	def setUp(self):
+		self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+		self.listener.bind(('127.0.0.1', 0))
+		self.listener.listen(1)
+		self.link = link.Link('127.0.0.1', self.listener.getsockname()[1])
+		self.conn = None
+
+	def tearDown(self):
+		self.link.close()
+		if self.conn is not None:
+			self.conn.close()
+		self.listener.close()
+
+	def _request(self, address):
+		return codec.encode_frame(address, 240, 1, 3, 120, '')
+
+	def _response(self, address, body):
+		return codec.encode_frame(1, 3, address, 240, 120, body)
+
+	def test_late_answer_skipped(self):
+		self.link.send(self._request(240))
+		self.conn = self.listener.accept()[0]
+		self.conn.settimeout(1.0)
+		self.conn.recv(codec.MAX_FRAME_LENGTH)
+		self.assertRaises(TimeoutError, self.link.recv, 0.1, bytes(bytearray((1, 3, 240, 240))))
+
+		self.link.send(self._request(241))
+		self.conn.recv(codec.MAX_FRAME_LENGTH)
+		late = self._response(240, bytearray(8))
+		response = self._response(241, bytearray([1, 2, 3]))
+		self.conn.sendall(late + response)
+		frame = codec.decode_frame(self.link.recv(1.0, bytes(bytearray((1, 3, 241, 240)))))
+		self.assertEqual(bytearray(frame.data), bytearray([1, 2, 3]))
+		self.assertEqual(self.link.discarded, len(late))
+		self.assertEqual(self.link.connects, 1)
+
+
+if __name__ == '__main__':
+	unittest.main()
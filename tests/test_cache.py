@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+# -*- coding: utf_8 -*-
+
+
+"""
+ TestKit: Implementation of Fisher ROC protocol in python
+ This is distributed under GNU LGPL license, see license.txt
+
+ Read-through TLP cache: hits, partial hits, time to live, eviction and
+ invalidation by opcode 181 writes.
+"""
+
+
+import time
+import unittest
+
+from roc import codec
+from roc import link
+from roc import cache
+from roc import points
+from roc import roc_tcp
+from roc import simulator
+
+
+class TestTlpCache(unittest.TestCase):
+
+	def test_lookup_and_store(self):
+		tlp_cache = cache.TlpCache(default_ttl=60)
+		point_set = points.compile_points([[1, 0, 1], [1, 0, 2]], ['f', 'f'])
+		self.assertEqual(tlp_cache.lookup('roc', point_set), [None, None])
+		tlp_cache.store('roc', point_set, (1.0, 2.0))
+		self.assertEqual(tlp_cache.lookup('roc', point_set), [(1.0,), (2.0,)])
+		self.assertEqual(tlp_cache.lookup('other', point_set), [None, None])
+		#another format for the same parameter is a miss
+		self.assertEqual(tlp_cache.lookup('roc', points.compile_points([[1, 0, 1]], ['B'])), [None])
+
+	def test_eviction(self):
+		tlp_cache = cache.TlpCache(default_ttl=60, max_entries=3)
+		for p in range(5):
+			tlp_cache.store('roc', points.compile_points([[1, 0, p]], ['f']), (float(p),))
+		self.assertEqual(len(tlp_cache), 3)
+		self.assertEqual(tlp_cache.lookup('roc', points.compile_points([[1, 0, 0], [1, 0, 4]], ['f', 'f'])), [None, (4.0,)])
+
+	def test_ttl_by_type(self):
+		tlp_cache = cache.TlpCache(ttls={12: 0, 2: 0.05}, default_ttl=60)
+		point_set = points.compile_points([[12, 0, 1], [2, 0, 1], [1, 0, 1]], ['B', 'f', 'f'])
+		tlp_cache.store('roc', point_set, (1, 2.0, 3.0))
+		self.assertEqual(tlp_cache.lookup('roc', point_set), [None, (2.0,), (3.0,)])
+		time.sleep(0.06)
+		self.assertEqual(tlp_cache.lookup('roc', point_set), [None, None, (3.0,)])
+
+
+class TestCachedMaster(unittest.TestCase):
+
+	def setUp(self):
+		self.server = simulator.SimulatedRoc().start()
+		self.device = self.server.add_device(240, 240)
+		self.manager = link.LinkManager()
+		self.cache = cache.TlpCache(ttls={12: 0}, default_ttl=60)
+		self.master = roc_tcp.TcpMaster(self.server.host, self.server.port, timeout_in_sec=1.0, link_manager=self.manager, cache=self.cache)
+
+	def tearDown(self):
+		self.manager.close_all()
+		self.server.stop()
+
+	def _requests(self):
+		return self.server.stats['requests']
+
+	def _last_request_count(self):
+		#data byte 0 of the last opcode 180 request is its number of TLPs
+		aSent = [data for when, direction, data in self.master._link.frames.frames() if direction == 'TX']
+		return ord(aSent[-1][codec.HEADER_LENGTH])
+
+	def test_hit(self):
+		TLP = [(1, 0, 1), (1, 0, 2)]
+		self.assertEqual(self.master.opcode180(240, 240, TLP, ['f', 'f']), (10001.0, 10002.0))
+		self.assertEqual(self.master.opcode180(240, 240, TLP, ['f', 'f']), (10001.0, 10002.0))
+		self.assertEqual(self._requests(), 1)
+
+	def test_partial_hit_fetches_missing_only(self):
+		self.master.opcode180(240, 240, [(1, 0, 1), (1, 0, 3)], ['f', 'f'])
+		values = self.master.opcode180(240, 240, [(1, 0, 1), (1, 0, 2), (1, 0, 3), (1, 0, 4)], ['f'] * 4)
+		self.assertEqual(values, (10001.0, 10002.0, 10003.0, 10004.0))
+		self.assertEqual(self._requests(), 2)
+		self.assertEqual(self._last_request_count(), 2)
+
+	def test_uncached_type(self):
+		self.master.opcode180(240, 240, [(12, 0, 3)], ['B'])
+		self.master.opcode180(240, 240, [(12, 0, 3)], ['B'])
+		self.assertEqual(self._requests(), 2)
+
+	def test_write_invalidates(self):
+		TLP = [(1, 0, 1), (1, 0, 2)]
+		self.master.opcode180(240, 240, TLP, ['f', 'f'])
+		self.master.opcode181(240, 240, [(1, 0, 2)], ['f'], [5.5])
+		self.assertEqual(self.master.opcode180(240, 240, TLP, ['f', 'f']), (10001.0, 5.5))
+		#only the written point was read again
+		self.assertEqual(self._last_request_count(), 1)
+		self.assertEqual(self.master.opcode180(240, 240, TLP, ['f', 'f']), (10001.0, 5.5))
+		self.assertEqual(self._requests(), 3)
+
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+# -*- coding: utf_8 -*-
+
+
+"""
+ TestKit: Implementation of Fisher ROC protocol in python
+ This is distributed under GNU LGPL license, see license.txt
+
+ Short responses decoded from a reused frame buffer must fail, not read
+ the bytes left by the previous frame.
+"""
+
+
+import unittest
+
+from roc import codec
+from roc import history
+from roc import roc_tcp
+from roc.errors import OpcodeError
+
+
+#=============================================================================================================
+# A frame with body, written over a longer frame of 0x40 bytes as FrameReader does
+#=============================================================================================================
+def _reused(opcode, body):
+	buf = codec.encode_frame(1, 3, 240, 240, opcode, bytearray([0x40] * 240))
+	short = codec.encode_frame(1, 3, 240, 240, opcode, body)
+	buf[:len(short)] = short
+	return codec.decode_frame(buf)
+
+
+class TestShortResponses(unittest.TestCase):
+
+	def test_byte_bounds(self):
+		frame = _reused(120, bytearray([7, 8]))
+		self.assertEqual((frame.byte(0), frame.byte(1)), (7, 8))
+		self.assertRaises(RuntimeError, frame.byte, 2)
+
+	def test_unpack_bounds(self):
+		frame = _reused(120, bytearray(4))
+		self.assertEqual(frame.unpack_from('<HH'), (0, 0))
+		self.assertRaises(RuntimeError, frame.unpack_from, '<HHH')
+		self.assertRaises(RuntimeError, frame.unpack_from, '<H', 3)
+
+	def test_opcode120(self):
+		self.assertRaises(RuntimeError, roc_tcp.RocMaster()._decode120, _reused(120, bytearray(4)))
+
+	def test_opcode126(self):
+		self.assertRaises(RuntimeError, history.decode_minutes, _reused(126, bytearray([1, 0])), 1, None)
+
+	def test_opcode128(self):
+		self.assertRaises(RuntimeError, history.decode_daily, _reused(128, bytearray([1, 9])), 1, 9)
+		record = history.decode_daily(_reused(128, bytearray([1, 9, 1]) + bytearray(8)), 1, 9)
+		self.assertEqual(list(record.values), [0.0, 0.0])
+
+	def test_short_error_response(self):
+		frame = _reused(codec.ERROR_OPCODE, bytearray([21]))
+		try:
+			frame.check(1, 3, 240, 240, 17)
+		except OpcodeError as ex:
+			self.assertEqual(ex.code, 21)
+		else:
+			self.fail('no OpcodeError')
+
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+# -*- coding: utf_8 -*-
+
+
+"""
+ TestKit: Implementation of Fisher ROC protocol in python
+ This is distributed under GNU LGPL license, see license.txt
+
+ RTT estimator and circuit breakers of DeviceHealth.
+"""
+
+
+import time
+import unittest
+
+from roc import health
+from roc.errors import DeviceUnavailable
+
+
+class TestRttEstimator(unittest.TestCase):
+
+	def test_first_sample(self):
+		estimator = health.RttEstimator()
+		self.assertEqual(estimator.timeout(5.0, 0.2, 5.0), 5.0)
+		estimator.observe(0.4)
+		self.assertEqual((estimator.srtt, estimator.rttvar), (0.4, 0.2))
+		self.assertAlmostEqual(estimator.timeout(5.0, 0.2, 5.0), 1.2)
+
+	def test_smoothing_and_bounds(self):
+		estimator = health.RttEstimator()
+		for i in range(50):
+			estimator.observe(0.01)
+		self.assertAlmostEqual(estimator.srtt, 0.01)
+		#never below min_timeout
+		self.assertEqual(estimator.timeout(5.0, 0.2, 5.0), 0.2)
+		estimator.observe(10.0)
+		self.assertEqual(estimator.timeout(5.0, 0.2, 5.0), 5.0)
+
+	def test_backoff(self):
+		estimator = health.RttEstimator()
+		estimator.observe(1.0)
+		estimator.backoff()
+		self.assertEqual(estimator.rttvar, 1.0)
+		estimator.backoff()
+		self.assertEqual(estimator.rttvar, 2.0)
+
+
+class TestDeviceHealth(unittest.TestCase):
+
+	def setUp(self):
+		self.health = health.DeviceHealth(min_timeout=0.1, failures=3, probe_interval=0.05, max_probe_interval=0.2)
+
+	def _open(self, device='roc'):
+		for i in range(3):
+			self.health.allow(device)
+			self.health.failure(device, 180)
+		self.assertEqual(self.health.state(device), health.OPEN)
+
+	def test_timeout_per_opcode(self):
+		self.assertEqual(self.health.timeout('roc', 180, 5.0), 5.0)
+		self.health.success('roc', 180, 0.2)
+		self.assertAlmostEqual(self.health.timeout('roc', 180, 5.0), 0.6)
+		self.assertEqual(self.health.timeout('roc', 120, 5.0), 5.0)
+		self.assertEqual(self.health.timeout('other', 180, 5.0), 5.0)
+
+	def test_opens_after_failures(self):
+		self.health.failure('roc', 180)
+		self.health.failure('roc', 180)
+		self.assertEqual(self.health.state('roc'), health.CLOSED)
+		self.health.allow('roc')
+		self.health.failure('roc', 180)
+		self.assertRaises(DeviceUnavailable, self.health.allow, 'roc')
+		#other devices are not affected
+		self.health.allow('other')
+
+	def test_success_resets_failures(self):
+		self.health.failure('roc', 180)
+		self.health.failure('roc', 180)
+		self.health.success('roc', 180)
+		self.health.failure('roc', 180)
+		self.assertEqual(self.health.state('roc'), health.CLOSED)
+
+	def test_probe_closes(self):
+		self._open()
+		time.sleep(0.06)
+		self.health.allow('roc')
+		self.assertEqual(self.health.state('roc'), health.HALF_OPEN)
+		#only one probe at a time
+		self.assertRaises(DeviceUnavailable, self.health.allow, 'roc')
+		self.health.success('roc', 180, 0.01)
+		self.assertEqual(self.health.state('roc'), health.CLOSED)
+		self.health.allow('roc')
+
+	def test_failed_probe_doubles_interval(self):
+		self._open()
+		time.sleep(0.06)
+		self.health.allow('roc')
+		self.health.failure('roc', 180)
+		self.assertEqual(self.health.state('roc'), health.OPEN)
+		self.assertEqual(self.health._breakers['roc'].interval, 0.1)
+		time.sleep(0.06)
+		self.assertRaises(DeviceUnavailable, self.health.allow, 'roc')
+
+	def test_unfinished_probe_does_not_lock_out(self):
+		self._open()
+		time.sleep(0.06)
+		#the probe ends with neither success nor failure recorded
+		self.health.allow('roc')
+		self.assertRaises(DeviceUnavailable, self.health.allow, 'roc')
+		time.sleep(0.06)
+		self.health.allow('roc')
+		self.assertEqual(self.health.state('roc'), health.HALF_OPEN)
+
+	def test_reset(self):
+		self._open()
+		self.health.reset('roc')
+		self.health.allow('roc')
+		self.assertEqual(self.health.snapshot(), {})
+
+
+if __name__ == '__main__':
+	unittest.main()
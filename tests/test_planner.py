@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+# -*- coding: utf_8 -*-
+
+
+"""
+ TestKit: Implementation of Fisher ROC protocol in python
+ This is distributed under GNU LGPL license, see license.txt
+
+ Opcode 180 read planner: frame limits, duplicates, opcode 167 runs and
+ read_points against the simulator.
+"""
+
+
+import unittest
+
+from roc import codec
+from roc import link
+from roc import planner
+from roc import roc_tcp
+from roc import simulator
+
+
+def _floats(count, t=1, l=0):
+	return [(t, l, p, 'f') for p in range(count)]
+
+
+class TestPlanReads(unittest.TestCase):
+
+	def _check_limits(self, plan):
+		for batch in plan.batches:
+			self.assertTrue(batch.request_length() <= codec.MAX_DATA_LENGTH)
+			self.assertTrue(batch.response_length <= codec.MAX_DATA_LENGTH)
+			self.assertTrue(len(batch.points) <= planner.MAX_POINTS)
+
+	def test_floats_fill_responses(self):
+		#a float costs 7 response bytes, 36 fit after the count byte
+		plan = planner.plan_reads(_floats(100))
+		self._check_limits(plan)
+		self.assertEqual(sorted(len(batch.points) for batch in plan.batches), [28, 36, 36])
+
+	def test_bytes_limited_by_response(self):
+		plan = planner.plan_reads([(12, 0, p, 'B') for p in range(200)])
+		self._check_limits(plan)
+		self.assertEqual(len(plan), 4)
+		self.assertEqual(max(len(batch.points) for batch in plan.batches), 63)
+
+	def test_mixed_sizes_first_fit(self):
+		aPoints = [(1, 0, p, '20c') for p in range(10)] + [(12, 0, p, 'B') for p in range(30)]
+		plan = planner.plan_reads(aPoints)
+		self._check_limits(plan)
+		#230 bytes of strings, 120 of bytes: two responses
+		self.assertEqual(len(plan), 2)
+
+	def test_order_kept_in_batches(self):
+		aPoints = [(1, 0, 5, 'f'), (12, 0, 1, 'B'), (1, 0, 2, 'f')]
+		plan = planner.plan_reads(aPoints)
+		self.assertEqual(len(plan), 1)
+		self.assertEqual(plan.batches[0].TLP, [[1, 0, 5], [12, 0, 1], [1, 0, 2]])
+
+	def test_duplicates_read_once(self):
+		aPoints = [(1, 0, 1, 'f'), (1, 0, 2, 'f'), (1, 0, 1, 'f')]
+		plan = planner.plan_reads(aPoints)
+		self.assertEqual(plan.batches[0].TLP, [[1, 0, 1], [1, 0, 2]])
+		self.assertEqual(plan.merge([(10.0, 20.0)]), [10.0, 20.0, 10.0])
+
+	def test_merge_across_batches(self):
+		aPoints = _floats(40)
+		plan = planner.plan_reads(aPoints)
+		aResults = [[float(aPoints[i][2]) for i in batch.points] for batch in plan.batches]
+		self.assertEqual(plan.merge(aResults), [float(p) for p in range(40)])
+
+	def test_string_merge(self):
+		plan = planner.plan_reads([(1, 0, 1, '3c'), (1, 0, 2, 'f')])
+		self.assertEqual(plan.merge([('a', 'b', 'c', 1.5)]), [('a', 'b', 'c'), 1.5])
+
+	def test_too_large(self):
+		self.assertRaises(ValueError, planner.plan_reads, [(1, 0, 1, '252c')])
+
+	def test_runs_as_blocks(self):
+		aPoints = _floats(5) + [(1, 1, 7, 'f'), (1, 1, 8, 'f'), (2, 0, 0, 'f')]
+		plan = planner.plan_reads(aPoints, min_run=3)
+		aBlocks = [batch for batch in plan.batches if batch.start is not None]
+		self.assertEqual([(batch.start, len(batch.points)) for batch in aBlocks], [(0, 5)])
+		self.assertEqual(sum(len(batch.points) for batch in plan.batches), 8)
+
+	def test_long_run_split(self):
+		plan = planner.plan_reads(_floats(100), min_run=3)
+		self.assertTrue(all(batch.start is not None for batch in plan.batches))
+		self.assertTrue(all(batch.response_length <= codec.MAX_DATA_LENGTH for batch in plan.batches))
+		self.assertEqual([batch.start for batch in plan.batches], [0, 62])
+
+	def test_parameter_with_two_formats_not_in_block(self):
+		aPoints = _floats(4) + [(1, 0, 1, 'B')]
+		plan = planner.plan_reads(aPoints, min_run=3)
+		aBlocks = [batch for batch in plan.batches if batch.start is not None]
+		self.assertEqual([batch.TLP for batch in aBlocks], [])
+
+
+class TestReadPoints(unittest.TestCase):
+
+	def setUp(self):
+		self.server = simulator.SimulatedRoc().start()
+		self.device = self.server.add_device(240, 240)
+		self.manager = link.LinkManager()
+		self.master = roc_tcp.TcpMaster(self.server.host, self.server.port, timeout_in_sec=1.0, link_manager=self.manager)
+
+	def tearDown(self):
+		self.manager.close_all()
+		self.server.stop()
+
+	def _expected(self, aPoints):
+		return [self.device.value(t, l, p) for t, l, p, fmt in aPoints]
+
+	def test_many_points(self):
+		aPoints = _floats(60) + [(12, 0, p, 'B') for p in range(3)] + _floats(3)
+		self.assertEqual(self.master.read_points(240, 240, aPoints), self._expected(aPoints))
+		self.assertEqual(self.server.stats['requests'], 2)
+
+	def test_blocks_same_values(self):
+		aPoints = _floats(60, t=2) + [(3, 0, 9, 'f')]
+		self.assertEqual(self.master.read_points(240, 240, aPoints, blocks=True), self._expected(aPoints))
+		self.assertEqual(self.master.read_points(240, 240, aPoints, blocks=False), self._expected(aPoints))
+
+
+if __name__ == '__main__':
+	unittest.main()
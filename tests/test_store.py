@@ -0,0 +1,192 @@
+#!/usr/bin/env python
+# -*- coding: utf_8 -*-
+
+
+"""
+ TestKit: Implementation of Fisher ROC protocol in python
+ This is distributed under GNU LGPL license, see license.txt
+
+ SeriesFile append, merge, dedupe and growth, and DailyBackfill resuming
+ from a TimeSeriesStore.
+"""
+
+
+import os
+import shutil
+import datetime
+import tempfile
+import threading
+import unittest
+from array import array
+
+from roc import store
+from roc import history
+from roc import backfill
+
+
+#*************************************************************************************************************
+# SeriesFile
+#*************************************************************************************************************
+class TestSeriesFile(unittest.TestCase):
+
+	def setUp(self):
+		self.root = tempfile.mkdtemp()
+		self.path = os.path.join(self.root, 'series.ts')
+		self.series = store.SeriesFile(self.path)
+
+	def tearDown(self):
+		self.series.close()
+		shutil.rmtree(self.root)
+
+	def _samples(self, start=None, end=None):
+		times, values = self.series.range(start, end)
+		return zip(list(times), list(values))
+
+	def test_append(self):
+		self.assertEqual(self.series.insert([10, 20, 30], [1.0, 2.0, 3.0]), 3)
+		self.assertEqual(self.series.insert([40], [4.0]), 1)
+		self.assertEqual(self._samples(), [(10, 1.0), (20, 2.0), (30, 3.0), (40, 4.0)])
+		self.assertEqual((self.series.first(), self.series.last()), (10, 40))
+
+	def test_merge_older_samples(self):
+		self.series.insert([10, 30, 50], [1.0, 3.0, 5.0])
+		self.assertEqual(self.series.insert([40, 20, 60], [4.0, 2.0, 6.0]), 3)
+		self.assertEqual(self._samples(), [(10, 1.0), (20, 2.0), (30, 3.0), (40, 4.0), (50, 5.0), (60, 6.0)])
+		self.assertTrue(20 in self.series)
+		self.assertFalse(25 in self.series)
+
+	def test_dedupe(self):
+		self.series.insert([10, 20, 30], [1.0, 2.0, 3.0])
+		#stored timestamps keep their first value, repeats within one insert count once
+		self.assertEqual(self.series.insert([20, 30, 30, 40, 40], [9.0, 9.0, 9.0, 4.0, 8.0]), 1)
+		self.assertEqual(len(self.series), 4)
+		self.assertEqual(self._samples()[:3], [(10, 1.0), (20, 2.0), (30, 3.0)])
+		self.assertEqual(self._samples()[3][0], 40)
+		self.assertEqual(self.series.insert([10, 20], [0.0, 0.0]), 0)
+
+	def test_growth_and_reopen(self):
+		count = store.GROW_RECORDS * 2 + 10
+		self.series.insert(range(0, count * 2, 2), [float(i) for i in range(count)])
+		self.assertTrue(self.series.capacity >= count)
+		#an older sample merged into a grown file
+		self.assertEqual(self.series.insert([1], [0.5]), 1)
+		self.series.close()
+		self.series = store.SeriesFile(self.path)
+		self.assertEqual(len(self.series), count + 1)
+		self.assertEqual(self._samples(0, 5), [(0, 0.0), (1, 0.5), (2, 1.0), (4, 2.0)])
+		self.assertEqual(self.series.last(), (count - 1) * 2)
+
+	def test_readers_during_growth(self):
+		aErrors = []
+		done = threading.Event()
+
+		def read():
+			while not done.is_set():
+				try:
+					last = self.series.last()
+					if last is not None and last not in self.series:
+						aErrors.append(last)
+				except Exception as ex:
+					aErrors.append(ex)
+
+		reader = threading.Thread(target=read)
+		reader.start()
+		try:
+			for start in range(0, store.GROW_RECORDS * 4, 256):
+				self.series.insert(range(start, start + 256), [0.0] * 256)
+		finally:
+			done.set()
+			reader.join()
+		self.assertEqual(aErrors, [])
+		self.assertEqual(len(self.series), store.GROW_RECORDS * 4)
+
+	def test_range(self):
+		self.series.insert([10, 20, 30, 40], [1.0, 2.0, 3.0, 4.0])
+		self.assertEqual(self._samples(20, 40), [(20, 2.0), (30, 3.0)])
+		self.assertEqual(self._samples(None, 20), [(10, 1.0)])
+		self.assertEqual(self._samples(35, None), [(40, 4.0)])
+		self.assertEqual(self._samples(40, 20), [])
+
+	def test_not_a_series_file(self):
+		sPath = os.path.join(self.root, 'other.ts')
+		with open(sPath, 'wb') as f:
+			f.write('x' * 64)
+		self.assertRaises(ValueError, store.SeriesFile, sPath)
+
+
+#*************************************************************************************************************
+# TimeSeriesStore keys
+#*************************************************************************************************************
+class TestTimeSeriesStore(unittest.TestCase):
+
+	def setUp(self):
+		self.root = tempfile.mkdtemp()
+		self.store = store.TimeSeriesStore(self.root)
+
+	def tearDown(self):
+		self.store.close()
+		shutil.rmtree(self.root)
+
+	def _block(self, segment, base, history_type=history.PERIODIC):
+		times = array(history.TIME_TYPECODE, [3600, 7200])
+		return history.PeriodBlock(segment, 0, 2, 1, 2, times, array('d', [base, base + 1, base + 2, base + 3]), history_type)
+
+	def test_periods_keyed_by_segment_and_type(self):
+		self.assertEqual(self.store.add_periods('roc', self._block(0, 10.0)), 4)
+		self.assertEqual(self.store.add_periods('roc', self._block(3, 20.0)), 4)
+		self.assertEqual(self.store.add_periods('roc', self._block(0, 30.0, history.MINUTE)), 4)
+		self.assertEqual(list(self.store.range('roc', store.period_key(0, 1)).values), [10.0, 12.0])
+		self.assertEqual(list(self.store.range('roc', store.period_key(3, 1)).values), [20.0, 22.0])
+		self.assertEqual(list(self.store.range('roc', store.period_key(3, 2)).values), [21.0, 23.0])
+		self.assertEqual(list(self.store.range('roc', store.period_key(0, 1, history.MINUTE)).values), [30.0, 32.0])
+		#opcode 128 hourly values have a series of their own
+		self.assertEqual(self.store.last('roc', store.hourly_key(1)), None)
+
+
+#*************************************************************************************************************
+# DailyBackfill over a store
+#*************************************************************************************************************
+class _DailyMaster(object):
+
+	def __init__(self, values):
+		self.values = values
+		self.requests = []
+
+	def opcode128(self, address, group, point, day, month, year=None):
+		self.requests.append((point, year, month, day))
+		return history.DailyRecord(point, month, day, list(self.values), year)
+
+	def _chain(self, result, fn, *args):
+		return fn(result, *args)
+
+
+class TestDailyBackfill(unittest.TestCase):
+
+	def setUp(self):
+		self.root = tempfile.mkdtemp()
+		self.store = store.TimeSeriesStore(self.root)
+
+	def tearDown(self):
+		self.store.close()
+		shutil.rmtree(self.root)
+
+	def _run(self, master):
+		fill = backfill.DailyBackfill(master, 240, 240, [1, 2], datetime.date(2026, 9, 1), datetime.date(2026, 9, 3), store=self.store, device='roc')
+		return list(fill)
+
+	def test_resume_skips_stored_days(self):
+		master = _DailyMaster([float(i) for i in range(history.DAILY_INDEX + 1)])
+		self.assertEqual(len(self._run(master)), 6)
+		self.assertEqual(self._run(master), [])
+		self.assertEqual(len(master.requests), 6)
+
+	def test_resume_without_daily_value(self):
+		master = _DailyMaster([float(i) for i in range(24)])
+		self.assertEqual(len(self._run(master)), 6)
+		self.assertEqual(self.store.last('roc', store.daily_key(1)), None)
+		self.assertEqual(self._run(master), [])
+		self.assertEqual(len(master.requests), 6)
+
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,208 @@
+#!/usr/bin/env python
+# -*- coding: utf_8 -*-
+
+
+"""
+ TestKit: Implementation of Fisher ROC protocol in python
+ This is distributed under GNU LGPL license, see license.txt
+
+ Round trips over every link transport against the simulator, response
+ routing by header through line noise, and recovery of the UDP and serial
+ links.
+"""
+
+
+import os
+import pty
+import socket
+import unittest
+
+from roc import codec
+from roc import link
+from roc import roc_tcp
+from roc import simulator
+from roc.errors import TimeoutError
+
+
+ADDRESS = 240
+GROUP = 240
+
+#what a master with the default host address and group expects back from ADDRESS, GROUP
+HEADER = bytes(bytearray((1, 3, ADDRESS, GROUP)))
+
+
+def _request(opcode=120, body=''):
+	return codec.encode_frame(ADDRESS, GROUP, 1, 3, opcode, body)
+
+
+def _response(opcode=120, body='', address=ADDRESS):
+	return codec.encode_frame(1, 3, address, GROUP, opcode, body)
+
+
+#*************************************************************************************************************
+# TcpMaster over each transport against a SimulatedRoc
+#*************************************************************************************************************
+class TestRoundTrip(unittest.TestCase):
+
+	def _round_trip(self, transport):
+		server = simulator.SimulatedRoc(transport=transport)
+		server.add_device(ADDRESS, GROUP)
+		server.add_device(ADDRESS + 1, GROUP)
+		with server:
+			manager = link.LinkManager()
+			master = roc_tcp.TcpMaster(server.host, server.port, timeout_in_sec=1.0, link_manager=manager, transport=transport)
+			try:
+				for i in range(20):
+					self.assertEqual(master.opcode180(ADDRESS, GROUP, [(12, 0, 3), (12, 0, 4)], ['B', 'B']), (17, 10))
+				self.assertEqual(master.opcode180(ADDRESS + 1, GROUP, [(12, 0, 3)], ['B']), (17,))
+				self.assertEqual(master.opcode120(ADDRESS, GROUP)['max_alarms'], 240)
+				#nobody answers at this address, the link stays up
+				master.set_timeout(0.2)
+				self.assertRaises(TimeoutError, master.opcode120, ADDRESS + 2, GROUP)
+				master.set_timeout(1.0)
+				self.assertEqual(master.opcode180(ADDRESS, GROUP, [(12, 0, 3)], ['B']), (17,))
+				self.assertEqual(master._link.connects, 1)
+			finally:
+				manager.close_all()
+		return master
+
+	def test_tcp(self):
+		self.assertEqual(self._round_trip('tcp')._link.name[:4], '127.')
+
+	def test_udp(self):
+		self.assertTrue(isinstance(self._round_trip('udp')._link, link.UdpLink))
+
+	@unittest.skipIf(link.termios is None, 'serial links need termios')
+	def test_serial(self):
+		self.assertTrue(isinstance(self._round_trip('serial')._link, link.SerialLink))
+
+	def test_unknown_transport(self):
+		self.assertRaises(ValueError, link.LinkManager().get, '127.0.0.1', 4000, 'ipx')
+
+
+#*************************************************************************************************************
+# FrameReader.read_frame_for
+#*************************************************************************************************************
+class TestResync(unittest.TestCase):
+
+	def setUp(self):
+		self.master, self.slave = socket.socketpair()
+		self.reader = codec.FrameReader(self.master)
+
+	def tearDown(self):
+		self.master.close()
+		self.slave.close()
+
+	def test_noise_and_corrupted_frame(self):
+		good = _response(120, bytearray(range(20)))
+		corrupted = _response(120, bytearray(20))
+		corrupted[codec.HEADER_LENGTH + 3] ^= 0xff
+		other = _response(120, bytearray(5), address=ADDRESS + 1)
+		noise = bytearray('\x00\xff\x01' + HEADER[:3] + '\x55')
+		self.slave.sendall(noise + corrupted + other + good)
+		frame = codec.decode_frame(self.reader.read_frame_for(HEADER, 1.0))
+		self.assertEqual(frame.address, ADDRESS)
+		self.assertEqual(bytearray(frame.data), bytearray(range(20)))
+		self.assertEqual(self.reader.discarded, len(noise) + len(corrupted) + len(other))
+
+	def test_header_split_across_reads(self):
+		good = _response(120, bytearray(3))
+		self.slave.sendall(bytearray('\x07\x07') + good[:2])
+		self.assertRaises(TimeoutError, self.reader.read_frame_for, HEADER, 0.1)
+		self.slave.sendall(good[2:])
+		self.assertEqual(bytearray(self.reader.read_frame_for(HEADER, 1.0)[:len(good)]), good)
+
+	def test_timeout_without_frame(self):
+		self.slave.sendall(bytearray(_response(120, bytearray(3), address=ADDRESS + 1)))
+		self.assertRaises(TimeoutError, self.reader.read_frame_for, HEADER, 0.1)
+
+
+#*************************************************************************************************************
+# UdpLink against a bare datagram socket standing in for the device
+#*************************************************************************************************************
+class TestUdpLink(unittest.TestCase):
+
+	def setUp(self):
+		self.device = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+		self.device.bind(('127.0.0.1', 0))
+		self.device.settimeout(1.0)
+		self.link = link.UdpLink('127.0.0.1', self.device.getsockname()[1])
+
+	def tearDown(self):
+		self.link.close()
+		self.device.close()
+
+	def test_dropped_datagram(self):
+		self.link.send(_request())
+		self.device.recvfrom(codec.MAX_FRAME_LENGTH)
+		#no answer: a timeout, the link stays open
+		self.assertRaises(TimeoutError, self.link.recv, 0.2, HEADER)
+		self.assertTrue(self.link.is_open())
+
+		self.link.send(_request())
+		data, peer = self.device.recvfrom(codec.MAX_FRAME_LENGTH)
+		self.assertEqual(bytearray(data), _request())
+		response = _response(120, bytearray(4))
+		self.device.sendto(response, peer)
+		self.assertEqual(bytearray(self.link.recv(1.0, HEADER)[:len(response)]), response)
+		self.assertEqual(self.link.connects, 1)
+
+	def test_late_datagram_dropped(self):
+		self.link.send(_request())
+		data, peer = self.device.recvfrom(codec.MAX_FRAME_LENGTH)
+		self.assertRaises(TimeoutError, self.link.recv, 0.1, HEADER)
+		#the answer to the first request comes after its timeout
+		self.device.sendto(_response(120, bytearray(1)), peer)
+		self.link.send(_request())
+		self.device.recvfrom(codec.MAX_FRAME_LENGTH)
+		response = _response(120, bytearray(2))
+		self.device.sendto(response, peer)
+		self.assertEqual(bytearray(self.link.recv(1.0, HEADER)[:len(response)]), response)
+
+
+#*************************************************************************************************************
+# SerialLink on a pseudo-terminal
+#*************************************************************************************************************
+@unittest.skipIf(link.termios is None, 'serial links need termios')
+class TestSerialLink(unittest.TestCase):
+
+	def setUp(self):
+		self.fd, self.slave = pty.openpty()
+		self.port = link.SerialPort(self.fd)
+		self.port.settimeout(1.0)
+		self.link = link.SerialLink(os.ttyname(self.slave), 9600)
+
+	def tearDown(self):
+		self.link.close()
+		self.port.close()
+		os.close(self.slave)
+
+	def _read_request(self):
+		reader = codec.FrameReader(self.port)
+		return bytearray(reader.read_frame(1.0)[:len(_request())])
+
+	def test_echo_and_noise_skipped(self):
+		self.link.send(_request())
+		request = self._read_request()
+		self.assertEqual(request, _request())
+		response = _response(120, bytearray(6))
+		#an RS-485 adapter echoes the request, then noise, then the answer
+		self.port.sendall(request + bytearray('\xaa\x55') + response)
+		self.assertEqual(bytearray(self.link.recv(1.0, HEADER)[:len(response)]), response)
+		self.assertEqual(self.link.discarded, len(request) + 2)
+
+	def test_timeout_includes_line_time(self):
+		self.link.send(_request())
+		self._read_request()
+		self.assertAlmostEqual(self.link._timeout(1.0), 1.0 + (len(_request()) + codec.MAX_FRAME_LENGTH) * 10 / 9600.0)
+		self.assertRaises(TimeoutError, self.link.recv, 0.05, HEADER)
+		self.assertTrue(self.link.is_open())
+
+	def test_missing_device(self):
+		bad = link.SerialLink('/dev/roc-no-such-tty', 9600)
+		self.assertRaises(socket.error, bad.open)
+		self.assertEqual(bad.failures, 1)
+
+
+if __name__ == '__main__':
+	unittest.main()